@@ -0,0 +1,316 @@
+"""Benchmark makem4b's processing stages against synthetic audiobooks.
+
+Run `python -m benchmarks run` to write a JSON report, and `python -m benchmarks compare` to compare two of them.
+`python -m benchmarks importtime` checks the startup of the CLI against a budget, `python -m benchmarks scaling`
+that analysis scales linearly with the number of files, `python -m benchmarks memory` the memory kept per
+analyzed file, and `python -m benchmarks parity` that the native probes agree with FFprobe.
+"""
+
+from __future__ import annotations
+
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import Any
+
+import rich_click as click
+from loguru import logger
+from rich.console import Console
+from rich.table import Table
+
+from benchmarks.fixtures import SCENARIOS
+from benchmarks.importtime import deferred_imports, measure_importtime, total_ms
+from benchmarks.memory import measure_probe_memory
+from benchmarks.parity import compare_probes
+from benchmarks.stages import STAGES, BookBenchmark, bench_probe_decoding, bench_probe_result
+from makem4b import __version__
+from makem4b.aioffmpeg import FFMPEG_CMD_BIN
+from makem4b.cli.env import Environment
+
+SCENARIO_NAMES = [spec.name for spec in SCENARIOS]
+PROBE_RESULT_SIZES = [100, 1000, 10000, 50000]
+PROBE_DECODING_SIZES = [1000, 10000]
+PROBE_MEMORY_SIZES = (1000, 10000, 100000)
+
+console = Console()
+
+
+def ffmpeg_version() -> str:
+    try:
+        output = subprocess.run(  # noqa: S603
+            [FFMPEG_CMD_BIN, "-version"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return output.splitlines()[0] if output else "unknown"
+
+
+@click.group()
+@click.help_option("-h", "--help")
+def cli() -> None:
+    logger.remove()
+    logger.add(sys.stderr, format="<level>{message}</level>", level="INFO")
+
+
+@cli.command()
+@click.option(
+    "-s",
+    "--scenario",
+    "scenarios",
+    type=click.Choice(SCENARIO_NAMES),
+    multiple=True,
+    help="Scenarios to run. Defaults to all of them.",
+)
+@click.option(
+    "-n",
+    "--tracks",
+    type=click.IntRange(min=1, max=5000),
+    multiple=True,
+    default=[10, 100],
+    show_default=True,
+    help="Number of tracks per book, can be given multiple times.",
+)
+@click.option(
+    "--stage",
+    "stages",
+    type=click.Choice(STAGES),
+    multiple=True,
+    help="Stages to time. Defaults to all of them.",
+)
+@click.option("-r", "--repeat", type=click.IntRange(min=1), default=3, show_default=True)
+@click.option("-j", "--jobs", type=click.IntRange(min=1), default=None, help="Defaults to the number of CPUs.")
+@click.option(
+    "--workdir",
+    type=click.Path(file_okay=False, path_type=Path),
+    default=None,
+    help="Directory for the generated books. Generated tracks are reused across runs. Defaults to a temporary one.",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    default=None,
+    help="File to write the JSON report to. Defaults to stdout.",
+)
+def run(
+    *,
+    scenarios: tuple[str, ...],
+    tracks: tuple[int, ...],
+    stages: tuple[str, ...],
+    repeat: int,
+    jobs: int | None,
+    workdir: Path | None,
+    output: Path | None,
+) -> None:
+    """Time the stages of makem4b for each scenario and number of tracks."""
+    with tempfile.TemporaryDirectory(prefix="makem4b-bench-") as tmpdir:
+        workdir = workdir or Path(tmpdir)
+        workdir.mkdir(parents=True, exist_ok=True)
+        # Without caches, each repeat measures the actual work, and nothing is written to the user's cache.
+        env = Environment(
+            cwd=workdir,
+            probe_cache=False,
+            library_index=False,
+            intermediate_cache_size=0,
+            cache_dir=workdir / "cache",
+        )
+        if jobs:
+            env.jobs = jobs
+
+        results: list[dict[str, Any]] = []
+        for spec in SCENARIOS:
+            if scenarios and spec.name not in scenarios:
+                continue
+            for count in tracks:
+                bench = BookBenchmark(env, spec.with_tracks(count), workdir=workdir, repeat=repeat)
+                results += bench.run(list(stages or STAGES))
+        results += bench_probe_result(PROBE_RESULT_SIZES, repeat=repeat)
+        results += bench_probe_decoding(PROBE_DECODING_SIZES, repeat=repeat)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(tz=UTC).isoformat(),
+            "makem4b": __version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "ffmpeg": ffmpeg_version(),
+            "jobs": env.jobs,
+        },
+        "results": results,
+    }
+    serialized = json.dumps(report, indent=2)
+    if output:
+        output.write_text(serialized + "\n")
+        logger.info("Wrote report to {}", output)
+    else:
+        click.echo(serialized)
+
+
+def _load_medians(report: Path) -> dict[tuple[str, int, str], float]:
+    results = json.loads(report.read_text())["results"]
+    return {(r["scenario"], r["tracks"], r["stage"]): r["median"] for r in results if "median" in r}
+
+
+@cli.command()
+@click.argument("baseline", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.argument("candidate", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+def compare(*, baseline: Path, candidate: Path) -> None:
+    """Compare the median timings of two reports."""
+    old, new = _load_medians(baseline), _load_medians(candidate)
+    table = Table("Scenario", "Tracks", "Stage", "Baseline", "Candidate", "Ratio")
+    for key in sorted(old.keys() & new.keys()):
+        ratio = new[key] / old[key] if old[key] else float("nan")
+        style = "green" if ratio < 0.95 else "red" if ratio > 1.05 else ""
+        table.add_row(
+            key[0],
+            str(key[1]),
+            key[2],
+            f"{old[key]:.3f}s",
+            f"{new[key]:.3f}s",
+            f"[{style}]{ratio:.2f}x[/]" if style else f"{ratio:.2f}x",
+        )
+    console.print(table)
+
+
+@cli.command()
+@click.option(
+    "--budget",
+    type=click.FloatRange(min=0),
+    default=500,
+    show_default=True,
+    help="Milliseconds the imports of `makem4b --help` may take, as reported by -X importtime. Depends on the machine.",
+)
+@click.option("-r", "--repeat", type=click.IntRange(min=1), default=5, show_default=True)
+@click.option(
+    "--top",
+    type=click.IntRange(min=0),
+    default=15,
+    show_default=True,
+    help="Number of the slowest imports to show.",
+)
+def importtime(*, budget: float, repeat: int, top: int) -> None:
+    """Check the import time of `makem4b --help` against a budget, failing if it is exceeded.
+
+    Also fails if modules only needed for processing are imported, regardless of the time taken.
+    """
+    times = measure_importtime(["--help"], repeat=repeat)
+    if not times:
+        msg = "No import times reported, does `python -m makem4b --help` run?"
+        raise click.ClickException(msg)
+
+    table = Table("Module", "Self", "Cumulative")
+    for time in sorted(times, key=lambda t: t.cumulative_us, reverse=True)[:top]:
+        table.add_row(time.module, f"{time.self_us / 1000:.1f}ms", f"{time.cumulative_us / 1000:.1f}ms")
+    console.print(table)
+
+    total = total_ms(times)
+    failed = False
+    if total > budget:
+        logger.error("Imports took {:.1f}ms, exceeding the budget of {:.0f}ms", total, budget)
+        failed = True
+    else:
+        logger.info("Imports took {:.1f}ms of the budget of {:.0f}ms", total, budget)
+    if deferred := deferred_imports(times):
+        logger.error("Modules imported that are only needed for processing: {}", ", ".join(deferred))
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+@cli.command()
+@click.option("-r", "--repeat", type=click.IntRange(min=1), default=5, show_default=True)
+@click.option(
+    "--max-ratio",
+    type=click.FloatRange(min=1),
+    default=2.0,
+    show_default=True,
+    help="Factor by which the time per file may grow from the fewest to the most files.",
+)
+def scaling(*, repeat: int, max_ratio: float) -> None:
+    """Check that adding files to a ProbeResult scales linearly, up to 50000 files.
+
+    Fails if the time per file of the largest number of files exceeds that of the smallest by more than
+    --max-ratio. The fastest of the repeated runs is used, as it is the least affected by noise.
+    """
+    records = bench_probe_result(PROBE_RESULT_SIZES, repeat=repeat)
+    table = Table("Files", "Total", "Per file")
+    for record in records:
+        table.add_row(str(record["tracks"]), f"{record['min']:.3f}s", f"{record['min'] / record['tracks'] * 1e6:.2f}µs")
+    console.print(table)
+
+    smallest, largest = records[0], records[-1]
+    ratio = (largest["min"] / largest["tracks"]) / (smallest["min"] / smallest["tracks"])
+    if ratio > max_ratio:
+        logger.error(
+            "Time per file grew {:.2f}x from {} to {} files, exceeding {:.2f}x",
+            ratio,
+            smallest["tracks"],
+            largest["tracks"],
+            max_ratio,
+        )
+        sys.exit(1)
+    logger.info("Time per file grew {:.2f}x from {} to {} files", ratio, smallest["tracks"], largest["tracks"])
+
+
+@cli.command()
+@click.option(
+    "-n",
+    "--files",
+    "counts",
+    type=click.IntRange(min=1),
+    multiple=True,
+    default=PROBE_MEMORY_SIZES,
+    show_default=True,
+    help="Number of files to analyze, may be given multiple times.",
+)
+@click.option(
+    "--budget",
+    type=click.IntRange(min=0),
+    default=None,
+    help="Bytes a ProbeResult may keep per file, failing if it is exceeded.",
+)
+def memory(*, counts: tuple[int, ...], budget: int | None) -> None:
+    """Measure the memory kept per file when analyzing large libraries."""
+    table = Table("Files", "Bytes per file", "Total")
+    largest = 0
+    for count in counts:
+        per_file = measure_probe_memory(count)
+        largest = max(largest, per_file)
+        table.add_row(str(count), str(per_file), f"{per_file * count / 1024 / 1024:.1f} MiB")
+    console.print(table)
+    if budget is not None and largest > budget:
+        logger.error("Analysis kept {} bytes per file, exceeding the budget of {} bytes", largest, budget)
+        sys.exit(1)
+
+
+@cli.command()
+@click.option(
+    "--workdir",
+    type=click.Path(file_okay=False, path_type=Path),
+    default=None,
+    help="Directory for the generated books. Generated tracks are reused across runs. Defaults to a temporary one.",
+)
+def parity(*, workdir: Path | None) -> None:
+    """Check that probing files from their headers agrees with FFprobe, failing on any difference.
+
+    Codec parameters must match exactly, as books mixing both probes are otherwise transcoded instead of remuxed.
+    """
+    with tempfile.TemporaryDirectory(prefix="makem4b-bench-") as tmpdir:
+        workdir = workdir or Path(tmpdir)
+        compared, differences = compare_probes(workdir=workdir)
+    for difference in differences:
+        logger.error(difference)
+    if differences:
+        sys.exit(1)
+    logger.info("Native probes of {} files agree with FFprobe", compared)
+
+
+if __name__ == "__main__":
+    cli()
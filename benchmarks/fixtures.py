@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import shutil
+import subprocess
+from enum import StrEnum
+from typing import TYPE_CHECKING, Any, NamedTuple
+
+from makem4b.aioffmpeg import FFMPEG_CMD
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+class Codec(StrEnum):
+    MP3_CBR = "mp3-cbr"
+    MP3_CBR_LOW = "mp3-cbr-low"
+    MP3_VBR = "mp3-vbr"
+    AAC = "aac"
+
+
+CODEC_ARGS = {
+    Codec.MP3_CBR: ["-c:a", "libmp3lame", "-b:a", "64k"],
+    # Below 56 kBit/s, LAME writes its Info frame at a higher bit rate than the audio frames.
+    Codec.MP3_CBR_LOW: ["-c:a", "libmp3lame", "-b:a", "32k"],
+    Codec.MP3_VBR: ["-c:a", "libmp3lame", "-q:a", "6"],
+    Codec.AAC: ["-c:a", "aac", "-b:a", "64k"],
+}
+CODEC_SUFFIXES = {
+    Codec.MP3_CBR: ".mp3",
+    Codec.MP3_CBR_LOW: ".mp3",
+    Codec.MP3_VBR: ".mp3",
+    Codec.AAC: ".m4a",
+}
+
+
+class BookSpec(NamedTuple):
+    """Synthetic audiobook, its tracks cycle through the given sample rates."""
+
+    name: str
+    codec: Codec
+    tracks: int
+    sample_rates: tuple[int, ...] = (44100,)
+    cover: bool = False
+    track_seconds: float = 2.0
+
+    @property
+    def suffix(self) -> str:
+        return CODEC_SUFFIXES[self.codec]
+
+    def with_tracks(self, tracks: int) -> BookSpec:
+        return self._replace(name=f"{self.name}-{tracks}", tracks=tracks)
+
+
+SCENARIOS = [
+    BookSpec("mp3-cbr", Codec.MP3_CBR, tracks=10),
+    BookSpec("mp3-vbr", Codec.MP3_VBR, tracks=10),
+    BookSpec("aac", Codec.AAC, tracks=10),
+    BookSpec("mp3-mixed-rates", Codec.MP3_CBR, tracks=10, sample_rates=(44100, 22050)),
+    BookSpec("mp3-cover", Codec.MP3_CBR, tracks=10, cover=True),
+    BookSpec("aac-cover", Codec.AAC, tracks=10, cover=True),
+]
+
+# Books whose files are probed both natively and with FFprobe, covering MPEG-1 and MPEG-2 sample rates.
+PARITY_SCENARIOS = [
+    BookSpec("mp3-cbr", Codec.MP3_CBR, tracks=4, sample_rates=(44100, 22050, 48000, 24000)),
+    BookSpec("mp3-cbr-low", Codec.MP3_CBR_LOW, tracks=4, sample_rates=(8000, 22050, 24000, 48000)),
+    BookSpec("mp3-vbr", Codec.MP3_VBR, tracks=4, sample_rates=(44100, 22050)),
+    BookSpec("mp3-cover", Codec.MP3_CBR, tracks=2, cover=True),
+    BookSpec("aac", Codec.AAC, tracks=4, sample_rates=(44100, 22050, 48000, 24000)),
+    BookSpec("aac-cover", Codec.AAC, tracks=2, cover=True),
+]
+
+
+def _generate_track(spec: BookSpec, *, sample_rate: int, variant: int, output: Path) -> None:
+    # Alternate between tones and noise, so that encoders do not get away with trivial input.
+    source = (
+        f"sine=frequency={220 + 110 * variant}:sample_rate={sample_rate}:duration={spec.track_seconds}"
+        if variant % 2 == 0
+        else f"anoisesrc=color=pink:sample_rate={sample_rate}:duration={spec.track_seconds}:amplitude=0.2"
+    )
+    inputs = ["-f", "lavfi", "-i", source]
+    maps = ["-map", "0:a"]
+    cover_args: list[str] = []
+    if spec.cover:
+        inputs += ["-f", "lavfi", "-i", "color=c=teal:s=300x300:d=1", "-frames:v", "1"]
+        maps += ["-map", "1:v"]
+        cover_args = ["-c:v", "mjpeg", "-disposition:v", "attached_pic"]
+        if spec.codec != Codec.AAC:
+            cover_args += ["-id3v2_version", "3"]
+
+    subprocess.run(  # noqa: S603
+        [
+            *FFMPEG_CMD,
+            *inputs,
+            *maps,
+            "-ac",
+            "1",
+            *CODEC_ARGS[spec.codec],
+            *cover_args,
+            "-metadata",
+            "artist=Benchmark",
+            "-metadata",
+            f"album=Book {spec.codec}",
+            "-metadata",
+            f"title=Track {variant + 1}",
+            str(output),
+        ],
+        check=True,
+        capture_output=True,
+    )
+
+
+def generate_book(spec: BookSpec, *, directory: Path, templates: Path) -> list[Path]:
+    """Generate the tracks of a book into directory.
+
+    Only a few distinct tracks per book are encoded (and kept in templates for subsequent books),
+    the others are copies of them, so that books with thousands of tracks are quick to set up.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    templates.mkdir(parents=True, exist_ok=True)
+    files = []
+    width = len(str(spec.tracks))
+    for idx in range(spec.tracks):
+        sample_rate = spec.sample_rates[idx % len(spec.sample_rates)]
+        variant = idx % 4
+        template = templates / (
+            f"{spec.codec}-{sample_rate}-{int(spec.cover)}-{spec.track_seconds}-{variant}{spec.suffix}"
+        )
+        if not template.is_file():
+            _generate_track(spec, sample_rate=sample_rate, variant=variant, output=template)
+
+        output = directory / f"{idx + 1:0{width}d}{spec.suffix}"
+        shutil.copyfile(template, output)
+        files.append(output)
+    return files
+
+
+def make_probe_output(idx: int, *, tracks: int) -> dict[str, Any]:
+    """Build the ffprobe output of track idx of a book, as parsed from JSON, with tags and an embedded cover."""
+    return {
+        "streams": [
+            {
+                "index": 0,
+                "codec_name": "mp3",
+                "codec_type": "audio",
+                "sample_fmt": "fltp",
+                "sample_rate": "44100",
+                "channels": 2,
+                "channel_layout": "stereo",
+                "time_base": "1/14112000",
+                "start_pts": 353600,
+                "start_time": "0.025057",
+                "duration_ts": 8467200000,
+                "duration": "600.000000",
+                "bit_rate": "128000",
+                "disposition": {"default": 0, "attached_pic": 0},
+                "tags": {"encoder": "LAME3.100"},
+                "side_data_list": [{"side_data_type": "Replay Gain", "track_gain": "-4.200000", "track_peak": "0.988"}],
+            },
+            {
+                "index": 1,
+                "codec_name": "mjpeg",
+                "codec_type": "video",
+                "width": 600,
+                "height": 600,
+                "disposition": {"default": 0, "attached_pic": 1},
+                "tags": {"comment": "Cover (front)"},
+            },
+        ],
+        "format": {
+            "filename": f"{idx:05d}.mp3",
+            "format_name": "mp3",
+            "duration": "600.025057",
+            "tags": {
+                "title": f"Chapter {idx + 1}",
+                "artist": "Benchmark",
+                "album_artist": "Benchmark",
+                "album": "Scaling",
+                "genre": "Audiobook",
+                "date": "2024",
+                "track": f"{idx + 1}/{tracks}",
+                "comment": "Encoded for the benchmarks of makem4b",
+            },
+        },
+    }
@@ -0,0 +1,62 @@
+"""Measure the import time of the makem4b CLI with Python's -X importtime."""
+
+from __future__ import annotations
+
+import re
+import subprocess
+import sys
+from typing import NamedTuple
+
+re_importtime = re.compile(r"^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \| (?P<module>.+)$")
+
+# Modules only needed for processing, which must not be imported to print the help.
+DEFERRED_MODULES = (
+    "pydantic",
+    "makem4b.models",
+    "makem4b.base",
+    "makem4b.ffmpeg",
+    "makem4b.server",
+    "rich.progress",
+)
+
+
+class ImportTime(NamedTuple):
+    module: str
+    self_us: int
+    cumulative_us: int
+
+
+def parse_importtime(output: str) -> list[ImportTime]:
+    times = []
+    for line in output.splitlines():
+        if match := re_importtime.match(line):
+            times.append(
+                ImportTime(
+                    module=match.group("module").strip(),
+                    self_us=int(match.group("self")),
+                    cumulative_us=int(match.group("cumulative")),
+                )
+            )
+    return times
+
+
+def total_ms(times: list[ImportTime]) -> float:
+    return sum(time.self_us for time in times) / 1000
+
+
+def measure_importtime(args: list[str], *, repeat: int) -> list[ImportTime]:
+    """Run the CLI with args repeat times, returning the import times of the fastest run."""
+    runs = []
+    for _ in range(repeat):
+        proc = subprocess.run(  # noqa: S603
+            [sys.executable, "-X", "importtime", "-m", "makem4b", *args],
+            check=False,
+            capture_output=True,
+            text=True,
+        )
+        runs.append(parse_importtime(proc.stderr))
+    return min(runs, key=total_ms)
+
+
+def deferred_imports(times: list[ImportTime]) -> list[str]:
+    return sorted(time.module for time in times if time.module in DEFERRED_MODULES)
@@ -0,0 +1,31 @@
+"""Measure the memory a ProbeResult keeps for each analyzed file with tracemalloc."""
+
+from __future__ import annotations
+
+import gc
+import json
+import tracemalloc
+from pathlib import Path
+
+from benchmarks.fixtures import make_probe_output
+from makem4b.models import FFProbeOutput
+from makem4b.types import ProbedFile, ProbeResult
+
+
+def measure_probe_memory(count: int) -> int:
+    """Analyze count synthetic files decoded from cached JSON, returning the bytes kept allocated per file."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        baseline, _ = tracemalloc.get_traced_memory()
+        result = ProbeResult(files=[])
+        for idx in range(count):
+            output = FFProbeOutput.decode(json.dumps(make_probe_output(idx, tracks=count)))
+            file = Path(f"/library/Benchmark/Scaling/{idx:06d}.mp3")
+            result.add(ProbedFile.from_ffmpeg_probe_output(output, file=file))
+        gc.collect()
+        retained, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return round((retained - baseline) / count)
@@ -0,0 +1,47 @@
+"""Compare the native header probes against FFprobe on synthetic audiobooks."""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from benchmarks.fixtures import PARITY_SCENARIOS, generate_book
+from makem4b import ffmpeg, headers
+from makem4b.models import FFProbeOutput
+from makem4b.types import ProbedFile
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+# Durations are reported with microsecond precision, native ones may differ in the last digit.
+DURATION_TOLERANCE = 1e-5
+
+
+def _probe_both(file: Path) -> tuple[ProbedFile, ProbedFile] | None:
+    if not (native := headers.probe(file)):
+        return None
+    return (
+        ProbedFile.from_ffmpeg_probe_output(FFProbeOutput.decode(native), file=file),
+        ProbedFile.from_ffmpeg_probe_output(FFProbeOutput.decode(ffmpeg.probe(file)), file=file),
+    )
+
+
+def compare_probes(*, workdir: Path) -> tuple[int, list[str]]:
+    """Probe the files of the parity scenarios both ways, returning the number compared and their differences."""
+    compared = 0
+    differences = []
+    for spec in PARITY_SCENARIOS:
+        files = generate_book(spec, directory=workdir / "parity" / spec.name, templates=workdir / "templates")
+        for file in files:
+            name = f"{spec.name}/{file.name}"
+            if not (probed := _probe_both(file)):
+                differences.append(f"{name}: not handled natively")
+                continue
+            compared += 1
+            native, ffprobed = probed
+            if native.codec_params != ffprobed.codec_params:
+                differences.append(f"{name}: {native.codec_params} != {ffprobed.codec_params}")
+            if abs(native.stream.duration - ffprobed.stream.duration) > DURATION_TOLERANCE:
+                differences.append(f"{name}: duration {native.stream.duration} != {ffprobed.stream.duration}")
+            if native.has_cover != ffprobed.has_cover:
+                differences.append(f"{name}: cover {native.has_cover} != {ffprobed.has_cover}")
+    return compared, differences
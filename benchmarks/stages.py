@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import json
+import tempfile
+import time
+from pathlib import Path
+from statistics import median
+from typing import TYPE_CHECKING, Any
+
+from loguru import logger
+
+from benchmarks.fixtures import BookSpec, generate_book, make_probe_output
+from makem4b.analysis import probe_files
+from makem4b.base import merge, process
+from makem4b.intermediates import generate_concat_file, generate_intermediates
+from makem4b.metadata import generate_metadata
+from makem4b.models import FFProbeOutput, Metadata
+from makem4b.types import ProbedFile, ProbedStream, ProbeResult
+from makem4b.utils import OutputBuffer
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from makem4b.cli.env import Environment
+
+STAGES = (
+    "probe_files",
+    "intermediates_remux",
+    "intermediates_transcode",
+    "generate_metadata",
+    "merge",
+    "process",
+)
+
+
+def measure(func: Callable[[], Any], *, repeat: int) -> list[float]:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def make_record(scenario: str, tracks: int, stage: str, timings: list[float]) -> dict[str, Any]:
+    return {
+        "scenario": scenario,
+        "tracks": tracks,
+        "stage": stage,
+        "seconds": timings,
+        "min": min(timings),
+        "median": median(timings),
+    }
+
+
+class BookBenchmark:
+    """Times the processing stages of makem4b against one synthetic book."""
+
+    def __init__(self, env: Environment, spec: BookSpec, *, workdir: Path, repeat: int) -> None:
+        self.env = env
+        self.spec = spec
+        self.workdir = workdir
+        self.repeat = repeat
+        self.files = generate_book(spec, directory=workdir / spec.name, templates=workdir / "templates")
+
+    def _tmpdir(self) -> tempfile.TemporaryDirectory[str]:
+        return tempfile.TemporaryDirectory(dir=self.workdir, prefix="run-")
+
+    def probe(self) -> ProbeResult:
+        return probe_files(
+            self.files,
+            analyze_only=False,
+            no_transcode=False,
+            prefer_remux=False,
+            jobs=self.env.jobs,
+            disable_progress=True,
+        )
+
+    def bench_probe_files(self) -> list[float]:
+        return measure(self.probe, repeat=self.repeat)
+
+    def _bench_intermediates(self, *, prefer_remux: bool) -> list[float]:
+        result = self.probe()
+
+        def _run() -> None:
+            with self._tmpdir() as tmpdir:
+                generate_intermediates(
+                    result,
+                    tmpdir=Path(tmpdir),
+                    prefer_remux=prefer_remux,
+                    jobs=self.env.jobs,
+                    disable_progress=True,
+                )
+
+        return measure(_run, repeat=self.repeat)
+
+    def bench_intermediates_remux(self) -> list[float]:
+        return self._bench_intermediates(prefer_remux=True)
+
+    def bench_intermediates_transcode(self) -> list[float]:
+        return self._bench_intermediates(prefer_remux=False)
+
+    def bench_generate_metadata(self) -> list[float]:
+        result = self.probe()
+        durations = [f.stream.duration_ts for f in result]
+        with self._tmpdir() as tmpdir:
+            return measure(
+                lambda: generate_metadata(result.files, durations=durations, tmpdir=Path(tmpdir)),
+                repeat=self.repeat,
+            )
+
+    def bench_merge(self) -> list[float]:
+        result = self.probe()
+        with self._tmpdir() as tmpdir_name:
+            tmpdir = Path(tmpdir_name)
+            intermediates, durations = generate_intermediates(
+                result,
+                tmpdir=tmpdir,
+                prefer_remux=True,
+                jobs=self.env.jobs,
+                disable_progress=True,
+            )
+            concat_file = generate_concat_file(intermediates, tmpdir=tmpdir)
+            metadata_file = generate_metadata(result.files, durations=durations, tmpdir=tmpdir)
+            output = tmpdir / "merged.m4b"
+            return measure(
+                lambda: merge(
+                    concat_file,
+                    metadata_file=metadata_file,
+                    output=output,
+                    total=result.approx_size,
+                    disable_progress=True,
+                ),
+                repeat=self.repeat,
+            )
+
+    def bench_process(self) -> list[float]:
+        def _run() -> None:
+            output = process(
+                self.env,
+                files=self.files,
+                move_originals_to=None,
+                analyze_only=False,
+                prefer_remux=False,
+                no_transcode=False,
+                overwrite=True,
+            )
+            output.unlink()
+
+        return measure(_run, repeat=self.repeat)
+
+    def run(self, stages: list[str]) -> list[dict[str, Any]]:
+        records = []
+        for stage in stages:
+            logger.info("Benchmarking {} on {}", stage, self.spec.name)
+            try:
+                with OutputBuffer().capture():
+                    timings = getattr(self, f"bench_{stage}")()
+            except Exception as exc:  # noqa: BLE001
+                logger.warning("Stage {} failed on {}: {}", stage, self.spec.name, exc)
+                records.append(
+                    {"scenario": self.spec.name, "tracks": self.spec.tracks, "stage": stage, "error": str(exc)}
+                )
+                continue
+            records.append(make_record(self.spec.name, self.spec.tracks, stage, timings))
+        return records
+
+
+def make_probed_files(count: int) -> list[ProbedFile]:
+    metadata = Metadata(artist="Benchmark", album="Scaling")
+    streams = [
+        ProbedStream(codec_name="aac", sample_rate=44100, bit_rate=bit_rate, channels=1, duration=10.0)
+        for bit_rate in (64000, 64050)
+    ]
+    return [
+        ProbedFile(
+            filename=Path(f"{idx:05d}.m4a"),
+            stream=streams[idx % 2],
+            title=f"Chapter {idx + 1}",
+            has_cover=False,
+            metadata=metadata,
+        )
+        for idx in range(count)
+    ]
+
+
+def bench_probe_result(counts: list[int], *, repeat: int) -> list[dict[str, Any]]:
+    """Time adding synthetic files to a ProbeResult, which must scale linearly with their number."""
+    records = []
+    for count in counts:
+        files = make_probed_files(count)
+
+        def _run(files: list[ProbedFile] = files) -> None:
+            result = ProbeResult(files=[])
+            for file in files:
+                result.add(file)
+
+        records.append(make_record("probe-result", count, "probe_result_add", measure(_run, repeat=repeat)))
+    return records
+
+
+def bench_probe_decoding(counts: list[int], *, repeat: int) -> list[dict[str, Any]]:
+    """Time validating cached ffprobe outputs after parsing them, and decoding them with FFProbeOutput.decode."""
+    records = []
+    for count in counts:
+        outputs = [json.dumps(make_probe_output(idx, tracks=count)) for idx in range(count)]
+
+        def _validate(outputs: list[str] = outputs) -> None:
+            for output in outputs:
+                FFProbeOutput.model_validate(json.loads(output))
+
+        def _decode(outputs: list[str] = outputs) -> None:
+            for output in outputs:
+                FFProbeOutput.decode(output)
+
+        records.append(make_record("probe-decoding", count, "probe_validate", measure(_validate, repeat=repeat)))
+        records.append(make_record("probe-decoding", count, "probe_decode", measure(_decode, repeat=repeat)))
+    return records
@@ -0,0 +1,243 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import shlex
+import threading
+from contextlib import asynccontextmanager, nullcontext
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from loguru import logger
+
+from makem4b import constants, metrics
+from makem4b.progress import read_progress, read_tail
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncGenerator, Callable, Coroutine
+    from concurrent.futures import Future
+
+    from makem4b.progress import ProgressEvent
+
+    ProgressCallback = Callable[[ProgressEvent], object]
+
+
+FFMPEG_CMD_BIN = "ffmpeg"
+
+FFPROBE_CMD = [
+    "ffprobe",
+    "-hide_banner",
+    "-v",
+    "16",
+]
+FFMPEG_CMD = [
+    FFMPEG_CMD_BIN,
+    "-hide_banner",
+    "-v",
+    "16",
+    "-y",
+]
+PROGRESS_ARGS = [
+    "-progress",
+    "-",
+    "-nostats",
+]
+CONCAT_AAC_ADDED_ARGS = [
+    "-movflags",
+    "faststart",
+    "-f",
+    "mp4",
+]
+
+
+class BackgroundLoop:
+    """Event loop running in a daemon thread, so that synchronous code can run coroutines on it."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if not self._loop:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="ffmpeg-loop", daemon=True).start()
+            return self._loop
+
+    def submit[T](self, coro: Coroutine[Any, Any, T]) -> Future[T]:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+background_loop = BackgroundLoop()
+
+
+def _make_input_args(inputs: list[Path | str] | Path | str) -> list[str]:
+    if not isinstance(inputs, list):
+        inputs = [inputs]
+    args = []
+    for file in inputs:
+        if isinstance(file, Path) and not file.is_file():
+            msg = f"File '{file}' not found"
+            raise ValueError(msg)
+        args += ["-i", str(file)]
+    return args
+
+
+@asynccontextmanager
+async def _spawn(cmd: list[str], *, limit: asyncio.Semaphore | None) -> AsyncGenerator[asyncio.subprocess.Process]:
+    """Spawn a process once the limit allows it, killing it if it is still running when leaving the context."""
+    async with limit or nullcontext():
+        logger.debug("Running command: {}", shlex.join(cmd))
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        metrics.ffmpeg_processes.inc()
+        try:
+            yield process
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            metrics.ffmpeg_processes.dec()
+
+
+async def run_ffmpeg(
+    args: list[str],
+    *,
+    on_progress: ProgressCallback | None = None,
+    limit: asyncio.Semaphore | None = None,
+) -> None:
+    """Run FFmpeg with args, reporting its progress to on_progress.
+
+    Cancelling the run kills the FFmpeg process.
+    """
+    async with _spawn([*FFMPEG_CMD, *PROGRESS_ARGS, *args], limit=limit) as process:
+        if not process.stdout or not process.stderr:
+            msg = "FFmpeg process is missing its pipes."
+            raise RuntimeError(msg)
+
+        stderr_task = asyncio.create_task(read_tail(process.stderr))
+        try:
+            async for event in read_progress(process.stdout):
+                if on_progress:
+                    on_progress(event)
+                if event.ended and event.speed:
+                    metrics.ffmpeg_speed.observe(event.speed)
+            stderr = await stderr_task
+        finally:
+            stderr_task.cancel()
+        await process.wait()
+
+    if process.returncode != 0:
+        msg = f"Error running command {shlex.join(['ffmpeg', *args])}"
+        if stderr:
+            msg += f": {stderr}"
+        raise RuntimeError(msg)
+
+
+async def _run_ffprobe(args: list[str], *, file: Path, limit: asyncio.Semaphore | None) -> bytes:
+    async with _spawn([*FFPROBE_CMD, *_make_input_args(file), *args], limit=limit) as process:
+        stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        msg = f"File {file} could not be parsed: {stderr.decode(errors='replace')}"
+        raise RuntimeError(msg)
+    return stdout
+
+
+async def probe(file: Path, *, limit: asyncio.Semaphore | None = None) -> dict[str, Any]:
+    output = await _run_ffprobe(
+        [
+            "-output_format",
+            "json",
+            "-show_streams",
+            "-show_entries",
+            "format_tags",
+        ],
+        file=file,
+        limit=limit,
+    )
+    try:
+        return json.loads(output)
+    except json.JSONDecodeError as exc:
+        msg = f"File {file} could not be probed: {exc}"
+        raise RuntimeError(msg) from exc
+
+
+async def probe_duration(file: Path, *, limit: asyncio.Semaphore | None = None) -> int:
+    output = await _run_ffprobe(
+        [
+            "-output_format",
+            "csv=p=0",
+            "-show_entries",
+            "format=duration",
+        ],
+        file=file,
+        limit=limit,
+    )
+    return round(float(output) * constants.TIMEBASE)
+
+
+async def extract_cover_img(file: Path, *, output: Path, limit: asyncio.Semaphore | None = None) -> None:
+    await run_ffmpeg(
+        [
+            *_make_input_args(file),
+            "-map_metadata",
+            "-1",
+            "-map",
+            "0:v",
+            "-map",
+            "-0:V",
+            "-c",
+            "copy",
+            str(output),
+        ],
+        limit=limit,
+    )
+
+
+async def convert(
+    inputs: list[Path | str],
+    args: list[str],
+    *,
+    output: Path,
+    on_progress: ProgressCallback | None = None,
+    limit: asyncio.Semaphore | None = None,
+) -> None:
+    await run_ffmpeg(
+        [
+            *_make_input_args(inputs),
+            *args,
+            str(output),
+        ],
+        on_progress=on_progress,
+        limit=limit,
+    )
+
+
+async def concat(
+    inputs: list[Path | str],
+    args: list[str],
+    *,
+    output: Path,
+    on_progress: ProgressCallback | None = None,
+    limit: asyncio.Semaphore | None = None,
+) -> None:
+    if output.suffix in (".m4a", ".m4b"):
+        args = args + CONCAT_AAC_ADDED_ARGS
+    await run_ffmpeg(
+        [
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            *_make_input_args(inputs),
+            *args,
+            str(output),
+        ],
+        on_progress=on_progress,
+        limit=limit,
+    )
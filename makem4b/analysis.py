@@ -1,25 +1,39 @@
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
 from typing import TYPE_CHECKING
 
 from click.exceptions import Exit
-from rich import box, get_console
+from rich import box
 from rich.progress import track
 from rich.table import Table
 
-from makem4b import constants, ffmpeg
+from makem4b import constants, ffmpeg, headers, metrics
 from makem4b.emoji import Emoji
 from makem4b.models import FFProbeOutput
 from makem4b.types import ProbedFile, ProbeResult, ProcessingMode
-from makem4b.utils import pinfo
+from makem4b.utils import current_console, display_path, pinfo
 
 if TYPE_CHECKING:
     from pathlib import Path
 
-
-def _probe_file(file: Path) -> ProbedFile:
-    output = ffmpeg.probe(file)
-    ffprobed = FFProbeOutput.model_validate(output, context={"file": file})
+    from makem4b.cache import ProbeCache
+    from makem4b.headers import ProbeOutput
+
+
+def _probe_file(file: Path, cache: ProbeCache | None = None) -> ProbedFile:
+    source = "cache"
+    output: str | ProbeOutput | None = cache.get(file) if cache else None
+    if output is None:
+        source = "headers"
+        if not (output := headers.probe(file)):
+            source = "ffprobe"
+            output = ffmpeg.probe(file)
+        if cache:
+            cache.set(file, output)
+    metrics.files_probed.inc(source)
+    ffprobed = FFProbeOutput.decode(output, context={"file": file})
     return ProbedFile.from_ffmpeg_probe_output(ffprobed, file=file)
 
 
@@ -29,26 +43,37 @@ def probe_files(
     analyze_only: bool,
     no_transcode: bool,
     prefer_remux: bool,
+    jobs: int = 1,
+    cache: ProbeCache | None = None,
     disable_progress: bool = False,
 ) -> ProbeResult:
     pinfo(Emoji.ANALYZE, f"Analyzing {len(files)} files")
 
     result = ProbeResult(files=[])
-    for file in track(
-        sorted(files),
-        description="Analyzing",
-        transient=True,
-        disable=disable_progress,
-    ):
-        probed_file = _probe_file(file)
-        result.add(probed_file)
-
-        if exit_code := result.check_should_bail(
-            analyze_only=analyze_only,
-            no_transcode=no_transcode,
-            prefer_remux=prefer_remux,
-        ):
-            raise Exit(exit_code)
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="probe") as executor:
+        # Probes are submitted in sorted order and consumed in that same order, so
+        # that the result is identical to probing the files one after another.
+        futures = [executor.submit(copy_context().run, _probe_file, file, cache) for file in sorted(files)]
+        try:
+            for future in track(
+                futures,
+                description="Analyzing",
+                transient=True,
+                disable=disable_progress,
+            ):
+                result.add(future.result())
+
+                if exit_code := result.check_should_bail(
+                    analyze_only=analyze_only,
+                    no_transcode=no_transcode,
+                    prefer_remux=prefer_remux,
+                ):
+                    raise Exit(exit_code)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            # Other processes may be waiting to write to the cache, keep its transaction short.
+            if cache:
+                cache.commit()
 
     return result
 
@@ -92,13 +117,13 @@ def print_probe_result(probed: ProbeResult) -> None:
             msg = "Remuxable " + Emoji.REMUX
     table.add_column("Files", msg)
 
-    for codec, files in probed.seen_codecs.items():
+    for codec, indices in probed.seen_codecs.items():
         table.add_row(
             codec.codec_name,
             f"{codec.bit_rate/1000:.3f} kBit/s",
             f"{codec.sample_rate/1000:.1f} kHz",
             f"{codec.channels:d}",
-            "\n".join(str(f.relative_to(constants.CWD)) for f in files),
+            "\n".join(str(display_path(probed.files[idx].filename, constants.CWD)) for idx in indices),
         )
 
-    get_console().print(table)
+    current_console().print(table)
@@ -1,6 +1,10 @@
 from __future__ import annotations
 
+import errno
 import shutil
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import copy_context
+from dataclasses import dataclass
 from os.path import commonpath
 from pathlib import Path
 from typing import TYPE_CHECKING
@@ -8,31 +12,67 @@ from typing import TYPE_CHECKING
 from click.exceptions import Exit
 from rich.progress import Progress, track
 
-from makem4b import constants, ffmpeg
+from makem4b import aioffmpeg, constants, ffmpeg, metrics
 from makem4b.analysis import print_probe_result, probe_files
 from makem4b.emoji import Emoji
-from makem4b.intermediates import generate_concat_file, generate_intermediates
+from makem4b.intermediates import (
+    generate_concat_file,
+    generate_intermediates,
+    make_intermediate_pipes,
+    requires_intermediates,
+    requires_transcode,
+    supports_pipes,
+)
 from makem4b.metadata import extract_cover_img, generate_metadata
+from makem4b.timings import total_size
 from makem4b.types import ExitCode, ProbeResult, ProcessingMode
-from makem4b.utils import TaskProgress, pinfo
+from makem4b.utils import TaskProgress, display_path, pinfo
 
 if TYPE_CHECKING:
     from makem4b.cli.env import Environment
 
-CACHEDIR_TAG = "CACHEDIR.TAG"
+# Intermediates are written as MPEG-TS, which adds some overhead to the audio data.
+INTERMEDIATES_OVERHEAD = 1.1
+SCRATCH_SPACE_MARGIN = 1.1
 
 
-def move_files(result: ProbeResult, target_path: Path, subdir: str) -> None:
+def move_files(result: ProbeResult, target_path: Path, subdir: str, *, disable_progress: bool = False) -> None:
     pinfo(Emoji.METADATA, "Moving original files")
     common = Path(commonpath(f.filename for f in result))
     if not common.is_file():
         common = result.first.filename.parent
-    for file in track(result, description="Moving files", transient=True):
+    for file in track(result, description="Moving files", transient=True, disable=disable_progress):
         file_target = target_path / subdir / file.filename.relative_to(common)
         file_target.parent.mkdir(exist_ok=True)
         shutil.move(file.filename, file_target)
 
 
+def move_output(source: Path, target: Path) -> None:
+    """Move source to target, which only ever appears complete, even across filesystems."""
+    try:
+        source.replace(target)
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+        partial = target.with_name(f".{target.name}.part")
+        try:
+            shutil.copyfile(source, partial)
+            partial.replace(target)
+        except BaseException:
+            partial.unlink(missing_ok=True)
+            raise
+        source.unlink()
+
+
+def estimate_scratch_space(env: Environment, result: ProbeResult, *, prefer_remux: bool) -> int:
+    """Estimate the space taken up by the temporary files of a book: its output, and its intermediates."""
+    size = result.approx_size
+    single_pass = env.single_pass and requires_transcode(result, prefer_remux=prefer_remux)
+    if requires_intermediates(result) and not single_pass and not env.pipe_intermediates:
+        size += round(result.approx_size * INTERMEDIATES_OVERHEAD)
+    return round(size * SCRATCH_SPACE_MARGIN)
+
+
 def generate_output_filename(result: ProbeResult, *, prefer_remux: bool, overwrite: bool) -> Path:
     if not result.processing_params:
         msg = "Processing parameters cannot be unset."
@@ -48,7 +88,7 @@ def generate_output_filename(result: ProbeResult, *, prefer_remux: bool, overwri
 
     output = result.first.filename.with_name(result.first.output_filename_stem + ext).resolve()
     if output.is_file() and not overwrite:
-        pinfo(Emoji.STOP, "Target file already exists:", output.relative_to(constants.CWD), style="bold red")
+        pinfo(Emoji.STOP, "Target file already exists:", display_path(output, constants.CWD), style="bold red")
         raise Exit(ExitCode.TARGET_EXISTS)
 
     return output
@@ -61,6 +101,7 @@ def merge(
     output: Path,
     total: int,
     cover_file: Path | None = None,
+    group: ffmpeg.ProcessGroup | None = None,
     disable_progress: bool = False,
 ) -> None:
     pinfo(Emoji.MERGE, "Merging to audiobook")
@@ -80,70 +121,357 @@ def merge(
                     total=total,
                     description="Merging",
                 ),
+                group=group,
             )
     except Exception:
         output.unlink(missing_ok=True)
         raise
 
 
-def process(
+def merge_single_pass(
+    result: ProbeResult,
+    *,
+    durations: list[int],
+    metadata_file: Path,
+    output: Path,
+    cover_file: Path | None = None,
+    disable_progress: bool = False,
+) -> None:
+    if not result.processing_params:
+        msg = "Processing parameters cannot be unset."
+        raise RuntimeError(msg)
+
+    pinfo(Emoji.MERGE, "Transcoding and merging to audiobook in a single pass")
+    _, codec = result.processing_params
+    inputs: list[Path | str] = [f.filename for f in result]
+    metadata_idx = len(inputs)
+    args = [
+        *ffmpeg.make_concat_filter_args(durations, codec),
+        # Video is mapped explicitly for the cover, so drop the transcoding args' -vn.
+        *(arg for arg in ffmpeg.make_transcoding_args(codec) if arg != "-vn"),
+        "-map_metadata",
+        str(metadata_idx),
+        "-map_chapters",
+        str(metadata_idx),
+    ]
+    inputs.append(metadata_file)
+    if cover_file:
+        args += ["-map", f"{len(inputs)}:v", *ffmpeg.COVER_STREAM_ARGS]
+        inputs.append(cover_file)
+
+    try:
+        with Progress(transient=True, disable=disable_progress) as progress:
+            ffmpeg.convert(
+                inputs,
+                args + aioffmpeg.CONCAT_AAC_ADDED_ARGS,
+                output=output,
+                progress=TaskProgress.make(
+                    progress,
+                    total=result.approx_size,
+                    description="Merging",
+                ),
+            )
+    except Exception:
+        output.unlink(missing_ok=True)
+        raise
+
+
+def _process_with_pipes(
+    env: Environment,
+    result: ProbeResult,
+    *,
+    pipes: list[Path],
+    tmpdir: Path,
+    output: Path,
+    prefer_remux: bool,
+    cover_file: Path | None,
+) -> None:
+    # The merge consumes the intermediates from named pipes while they are being generated,
+    # so chapter marks must be known in advance. Transcoded intermediates are padded or trimmed
+    # to the probed durations of the input files, and then last for their encoded frames.
+    if not result.processing_params:
+        msg = "Processing parameters cannot be unset."
+        raise RuntimeError(msg)
+    _, codec = result.processing_params
+    params = ffmpeg.select_transcoding_params(codec)
+    durations = [f.stream.duration_ts for f in result]
+    concat_file = generate_concat_file(
+        pipes,
+        tmpdir=tmpdir,
+    )
+    metadata_file = generate_metadata(
+        result.files,
+        durations=[ffmpeg.transcoded_duration(duration_ts, params) for duration_ts in durations],
+        tmpdir=tmpdir,
+    )
+
+    # The processes feeding the pipes block until the merge reads from them, so they must not
+    # compete with other processes over the process limit, or they might wait for each other.
+    group = ffmpeg.ProcessGroup(limited=False)
+    failures: list[BaseException] = []
+
+    def _on_merge_done(future: Future[None]) -> None:
+        if exc := future.exception():
+            failures.append(exc)
+            group.kill()
+
+    try:
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="merge") as executor:
+            merging = executor.submit(
+                copy_context().run,
+                merge,
+                concat_file,
+                metadata_file=metadata_file,
+                cover_file=cover_file,
+                total=result.approx_size,
+                output=output,
+                group=group,
+                disable_progress=True,
+            )
+            merging.add_done_callback(_on_merge_done)
+            try:
+                generate_intermediates(
+                    result,
+                    tmpdir=tmpdir,
+                    prefer_remux=prefer_remux,
+                    jobs=env.jobs,
+                    fixed_durations=durations,
+                    group=group,
+                    disable_progress=env.disable_progress,
+                )
+            except BaseException:
+                group.kill()
+                raise
+    except BaseException as exc:
+        # A failed merge kills the generation, in which case the merge error is the relevant one.
+        if failures:
+            raise failures[0] from exc
+        raise
+    if failures:
+        raise failures[0]
+
+
+def _process_single_pass(
+    env: Environment,
+    result: ProbeResult,
+    *,
+    tmpdir: Path,
+    output: Path,
+    cover_file: Path | None,
+) -> None:
+    # Without intermediates, chapter marks are based on the probed durations of the
+    # input files, which the filter graph enforces when concatenating.
+    durations = [f.stream.duration_ts for f in result]
+    metadata_file = generate_metadata(
+        result.files,
+        durations=durations,
+        tmpdir=tmpdir,
+    )
+    merge_single_pass(
+        result,
+        durations=durations,
+        metadata_file=metadata_file,
+        cover_file=cover_file,
+        output=output,
+        disable_progress=env.disable_progress,
+    )
+
+
+@dataclass
+class BookJob:
+    """A book that has been analyzed and prepared for processing in its temporary directory."""
+
+    result: ProbeResult
+    output: Path
+    tmpdir: Path
+    cover_file: Path | None
+    single_pass: bool = False
+    pipes: list[Path] | None = None
+    intermediates: tuple[list[Path], list[int]] | None = None
+
+    @property
+    def output_tmp(self) -> Path:
+        return self.tmpdir / self.output.name
+
+
+def analyze_book(
     env: Environment,
     *,
     files: list[Path],
-    move_originals_to: Path | None,
     analyze_only: bool,
     prefer_remux: bool,
     no_transcode: bool,
     overwrite: bool,
-    cover: Path | None = None,
-) -> None:
-    result = probe_files(
-        files,
-        analyze_only=analyze_only,
-        no_transcode=no_transcode,
-        prefer_remux=prefer_remux,
-        disable_progress=env.debug,
-    )
+) -> tuple[ProbeResult, Path]:
+    with env.open_probe_cache() as cache, env.span("probe", inputs=files):
+        result = probe_files(
+            files,
+            analyze_only=analyze_only,
+            no_transcode=no_transcode,
+            prefer_remux=prefer_remux,
+            jobs=env.jobs,
+            cache=cache,
+            disable_progress=env.disable_progress,
+        )
     if analyze_only or not result.processing_params:
         print_probe_result(result)
         raise Exit(ExitCode.SUCCESS)
 
     output = generate_output_filename(result, prefer_remux=prefer_remux, overwrite=overwrite)
+    return result, output
+
+
+def prepare_book(
+    env: Environment,
+    result: ProbeResult,
+    *,
+    output: Path,
+    tmpdir: Path,
+    prefer_remux: bool,
+    cover: Path | None,
+) -> BookJob:
+    cover_file = cover
+    if not cover_file:
+        with env.span("cover") as span:
+            cover_file = extract_cover_img(result, tmpdir=tmpdir)
+            span.wrote(cover_file)
+
+    job = BookJob(
+        result=result,
+        output=output,
+        tmpdir=tmpdir,
+        cover_file=cover_file,
+        single_pass=env.single_pass and requires_transcode(result, prefer_remux=prefer_remux),
+    )
+    # Only transcoded intermediates are padded or trimmed to a length that the chapter marks of piped
+    # intermediates can be based on, remuxed ones are written to disk and probed. So are those of
+    # encoders whose delay is unknown.
+    if (
+        not job.single_pass
+        and env.pipe_intermediates
+        and requires_transcode(result, prefer_remux=prefer_remux)
+        and supports_pipes(result)
+    ):
+        job.pipes = make_intermediate_pipes(result, tmpdir=tmpdir)
+    return job
 
-    with env.handle_temp_storage(parent=files[0].parent) as tmpdir:
-        intermediates, durations = generate_intermediates(
-            result,
-            tmpdir=tmpdir,
+
+def encode_book(env: Environment, job: BookJob, *, prefer_remux: bool) -> None:
+    # Single-pass and named pipe processing encode while merging.
+    if job.single_pass or job.pipes:
+        return
+
+    with (
+        env.open_intermediate_cache() as cache,
+        env.span("intermediates", inputs=(f.filename for f in job.result)) as span,
+    ):
+        job.intermediates = generate_intermediates(
+            job.result,
+            tmpdir=job.tmpdir,
             prefer_remux=prefer_remux,
-            disable_progress=env.debug,
+            jobs=env.jobs,
+            cache=cache,
+            disable_progress=env.disable_progress,
         )
+        span.wrote(*job.intermediates[0])
+
+
+def merge_book(env: Environment, job: BookJob, *, prefer_remux: bool) -> None:
+    if job.single_pass:
+        with env.span("single-pass merge", inputs=(f.filename for f in job.result)) as span:
+            _process_single_pass(env, job.result, tmpdir=job.tmpdir, output=job.output_tmp, cover_file=job.cover_file)
+            span.wrote(job.output_tmp)
+        return
+
+    if job.pipes:
+        with env.span("piped merge", inputs=(f.filename for f in job.result)) as span:
+            _process_with_pipes(
+                env,
+                job.result,
+                pipes=job.pipes,
+                tmpdir=job.tmpdir,
+                output=job.output_tmp,
+                prefer_remux=prefer_remux,
+                cover_file=job.cover_file,
+            )
+            span.wrote(job.output_tmp)
+        return
+
+    if not job.intermediates:
+        msg = "Intermediates must be generated before merging."
+        raise RuntimeError(msg)
+
+    intermediates, durations = job.intermediates
+    with env.span("metadata") as span:
         concat_file = generate_concat_file(
             intermediates,
-            tmpdir=tmpdir,
+            tmpdir=job.tmpdir,
         )
         metadata_file = generate_metadata(
-            result.files,
+            job.result.files,
             durations=durations,
-            tmpdir=tmpdir,
-        )
-        cover_file = cover or extract_cover_img(
-            result,
-            tmpdir=tmpdir,
+            tmpdir=job.tmpdir,
         )
+        span.wrote(concat_file, metadata_file)
 
-        output_tmp = tmpdir / output.name
+    merge_inputs = [*intermediates, job.cover_file] if job.cover_file else intermediates
+    with env.span("merge", inputs=merge_inputs) as span:
         merge(
             concat_file,
             metadata_file=metadata_file,
-            cover_file=cover_file,
-            total=result.approx_size,
-            output=output_tmp,
-            disable_progress=env.debug,
+            cover_file=job.cover_file,
+            total=job.result.approx_size,
+            output=job.output_tmp,
+            disable_progress=env.disable_progress,
         )
-        output_tmp.rename(output)
+        span.wrote(job.output_tmp)
+
+
+def finalize_book(env: Environment, job: BookJob, *, move_originals_to: Path | None) -> Path:
+    output = job.output
+    with env.span("finalize"):
+        move_output(job.output_tmp, output)
+        metrics.bytes_read.inc(amount=total_size(f.filename for f in job.result))
+        metrics.bytes_written.inc(amount=total_size([output]))
+
+        # copy_mtime(result.first.filename, output)
+        pinfo(Emoji.SAVE, f'Saved to "{display_path(output, env.cwd)}"\n', style="bold green")
+
+        if move_originals_to:
+            move_files(
+                job.result,
+                target_path=move_originals_to,
+                subdir=output.stem,
+                disable_progress=env.disable_progress,
+            )
+
+    return output
 
-    # copy_mtime(result.first.filename, output)
-    pinfo(Emoji.SAVE, f'Saved to "{output.relative_to(env.cwd)}"\n', style="bold green")
 
-    if move_originals_to:
-        move_files(result, target_path=move_originals_to, subdir=output.stem)
+def process(
+    env: Environment,
+    *,
+    files: list[Path],
+    move_originals_to: Path | None,
+    analyze_only: bool,
+    prefer_remux: bool,
+    no_transcode: bool,
+    overwrite: bool,
+    cover: Path | None = None,
+) -> Path:
+    result, output = analyze_book(
+        env,
+        files=files,
+        analyze_only=analyze_only,
+        prefer_remux=prefer_remux,
+        no_transcode=no_transcode,
+        overwrite=overwrite,
+    )
+    with env.handle_temp_storage(
+        parent=files[0].parent,
+        required=estimate_scratch_space(env, result, prefer_remux=prefer_remux),
+    ) as tmpdir:
+        job = prepare_book(env, result, output=output, tmpdir=tmpdir, prefer_remux=prefer_remux, cover=cover)
+        encode_book(env, job, prefer_remux=prefer_remux)
+        merge_book(env, job, prefer_remux=prefer_remux)
+        return finalize_book(env, job, move_originals_to=move_originals_to)
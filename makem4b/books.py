@@ -0,0 +1,374 @@
+from __future__ import annotations
+
+import threading
+from collections import Counter
+from concurrent.futures import CancelledError
+from contextlib import AbstractContextManager, ExitStack, nullcontext
+from dataclasses import dataclass, field
+from enum import StrEnum
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from click.exceptions import Exit
+from loguru import logger
+from rich import box
+from rich.table import Table
+
+from makem4b import metrics
+from makem4b.base import (
+    analyze_book,
+    encode_book,
+    estimate_scratch_space,
+    finalize_book,
+    merge_book,
+    prepare_book,
+)
+from makem4b.discovery import discover_books
+from makem4b.emoji import Emoji
+from makem4b.library import IndexedBook, fingerprint_inputs
+from makem4b.pipeline import Stage
+from makem4b.types import ExitCode
+from makem4b.utils import OutputBuffer, current_console, pinfo
+
+if TYPE_CHECKING:
+    import os
+    import re
+
+    from makem4b.base import BookJob
+    from makem4b.cli.env import Environment
+    from makem4b.discovery import BookDirectory
+    from makem4b.library import LibraryIndex
+    from makem4b.pipeline import Pipeline, StageStats
+    from makem4b.watching import PendingDirectories
+
+
+class BookStatus(StrEnum):
+    PROCESSED = "processed"
+    SKIPPED = "skipped"
+    FAILED = "failed"
+
+
+@dataclass
+class BookTask:
+    dirpath: Path
+    files: list[Path]
+    cover: Path | None
+    overwrite: bool
+    indexed: IndexedBook
+    output: OutputBuffer = field(default_factory=OutputBuffer)
+    cleanup: ExitStack = field(default_factory=ExitStack)
+    job: BookJob | None = None
+
+    @property
+    def prepared_job(self) -> BookJob:
+        if not self.job:
+            msg = "Book must be prepared before processing."
+            raise RuntimeError(msg)
+        return self.job
+
+
+@dataclass
+class BookStages:
+    """Processing stages of the books in a recursive run, and the tally of their outcomes.
+
+    With more than one book at a time, the stages of books overlap, and the output of each book is
+    buffered until it has finished. A single book passes all stages at once and prints its output,
+    including progress bars, right away.
+    """
+
+    env: Environment
+    index: LibraryIndex | None
+    move_originals_to: Path | None
+    analyze_only: bool
+    prefer_remux: bool
+    no_transcode: bool
+    books: int = 1
+    statuses: Counter[BookStatus] = field(default_factory=Counter)
+    failed: list[Path] = field(default_factory=list)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def pipeline_stages(self) -> list[Stage[BookTask]]:
+        if self.books == 1:
+            return [Stage("process", self.process)]
+        return [
+            Stage("analyze", self.analyze),
+            Stage("encode", self.encode, workers=self.books),
+            Stage("merge", self.merge, workers=self.books),
+            Stage("finalize", self.finalize),
+        ]
+
+    def _capture(self, task: BookTask) -> AbstractContextManager[object]:
+        return task.output.capture() if self.books > 1 else nullcontext()
+
+    def process(self, task: BookTask) -> bool:
+        return self.analyze(task) and self.encode(task) and self.merge(task) and self.finalize(task)
+
+    def analyze(self, task: BookTask) -> bool:
+        env = self.env
+        with self._capture(task):
+            pinfo(Emoji.INFO, f"Processing {task.dirpath.relative_to(env.cwd)}")
+            result, output = analyze_book(
+                env,
+                files=task.files,
+                analyze_only=self.analyze_only,
+                prefer_remux=self.prefer_remux,
+                no_transcode=self.no_transcode,
+                overwrite=task.overwrite,
+            )
+            tmpdir = task.cleanup.enter_context(
+                env.handle_temp_storage(
+                    parent=task.dirpath,
+                    required=estimate_scratch_space(env, result, prefer_remux=self.prefer_remux),
+                )
+            )
+            task.job = prepare_book(
+                env,
+                result,
+                output=output,
+                tmpdir=tmpdir,
+                prefer_remux=self.prefer_remux,
+                cover=task.cover,
+            )
+        return True
+
+    def encode(self, task: BookTask) -> bool:
+        with self._capture(task):
+            encode_book(self.env, task.prepared_job, prefer_remux=self.prefer_remux)
+        return True
+
+    def merge(self, task: BookTask) -> bool:
+        with self._capture(task):
+            merge_book(self.env, task.prepared_job, prefer_remux=self.prefer_remux)
+        return True
+
+    def finalize(self, task: BookTask) -> bool:
+        with self._capture(task):
+            output = finalize_book(self.env, task.prepared_job, move_originals_to=self.move_originals_to)
+            if self.index:
+                self.index.set(task.dirpath, task.indexed._replace(output=str(output)))
+        return True
+
+    def finish(self, task: BookTask, exc: BaseException | None) -> None:
+        metrics.books_in_progress.dec()
+        with self._capture(task):
+            try:
+                task.cleanup.close()
+            except Exception as cleanup_exc:  # noqa: BLE001
+                exc = exc or cleanup_exc
+            status = self._report(task, exc)
+        task.output.flush()
+        self.count(status, task.dirpath)
+
+    def count(self, status: BookStatus, dirpath: Path) -> None:
+        metrics.books.inc(status)
+        with self._lock:
+            self.statuses[status] += 1
+            if status == BookStatus.FAILED:
+                self.failed.append(dirpath)
+
+    def _report(self, task: BookTask, exc: BaseException | None) -> BookStatus:
+        if not exc:
+            return BookStatus.PROCESSED
+        if isinstance(exc, Exit):
+            if exc.exit_code == ExitCode.SUCCESS:
+                return BookStatus.PROCESSED
+            metrics.book_errors.inc(ExitCode(exc.exit_code).name if exc.exit_code in ExitCode else str(exc.exit_code))
+            return BookStatus.SKIPPED
+        if isinstance(exc, CancelledError):
+            return BookStatus.SKIPPED
+
+        metrics.book_errors.inc(ExitCode.GENERIC_ERROR.name)
+        logger.opt(exception=exc).debug("Processing {} failed", task.dirpath)
+        pinfo(Emoji.STOP, f"Failed to process {task.dirpath.relative_to(self.env.cwd)}: {exc}\n", style="bold red")
+        return BookStatus.FAILED
+
+
+def make_task(
+    candidate: BookDirectory,
+    *,
+    index: LibraryIndex | None,
+    relpath: Path,
+    settings: str,
+    overwrite: bool,
+    reprocess_changed: bool,
+) -> BookTask | None:
+    # The output of a previous run has the suffix of its inputs if they were remuxed, it must
+    # neither count as an input nor change the fingerprint of the directory.
+    previous = index.get(candidate.path) if index else None
+    output = Path(previous.output) if previous and previous.output else None
+    if not (seen_entries := check_matches(candidate, relpath=relpath, output=output)):
+        return None
+
+    indexed = IndexedBook(
+        inputs=fingerprint_inputs([*seen_entries, *filter(None, [candidate.cover])]),
+        output="",
+        settings=settings,
+    )
+    book_overwrite = check_index(
+        index,
+        candidate.path,
+        indexed,
+        relpath=relpath,
+        overwrite=overwrite,
+        reprocess_changed=reprocess_changed,
+    )
+    if book_overwrite is None:
+        return None
+
+    return BookTask(
+        dirpath=candidate.path,
+        files=[Path(entry.path) for entry in seen_entries],
+        cover=Path(candidate.cover.path) if candidate.cover else None,
+        overwrite=book_overwrite,
+        indexed=indexed,
+    )
+
+
+def check_matches(
+    candidate: BookDirectory,
+    *,
+    relpath: Path,
+    output: Path | None = None,
+) -> list[os.DirEntry[str]] | None:
+    """Return the input files of a directory, leaving out output, or None to skip it."""
+    matches = candidate.matches
+    if output:
+        matches = {
+            suffix: kept
+            for suffix, entries in matches.items()
+            if (kept := [entry for entry in entries if not _is_output(entry, output)])
+        }
+    seen_types = list(matches.keys())
+    if (type_cnt := len(seen_types)) > 1:
+        pinfo(
+            Emoji.STOP,
+            f"Skipping directory, multiple filetypes ({type_cnt}): {relpath}",
+        )
+        return None
+
+    seen_entries = matches[seen_types[0]] if seen_types else []
+    if len(seen_entries) < 2:
+        pinfo(
+            Emoji.STOP,
+            f"Skipping directory, fewer than 2 matching files: {relpath}",
+        )
+        return None
+    return seen_entries
+
+
+def _is_output(entry: os.DirEntry[str], output: Path) -> bool:
+    return entry.name == output.name and Path(entry.path).resolve() == output
+
+
+def check_index(
+    index: LibraryIndex | None,
+    dirpath: Path,
+    book: IndexedBook,
+    *,
+    relpath: Path,
+    overwrite: bool,
+    reprocess_changed: bool,
+) -> bool | None:
+    """Check a directory against its indexed state, returning whether to overwrite its output, or None to skip it."""
+    if overwrite or not index or not (indexed := index.get(dirpath)) or not Path(indexed.output).is_file():
+        return overwrite
+
+    if (indexed.inputs, indexed.settings) == (book.inputs, book.settings):
+        pinfo(Emoji.STOP, f"Skipping directory, unchanged since it was processed: {relpath}")
+        return None
+
+    if not reprocess_changed:
+        pinfo(
+            Emoji.STOP,
+            f"Skipping directory, changed since it was processed (see `--reprocess-changed`): {relpath}",
+        )
+        return None
+
+    return True
+
+
+def print_summary(statuses: Counter[BookStatus], *, failed: list[Path], env: Environment) -> None:
+    pinfo(
+        Emoji.INFO,
+        ", ".join(f"{statuses[status]} {status}" for status in BookStatus),
+        style="bold",
+    )
+    for dirpath in sorted(failed):
+        pinfo(Emoji.STOP, f"Failed: {dirpath.relative_to(env.cwd)}", style="red")
+
+
+def print_pipeline_stats(stats: list[StageStats], *, elapsed: float) -> None:
+    table = Table(box=box.SIMPLE)
+    table.add_column("Stage")
+    table.add_column("Workers", justify="right")
+    table.add_column("Books", justify="right")
+    table.add_column("Utilization", justify="right")
+    table.add_column("Blocked", justify="right")
+    table.add_column("Mean Queue", justify="right")
+    table.add_column("Max Queue", justify="right")
+    for stage in stats:
+        table.add_row(
+            stage.name,
+            str(stage.workers),
+            str(stage.items),
+            f"{stage.utilization(elapsed):.0%}",
+            f"{stage.blocked:.1f} s",
+            f"{stage.mean_depth:.1f}",
+            str(stage.max_depth),
+        )
+    current_console().print(table)
+
+
+@dataclass
+class BookQueue:
+    """Queue settled directories into the pipeline, holding back those of books still being processed."""
+
+    directory: Path
+    stages: BookStages
+    index: LibraryIndex | None
+    suffixes: list[str]
+    cover_regex: re.Pattern[str]
+    settings: str
+    overwrite: bool
+    reprocess_changed: bool
+    pending: PendingDirectories
+    pipeline: Pipeline[BookTask] | None = None
+    _active: set[Path] = field(default_factory=set)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def put(self, dirpath: Path) -> None:
+        if not self.pipeline:
+            msg = "Pipeline must be started before queueing books."
+            raise RuntimeError(msg)
+
+        with self._lock:
+            if dirpath in self._active:
+                # Check the directory again once the book has been processed.
+                self.pending.touch([dirpath])
+                return
+
+        candidate = next(
+            discover_books(dirpath, suffixes=self.suffixes, cover_regex=self.cover_regex, recursive=False),
+            None,
+        )
+        if not candidate or not (
+            task := make_task(
+                candidate,
+                index=self.index,
+                relpath=dirpath.relative_to(self.directory),
+                settings=self.settings,
+                overwrite=self.overwrite,
+                reprocess_changed=self.reprocess_changed,
+            )
+        ):
+            return
+
+        with self._lock:
+            self._active.add(dirpath)
+        metrics.books_in_progress.inc()
+        self.pipeline.put(task)
+
+    def finish(self, task: BookTask, exc: BaseException | None) -> None:
+        self.stages.finish(task, exc)
+        with self._lock:
+            self._active.discard(task.dirpath)
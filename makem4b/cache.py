@@ -0,0 +1,306 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from contextlib import suppress
+from typing import TYPE_CHECKING, Any, Self
+
+from loguru import logger
+
+from makem4b import constants
+
+if TYPE_CHECKING:
+    from pathlib import Path
+    from types import TracebackType
+
+PROBE_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS probes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    accessed REAL NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS probes_accessed ON probes (accessed);
+"""
+
+
+def _connect(db_file: Path, schema: str) -> sqlite3.Connection:
+    """Open a database shared between threads and processes, waiting for the writes of others."""
+    conn = sqlite3.connect(db_file, timeout=constants.CACHE_BUSY_TIMEOUT, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(schema)
+    return conn
+
+
+class ProbeCache:
+    """Persistent store of probe outputs, keyed by absolute path, size, mtime, and the version of the probes.
+
+    The cache is safe to share between the threads probing files, and between processes: it uses
+    write-ahead logging, and writes are collected in a transaction that is committed after each batch
+    of probes. Errors of the database are logged and treated as cache misses, they never fail a book.
+    """
+
+    def __init__(self, db_file: Path, *, max_size: int = constants.PROBE_CACHE_MAX_SIZE) -> None:
+        db_file.parent.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._conn = _connect(db_file, PROBE_CACHE_SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(probes)")}
+        if "version" not in columns:
+            # Caches written before probes were versioned, their entries are all outdated. Another process
+            # may add the column first.
+            with suppress(sqlite3.OperationalError):
+                self._conn.execute("ALTER TABLE probes ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        self._accessed: list[tuple[float, str]] = []
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    @staticmethod
+    def _key(file: Path) -> tuple[str, int, int]:
+        stat = file.stat()
+        return str(file.absolute()), stat.st_size, stat.st_mtime_ns
+
+    def get(self, file: Path) -> str | None:
+        """Return the cached output for file as JSON, which FFProbeOutput validates without parsing it first."""
+        path, size, mtime_ns = self._key(file)
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    "SELECT data FROM probes WHERE path = ? AND size = ? AND mtime_ns = ? AND version = ?",
+                    (path, size, mtime_ns, constants.PROBE_CACHE_VERSION),
+                ).fetchone()
+            except sqlite3.Error as exc:
+                logger.warning("Failed to read probe cache, probing {}: {}", path, exc)
+                return None
+            if not row:
+                return None
+            self._accessed.append((time.time(), path))
+        logger.debug("Probe cache hit: {}", path)
+        return row[0]
+
+    def set(self, file: Path, output: dict[str, Any]) -> None:
+        path, size, mtime_ns = self._key(file)
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO probes (path, size, mtime_ns, data, accessed, version)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        path,
+                        size,
+                        mtime_ns,
+                        json.dumps(output, separators=(",", ":")),
+                        time.time(),
+                        constants.PROBE_CACHE_VERSION,
+                    ),
+                )
+            except sqlite3.Error as exc:
+                logger.warning("Failed to cache probe of {}: {}", path, exc)
+
+    def evict(self) -> None:
+        """Drop the least recently used entries until the stored data fits into max_size."""
+        with self._lock:
+            (total,) = self._conn.execute("SELECT COALESCE(SUM(LENGTH(data)), 0) FROM probes").fetchone()
+            if total <= self.max_size:
+                return
+            self._conn.execute(
+                """
+                DELETE FROM probes WHERE path IN (
+                    SELECT path FROM (
+                        SELECT path, SUM(LENGTH(data)) OVER (ORDER BY accessed DESC) AS running FROM probes
+                    ) WHERE running > ?
+                )
+                """,
+                (self.max_size,),
+            )
+            self._conn.commit()
+            logger.debug("Evicted probe cache entries exceeding {} bytes", self.max_size)
+
+    def commit(self) -> None:
+        """Commit the probes and accesses since the last commit, ending the write transaction."""
+        with self._lock:
+            accessed, self._accessed = self._accessed, []
+            try:
+                self._conn.executemany("UPDATE probes SET accessed = ? WHERE path = ?", accessed)
+                self._conn.commit()
+            except sqlite3.Error as exc:
+                logger.warning("Failed to commit probe cache: {}", exc)
+                self._conn.rollback()
+
+    def close(self) -> None:
+        self.commit()
+        try:
+            self.evict()
+        except sqlite3.Error as exc:
+            logger.warning("Failed to evict probe cache entries: {}", exc)
+        with self._lock:
+            self._conn.close()
+
+
+INTERMEDIATE_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS intermediates (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    duration_ts INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS intermediates_accessed ON intermediates (accessed);
+"""
+
+
+def _link(source: Path, target: Path) -> None:
+    target.unlink(missing_ok=True)
+    target.hardlink_to(source)
+
+
+class IntermediateCache:
+    """Persistent store of intermediate files, keyed by the identity of their input file and the FFmpeg args.
+
+    Inputs are identified by absolute path, size, and mtime. Intermediates are hard linked into and out
+    of the cache directory, those written to another filesystem are not cached, as copying them would
+    cost more than it saves. Entries are committed right away, so that
+    the intermediates finished before a failure or an interruption are reused by the next run. The least
+    recently used entries are evicted once the cached files exceed max_size. Like the ProbeCache, it is
+    shared between processes, and errors of the database are logged and treated as cache misses.
+    """
+
+    def __init__(self, directory: Path, *, max_size: int = constants.INTERMEDIATE_CACHE_MAX_SIZE) -> None:
+        directory.mkdir(parents=True, exist_ok=True)
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._conn = _connect(directory / constants.INTERMEDIATE_CACHE_FILE, INTERMEDIATE_CACHE_SCHEMA)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    @staticmethod
+    def _key(file: Path, args: list[str]) -> str:
+        stat = file.stat()
+        identity = [str(file.absolute()), stat.st_size, stat.st_mtime_ns, args]
+        return hashlib.sha256(json.dumps(identity, separators=(",", ":")).encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.ts"
+
+    def _can_link(self, output: Path) -> bool:
+        try:
+            return output.parent.stat().st_dev == self.directory.stat().st_dev
+        except OSError:
+            return False
+
+    def _write(self, sql: str, params: tuple[Any, ...]) -> bool:
+        with self._lock:
+            try:
+                self._conn.execute(sql, params)
+                self._conn.commit()
+            except sqlite3.Error as exc:
+                logger.warning("Failed to write intermediate cache: {}", exc)
+                self._conn.rollback()
+                return False
+        return True
+
+    def get(self, file: Path, args: list[str], *, output: Path) -> int | None:
+        """Place the cached intermediate of file at output, returning its duration, or None if not cached.
+
+        Output may be hard linked to the cached file, it must be unlinked rather than written to.
+        """
+        if not self._can_link(output):
+            return None
+        key = self._key(file, args)
+        with self._lock:
+            try:
+                row = self._conn.execute("SELECT duration_ts FROM intermediates WHERE key = ?", (key,)).fetchone()
+            except sqlite3.Error as exc:
+                logger.warning("Failed to read intermediate cache, generating {}: {}", file, exc)
+                return None
+        if not row:
+            return None
+
+        try:
+            _link(self._path(key), output)
+        except OSError as exc:
+            logger.debug("Dropping unusable intermediate cache entry for {}: {}", file, exc)
+            self._write("DELETE FROM intermediates WHERE key = ?", (key,))
+            return None
+
+        self._write("UPDATE intermediates SET accessed = ? WHERE key = ?", (time.time(), key))
+        logger.debug("Intermediate cache hit: {}", file)
+        return row[0]
+
+    def set(self, file: Path, args: list[str], *, output: Path, duration_ts: int) -> None:
+        if not self._can_link(output):
+            logger.debug("Not caching intermediate of {}, it is on another filesystem than the cache", file)
+            return
+        key = self._key(file, args)
+        cached = self._path(key)
+        partial = cached.with_suffix(".part")
+        try:
+            _link(output, partial)
+            partial.replace(cached)
+        except OSError as exc:
+            partial.unlink(missing_ok=True)
+            logger.warning("Failed to cache intermediate of {}: {}", file, exc)
+            return
+
+        if not self._write(
+            "INSERT OR REPLACE INTO intermediates (key, size, duration_ts, accessed) VALUES (?, ?, ?, ?)",
+            (key, cached.stat().st_size, duration_ts, time.time()),
+        ):
+            cached.unlink(missing_ok=True)
+            return
+        self.evict()
+
+    def evict(self) -> None:
+        """Drop the least recently used entries until the cached files fit into max_size."""
+        with self._lock:
+            try:
+                evicted = [
+                    key
+                    for (key,) in self._conn.execute(
+                        """
+                        SELECT key FROM (
+                            SELECT key, SUM(size) OVER (ORDER BY accessed DESC) AS running FROM intermediates
+                        ) WHERE running > ?
+                        """,
+                        (self.max_size,),
+                    )
+                ]
+                if not evicted:
+                    return
+                self._conn.executemany("DELETE FROM intermediates WHERE key = ?", [(key,) for key in evicted])
+                self._conn.commit()
+            except sqlite3.Error as exc:
+                logger.warning("Failed to evict intermediate cache entries: {}", exc)
+                self._conn.rollback()
+                return
+
+        for key in evicted:
+            self._path(key).unlink(missing_ok=True)
+        logger.debug("Evicted {} intermediate cache entries exceeding {} bytes", len(evicted), self.max_size)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
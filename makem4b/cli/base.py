@@ -1,6 +1,8 @@
 from __future__ import annotations
 
 import pkgutil
+from functools import cache, partial
+from pathlib import Path
 from typing import TYPE_CHECKING
 
 import rich_click as click
@@ -9,6 +11,7 @@ from loguru import logger
 from makem4b import commands, constants
 from makem4b.cli import options
 from makem4b.cli.decorators import pass_ctx_and_env
+from makem4b.timings import Timings
 
 if TYPE_CHECKING:
     from makem4b.cli.env import Environment
@@ -26,9 +29,22 @@ help_config = click.RichHelpConfiguration(
                 "name": "Common processing options",
                 "options": options.PROCESSING_OPTION_NAMES,
             },
+            {
+                "name": "Performance options",
+                "options": [
+                    "-j",
+                    "--io-jobs",
+                    "--single-pass",
+                    "--pipe-intermediates",
+                    "--no-probe-cache",
+                    "--intermediate-cache-size",
+                    "--cache-dir",
+                    "--scratch-dir",
+                ],
+            },
             {
                 "name": "Debugging options",
-                "options": ["-k", "-D"],
+                "options": ["-k", "-D", "--timings", "--timings-json"],
             },
             {
                 "name": "Misc options",
@@ -41,9 +57,27 @@ help_config = click.RichHelpConfiguration(
 )
 
 
+def report_timings(timings: Timings, *, show: bool, json_file: Path | None) -> None:
+    if show:
+        timings.print_table()
+    if json_file:
+        timings.write_json(json_file)
+
+
+@cache
+def command_names() -> tuple[str, ...]:
+    return tuple(sorted(mod.name for mod in pkgutil.iter_modules(commands.__path__) if mod.name != "base"))
+
+
 class NamedCommandsCli(click.RichGroup):
+    """Group of the commands found in the commands package.
+
+    All command modules are imported to list them in the help, so they import the modules doing the
+    actual processing (models, FFmpeg, rich's progress and tables) only once their command is run.
+    """
+
     def list_commands(self, ctx: click.Context) -> list[str]:
-        return sorted(mod.name for mod in pkgutil.iter_modules(commands.__path__) if mod.name != "base")
+        return list(command_names())
 
     def get_command(self, ctx: click.Context, name: str) -> click.RichCommand:
         return __import__(f"makem4b.commands.{name}", None, None, ["cli"]).cli
@@ -64,6 +98,120 @@ class NamedCommandsCli(click.RichGroup):
     is_flag=True,
     show_envvar=True,
 )
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=None,
+    show_envvar=True,
+    help="""
+        Number of CPU cores to keep busy with FFmpeg processes. Transcodes are given threads
+        within this budget. Defaults to the number of CPUs.
+    """,
+)
+@click.option(
+    "--io-jobs",
+    type=click.IntRange(min=1),
+    default=2,
+    show_envvar=True,
+    show_default=True,
+    help="""
+        Number of disk-heavy FFmpeg processes (remuxing to intermediates, merging) to run at the same
+        time, independently of the transcodes taking up CPU cores.
+    """,
+)
+@click.option(
+    "--single-pass",
+    type=bool,
+    is_flag=True,
+    show_envvar=True,
+    help="""
+        When transcoding is required, decode, concatenate, and encode all input files in a
+        single FFmpeg run instead of writing intermediate files to disk first. Chapter marks
+        are based on the probed durations of the input files, which are padded or trimmed
+        to match them exactly.
+    """,
+)
+@click.option(
+    "--pipe-intermediates",
+    type=bool,
+    is_flag=True,
+    show_envvar=True,
+    help="""
+        Stream transcoded intermediate files to the final merge through named pipes instead of
+        writing them to disk. Falls back to intermediate files where named pipes are not supported,
+        and with the libfdk-aac encoder, whose delay is unknown. Chapter marks are based on the probed
+        durations of the input files, which the transcoded audio is padded or trimmed to. Remuxed
+        intermediates are always written to disk.
+    """,
+)
+@click.option(
+    "--no-probe-cache",
+    type=bool,
+    is_flag=True,
+    show_envvar=True,
+    help="""Probe all files again instead of reusing the results of previous runs.""",
+)
+@click.option(
+    "--intermediate-cache-size",
+    type=click.IntRange(min=0),
+    default=constants.INTERMEDIATE_CACHE_MAX_SIZE // 1_000_000,
+    show_envvar=True,
+    show_default=True,
+    help="""
+        Megabytes of intermediate files to keep in the cache directory, so that subsequent runs on the
+        same input files, e.g. after a failed merge, reuse them instead of transcoding again. The least
+        recently used ones are removed first. Intermediates are hard linked, they are only cached if they
+        are written to the filesystem of the cache directory. Pass 0 to disable the cache.
+    """,
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(
+        file_okay=False,
+        writable=True,
+        resolve_path=True,
+        path_type=Path,
+    ),
+    default=None,
+    show_envvar=True,
+    help="""Directory to keep persistent caches in. Defaults to the user's cache directory.""",
+)
+@click.option(
+    "--scratch-dir",
+    type=click.Path(
+        file_okay=False,
+        writable=True,
+        resolve_path=True,
+        path_type=Path,
+    ),
+    default=None,
+    show_envvar=True,
+    help="""
+        Directory to write intermediates and the unfinished output to, e.g. on a fast local disk or
+        tmpfs. Defaults to a `.makem4b` directory next to the input files. Books are only started once
+        their estimated temporary space is free there.
+    """,
+)
+@click.option(
+    "--timings",
+    type=bool,
+    is_flag=True,
+    show_envvar=True,
+    help="""Print how much time, FFmpeg CPU time, and I/O each processing step took.""",
+)
+@click.option(
+    "--timings-json",
+    type=click.Path(
+        dir_okay=False,
+        writable=True,
+        resolve_path=True,
+        path_type=Path,
+    ),
+    default=None,
+    show_envvar=True,
+    help="""Write the timings of the processing steps to a JSON file.""",
+)
 @click.option(
     "-D",
     "--debug",
@@ -78,6 +226,16 @@ def main(
     *,
     debug: bool,
     keep_intermediates: bool,
+    jobs: int | None,
+    io_jobs: int,
+    single_pass: bool,
+    pipe_intermediates: bool,
+    no_probe_cache: bool,
+    intermediate_cache_size: int,
+    cache_dir: Path | None,
+    scratch_dir: Path | None,
+    timings: bool,
+    timings_json: Path | None,
 ) -> None:
     """Merge multiple audio files into an audiobook.
 
@@ -115,6 +273,23 @@ def main(
     """
     env.debug = debug
     env.keep_intermediates = keep_intermediates
+    if jobs:
+        env.jobs = jobs
+    env.io_jobs = io_jobs
+    env.single_pass = single_pass
+    env.pipe_intermediates = pipe_intermediates
+    env.probe_cache = not no_probe_cache
+    env.intermediate_cache_size = intermediate_cache_size * 1_000_000
+    if cache_dir:
+        env.cache_dir = cache_dir
+    env.scratch_dir = scratch_dir
+    if timings or timings_json:
+        env.timings = Timings()
+        ctx.call_on_close(partial(report_timings, env.timings, show=timings, json_file=timings_json))
+
+    from makem4b import ffmpeg
+
+    ctx.with_resource(ffmpeg.scheduler.budget(cpu=env.jobs, io=env.io_jobs))
 
     if debug:
         logger.enable("makem4b")
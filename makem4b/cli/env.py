@@ -1,14 +1,24 @@
 from __future__ import annotations
 
+import os
+import sqlite3
+import time
 from contextlib import contextmanager
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import TYPE_CHECKING
 
-from makem4b.utils import make_tempdir
+from loguru import logger
+
+from makem4b import constants, metrics
+from makem4b.cache import IntermediateCache, ProbeCache
+from makem4b.library import LibraryIndex
+from makem4b.scratch import scratch_space
+from makem4b.timings import Span, Timings
+from makem4b.utils import current_progress_tracker, is_output_buffered, make_tempdir, remove_tempdir, user_cache_dir
 
 if TYPE_CHECKING:
-    from collections.abc import Generator
+    from collections.abc import Generator, Iterable
 
 
 @dataclass
@@ -18,14 +28,114 @@ class Environment:
 
     debug: bool = False
     keep_intermediates: bool = False
+    jobs: int = field(default_factory=lambda: os.cpu_count() or 1)
+    io_jobs: int = 2
+    probe_cache: bool = True
+    cache_dir: Path = field(default_factory=user_cache_dir)
+    scratch_dir: Path | None = None
+    intermediate_cache_size: int = constants.INTERMEDIATE_CACHE_MAX_SIZE
+    single_pass: bool = False
+    pipe_intermediates: bool = False
+    library_index: bool = True
+    timings: Timings | None = None
+
+    _active_probe_cache: ProbeCache | None = field(default=None, init=False, repr=False)
+    _active_intermediate_cache: IntermediateCache | None = field(default=None, init=False, repr=False)
+
+    @property
+    def disable_progress(self) -> bool:
+        # Live progress displays cannot be rendered into buffered output.
+        return self.debug or is_output_buffered()
 
     @contextmanager
-    def handle_temp_storage(self, *, parent: Path) -> Generator[Path, None, None]:
-        tempdir = make_tempdir(parent)
+    def handle_temp_storage(self, *, parent: Path, required: int = 0) -> Generator[Path, None, None]:
+        """Create the temporary directory of a book, once the required space is free on its filesystem."""
+        tempdir = make_tempdir(parent, scratch_dir=self.scratch_dir)
         try:
-            yield tempdir
+            with scratch_space.reserve(tempdir, required):
+                yield tempdir
         finally:
             if not self.keep_intermediates:
-                for file in tempdir.iterdir():
-                    file.unlink(missing_ok=True)
-                tempdir.rmdir()
+                remove_tempdir(tempdir)
+
+    @contextmanager
+    def span(self, name: str, *, inputs: Iterable[Path] = ()) -> Generator[Span, None, None]:
+        """Record the duration of a processing step in the metrics, and its timings, if enabled."""
+        if tracker := current_progress_tracker():
+            tracker.step = name
+        started = time.perf_counter()
+        try:
+            if not self.timings:
+                yield Span()
+                return
+            with self.timings.span(name, inputs=inputs) as span:
+                yield span
+        finally:
+            metrics.step_duration.observe(time.perf_counter() - started, name)
+
+    @contextmanager
+    def open_probe_cache(self) -> Generator[ProbeCache | None, None, None]:
+        """Open the probe cache, or reuse the one already opened for concurrently processed books."""
+        if not self.probe_cache:
+            yield None
+            return
+        if self._active_probe_cache:
+            yield self._active_probe_cache
+            return
+
+        try:
+            cache = ProbeCache(self.cache_dir / constants.PROBE_CACHE_FILE)
+        except (OSError, sqlite3.Error) as exc:
+            logger.warning("Probe cache unavailable, continuing without: {}", exc)
+            yield None
+            return
+
+        with cache:
+            self._active_probe_cache = cache
+            try:
+                yield cache
+            finally:
+                self._active_probe_cache = None
+
+    @contextmanager
+    def open_intermediate_cache(self) -> Generator[IntermediateCache | None, None, None]:
+        """Open the intermediate cache, or reuse the one already opened for concurrently processed books."""
+        if not self.intermediate_cache_size:
+            yield None
+            return
+        if self._active_intermediate_cache:
+            yield self._active_intermediate_cache
+            return
+
+        try:
+            cache = IntermediateCache(
+                self.cache_dir / constants.INTERMEDIATE_CACHE_DIR,
+                max_size=self.intermediate_cache_size,
+            )
+        except (OSError, sqlite3.Error) as exc:
+            logger.warning("Intermediate cache unavailable, continuing without: {}", exc)
+            yield None
+            return
+
+        with cache:
+            self._active_intermediate_cache = cache
+            try:
+                yield cache
+            finally:
+                self._active_intermediate_cache = None
+
+    @contextmanager
+    def open_library_index(self) -> Generator[LibraryIndex | None, None, None]:
+        if not self.library_index:
+            yield None
+            return
+
+        try:
+            index = LibraryIndex(self.cache_dir / constants.LIBRARY_INDEX_FILE)
+        except (OSError, sqlite3.Error) as exc:
+            logger.warning("Library index unavailable, continuing without: {}", exc)
+            yield None
+            return
+
+        with index:
+            yield index
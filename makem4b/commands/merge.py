@@ -6,10 +6,8 @@ from typing import TYPE_CHECKING
 import rich_click as click
 from click.exceptions import Exit
 
-from makem4b.base import process
 from makem4b.cli.decorators import add_processing_options, pass_ctx_and_env
 from makem4b.emoji import Emoji
-from makem4b.types import ExitCode
 from makem4b.utils import pinfo
 
 if TYPE_CHECKING:
@@ -56,6 +54,9 @@ def cli(
     cover: Path | None,
 ) -> None:
     """Merge multiple audio files into an audiobook."""
+    from makem4b.base import process
+    from makem4b.types import ExitCode
+
     if not files:
         pinfo(Emoji.NO_FILES, "No files given.", style="bold yellow")
         click.echo(ctx.command.get_help(ctx))
@@ -1,20 +1,19 @@
 from __future__ import annotations
 
-import re
-from collections import defaultdict
+from contextlib import nullcontext
 from pathlib import Path
 from typing import TYPE_CHECKING
 
 import rich_click as click
 from click.exceptions import Exit
 
-from makem4b.base import process
 from makem4b.cli.decorators import add_processing_options, pass_ctx_and_env
 from makem4b.emoji import Emoji
-from makem4b.types import ExitCode
 from makem4b.utils import comma_separated_suffix_list, pinfo, regex_pattern
 
 if TYPE_CHECKING:
+    import re
+
     from makem4b.cli.env import Environment
 
 
@@ -49,6 +48,74 @@ if TYPE_CHECKING:
     """,
     show_default=True,
 )
+@click.option(
+    "-b",
+    "--books",
+    type=click.IntRange(min=1),
+    default=None,
+    show_envvar=True,
+    help="""
+        Number of books to encode and merge at the same time. Books pass through the stages of
+        analysis, encoding, merging, and finalization in a pipeline, so that the next books are
+        analyzed while the current ones are encoded. The number of FFmpeg processes running
+        across all books is still capped by `--jobs`. With more than one book, the output of each
+        book is printed once it has finished, without progress bars. Defaults to `--jobs`.
+    """,
+)
+@click.option(
+    "--pipeline-stats",
+    type=bool,
+    is_flag=True,
+    show_envvar=True,
+    help="""
+        Print the utilization and queue depths of the processing stages at the end of the run,
+        to find the stage that limits throughput.
+    """,
+)
+@click.option(
+    "--reprocess-changed",
+    type=bool,
+    is_flag=True,
+    show_envvar=True,
+    help="""
+        Reprocess directories whose input files or settings changed since they were last
+        processed, overwriting their previous output. By default, they are skipped.
+    """,
+)
+@click.option(
+    "--no-library-index",
+    type=bool,
+    is_flag=True,
+    show_envvar=True,
+    help="""
+        Do not consult or update the index of processed directories. Without it, every directory
+        is analyzed again, and skipped only once its output turns out to exist.
+    """,
+)
+@click.option(
+    "--metrics-file",
+    type=click.Path(
+        dir_okay=False,
+        writable=True,
+        resolve_path=True,
+        path_type=Path,
+    ),
+    default=None,
+    show_envvar=True,
+    help="""
+        Periodically write metrics on the processed books, probed files, FFmpeg processes, and
+        the durations of the processing steps to a file in Prometheus' text format, for example
+        for node_exporter's textfile collector.
+    """,
+)
+@click.option(
+    "--metrics-interval",
+    type=click.FloatRange(min=1),
+    default=15,
+    show_envvar=True,
+    show_default=True,
+    help="""Seconds between the updates of `--metrics-file`.""",
+)
 @add_processing_options
 @pass_ctx_and_env
 def cli(
@@ -63,6 +130,12 @@ def cli(
     no_transcode: bool,
     overwrite: bool,
     cover_regex: re.Pattern[str],
+    books: int | None,
+    pipeline_stats: bool,
+    reprocess_changed: bool,
+    no_library_index: bool,
+    metrics_file: Path | None,
+    metrics_interval: float,
 ) -> None:
     """Recurse into a directory to make audiobooks within its subdirectories.
 
@@ -72,60 +145,68 @@ def cli(
     to be placed in that directory. This option cannot be combined with passing filenames explicitly.
 
     Unless `--overwrite` is passed as well, MAKEM4B will attempt to act in an idempotent manner: if a given directory
-    already contains a file with the prospective output filename, it will skip the directory.
+    already contains a file with the prospective output filename, it will skip the directory. Processed directories are
+    recorded in an index, so that on subsequent runs unchanged directories are skipped without analyzing them again.
+
+    A failure to process one directory does not stop the others from being processed. A summary is printed at the end.
     """
-    suffixes = "|".join(re.escape(suff) for suff in types)
-    re_types = re.compile(rf"^.+({suffixes})$")
+    from makem4b import metrics
+    from makem4b.books import BookStages, BookStatus, make_task, print_pipeline_stats, print_summary
+    from makem4b.discovery import discover_books
+    from makem4b.library import serialize_settings
+    from makem4b.metrics import MetricsFile
+    from makem4b.pipeline import Pipeline
+    from makem4b.types import ExitCode
 
     if not directory:
         pinfo(Emoji.NO_FILES, "No files given.", style="bold yellow")
         click.echo(ctx.command.get_help(ctx))
         raise Exit(ExitCode.USAGE_ERROR)
 
-    for dirpath, dirnames, filenames in directory.walk():
-        matches = filter_files(dirpath=dirpath, filenames=filenames, regex=re_types)
-        filenames.sort()
-        dirnames.sort()
-
-        seen_types = list(matches.keys())
-        if (type_cnt := len(seen_types)) > 1:
-            pinfo(
-                Emoji.STOP,
-                f"Skipping directory, multiple filetypes ({type_cnt}): {dirpath.relative_to(directory)}",
-            )
-            continue
-        elif type_cnt < 1:
-            continue
-
-        seen_files = matches[seen_types[0]]
-        if len(seen_files) < 2:
-            pinfo(
-                Emoji.STOP,
-                f"Skipping directory, fewer than 2 matching files: {dirpath.relative_to(directory)}",
-            )
-            continue
-
-        cover_file = next((dirpath / f for f in filenames if cover_regex.match(f)), None)
-        try:
-            pinfo(Emoji.INFO, f"Processing {dirpath.relative_to(env.cwd)}")
-            process(
-                env=env,
-                files=seen_files,
-                move_originals_to=move_originals_to,
-                analyze_only=analyze_only,
-                prefer_remux=prefer_remux,
-                no_transcode=no_transcode,
-                overwrite=overwrite,
-                cover=cover_file,
-            )
-        except Exit:
-            pass
-
+    books = books or env.jobs
+    env.library_index = not no_library_index
+    settings = serialize_settings(prefer_remux=prefer_remux, single_pass=env.single_pass)
+    with (
+        env.open_probe_cache(),
+        env.open_intermediate_cache(),
+        env.open_library_index() as index,
+        MetricsFile(metrics_file, interval=metrics_interval) if metrics_file else nullcontext(),
+    ):
+        stages = BookStages(
+            env,
+            index=index,
+            move_originals_to=move_originals_to,
+            analyze_only=analyze_only,
+            prefer_remux=prefer_remux,
+            no_transcode=no_transcode,
+            books=books,
+        )
+        with Pipeline(
+            stages.pipeline_stages(),
+            on_finish=stages.finish,
+            maxsize=books,
+        ) as pipeline:
+            for candidate in discover_books(
+                directory,
+                suffixes=types,
+                cover_regex=cover_regex,
+                prune=[path for path in (move_originals_to, env.scratch_dir) if path],
+            ):
+                if task := make_task(
+                    candidate,
+                    index=index,
+                    relpath=candidate.path.relative_to(directory),
+                    settings=settings,
+                    overwrite=overwrite,
+                    reprocess_changed=reprocess_changed,
+                ):
+                    metrics.books_in_progress.inc()
+                    pipeline.put(task)
+                else:
+                    stages.count(BookStatus.SKIPPED, candidate.path)
 
-def filter_files(dirpath: Path, filenames: list[str], regex: re.Pattern[str]) -> dict[str, list[Path]]:
-    matches: dict[str, list[Path]] = defaultdict(list)
-    for filen in filenames:
-        if regex.match(filen):
-            filepath = dirpath / filen
-            matches[filepath.suffix].append(filepath)
-    return dict(matches)
+    print_summary(stages.statuses, failed=stages.failed, env=env)
+    if pipeline_stats:
+        print_pipeline_stats(pipeline.stats, elapsed=pipeline.elapsed)
+    if stages.failed:
+        raise Exit(ExitCode.GENERIC_ERROR)
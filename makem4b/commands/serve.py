@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import signal
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, NoReturn
+
+import rich_click as click
+
+from makem4b.cli.decorators import pass_ctx_and_env
+from makem4b.emoji import Emoji
+from makem4b.utils import pinfo
+
+if TYPE_CHECKING:
+    from makem4b.cli.env import Environment
+
+
+def _interrupt(*_: Any) -> NoReturn:
+    raise KeyboardInterrupt
+
+
+@click.command()
+@click.help_option("-h", "--help")
+@click.option(
+    "-s",
+    "--socket",
+    "socket_path",
+    type=click.Path(
+        dir_okay=False,
+        writable=True,
+        resolve_path=True,
+        path_type=Path,
+    ),
+    default=None,
+    show_envvar=True,
+    help="""Unix socket to listen on. It is accessible to the owner and group of the server process.""",
+)
+@click.option(
+    "-p",
+    "--port",
+    type=click.IntRange(min=0, max=65535),
+    default=None,
+    show_envvar=True,
+    help="""
+        Port to listen on at 127.0.0.1 instead of a Unix socket. Any local user may connect to it. Pass 0
+        to pick a free port.
+    """,
+)
+@click.option(
+    "-b",
+    "--books",
+    type=click.IntRange(min=1),
+    default=None,
+    show_envvar=True,
+    help="""
+        Number of jobs to process at the same time, further jobs are queued. The number of FFmpeg
+        processes running across all jobs is still capped by `--jobs`. Defaults to `--jobs`.
+    """,
+)
+@pass_ctx_and_env
+def cli(
+    ctx: click.RichContext,
+    env: Environment,
+    *,
+    socket_path: Path | None,
+    port: int | None,
+    books: int | None,
+) -> None:
+    """Serve an API to merge audiobooks, for other programs to submit jobs to.
+
+    \b
+    The server accepts merge jobs as JSON, with the same options as the `merge` command, and processes them
+    on a pool of workers, sparing each book the startup of another MAKEM4B process. The output of jobs is
+    not printed, but kept with their status.
+
+    \b
+    - `POST /jobs` submits a job as `application/json`: `{"files": [...], "cover": null, "prefer_remux": false,
+      "no_transcode": false, "overwrite": false, "move_originals_to": null, "analyze_only": false}`, only `files`
+      being required.
+    - `GET /jobs` lists the jobs, and `GET /jobs/<id>` returns the status, processing step, progress of the
+      FFmpeg processes, and output of a job.
+    - `DELETE /jobs/<id>` cancels a job, killing its FFmpeg processes, or forgets it once it has finished.
+    - `GET /metrics` returns metrics in Prometheus' text format.
+
+    Stop the server with Ctrl+C or SIGTERM, which cancels the jobs still queued or running.
+    """
+    from makem4b.server import JobManager, TCPJobServer, UnixJobServer
+
+    if (socket_path is None) == (port is None):
+        ctx.fail("Pass either -s/--socket or -p/--port.")
+
+    books = books or env.jobs
+    signal.signal(signal.SIGTERM, _interrupt)
+    with env.open_probe_cache(), env.open_intermediate_cache():
+        jobs = JobManager(env, workers=books)
+        try:
+            with UnixJobServer(socket_path, jobs=jobs) if socket_path else TCPJobServer(port or 0, jobs=jobs) as server:
+                pinfo(Emoji.INFO, f"Serving jobs at {server.url}")
+                server.serve_forever()
+        except KeyboardInterrupt:
+            pinfo(Emoji.STOP, "Stopping server")
+        finally:
+            jobs.close()
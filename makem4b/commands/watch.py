@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+from contextlib import closing
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import rich_click as click
+
+from makem4b.cli.decorators import add_processing_options, pass_ctx_and_env
+from makem4b.emoji import Emoji
+from makem4b.utils import comma_separated_suffix_list, pinfo, regex_pattern
+
+if TYPE_CHECKING:
+    import re
+
+    from makem4b.cli.env import Environment
+
+# Seconds to wait for changes at most, before checking whether pending directories have settled.
+WAIT_TIMEOUT = 1.0
+
+
+@click.command()
+@click.help_option("-h", "--help")
+@click.argument(
+    "directory",
+    type=click.Path(
+        exists=True,
+        readable=True,
+        file_okay=False,
+        resolve_path=True,
+        path_type=Path,
+    ),
+)
+@click.option(
+    "-t",
+    "--types",
+    type=comma_separated_suffix_list,
+    default=[".m4a", ".mp3"],
+    help="""Filename extensions to be considered.""",
+    show_default=True,
+)
+@click.option(
+    "-c",
+    "--cover-regex",
+    type=regex_pattern,
+    default=r"^cover\.(jpe?g|png)$",
+    help="""
+        Regular expression to use to find a matching cover image file. If merging of
+        cover files it not desired, pass `^$` (effectively matching files with no name).
+    """,
+    show_default=True,
+)
+@click.option(
+    "-b",
+    "--books",
+    type=click.IntRange(min=1),
+    default=None,
+    show_envvar=True,
+    help="""Number of books to encode and merge at the same time. Defaults to `--jobs`.""",
+)
+@click.option(
+    "--settle",
+    type=click.FloatRange(min=0),
+    default=15,
+    show_envvar=True,
+    show_default=True,
+    help="""
+        Seconds without changes after which the files of a directory are checked for stability. A
+        directory is processed once its files kept their sizes and modification times for another
+        such period.
+    """,
+)
+@click.option(
+    "--polling",
+    type=bool,
+    is_flag=True,
+    show_envvar=True,
+    help="""
+        Poll for changes instead of using inotify, e.g. for network file systems, where changes made
+        by other hosts are not notified. Polling is also used where inotify is unavailable.
+    """,
+)
+@click.option(
+    "--poll-interval",
+    type=click.FloatRange(min=1),
+    default=60,
+    show_envvar=True,
+    show_default=True,
+    help="""Seconds between scans of the directory tree when polling.""",
+)
+@click.option(
+    "--reprocess-changed",
+    type=bool,
+    is_flag=True,
+    show_envvar=True,
+    help="""
+        Reprocess directories whose input files or settings changed since they were last
+        processed, overwriting their previous output. By default, they are skipped.
+    """,
+)
+@add_processing_options
+@pass_ctx_and_env
+def cli(
+    ctx: click.RichContext,
+    env: Environment,
+    *,
+    directory: Path,
+    move_originals_to: Path | None,
+    types: list[str],
+    analyze_only: bool,
+    prefer_remux: bool,
+    no_transcode: bool,
+    overwrite: bool,
+    cover_regex: re.Pattern[str],
+    books: int | None,
+    settle: float,
+    polling: bool,
+    poll_interval: float,
+    reprocess_changed: bool,
+) -> None:
+    """Watch a directory for new or changed audiobooks, and make them as they arrive.
+
+    \b
+    Subdirectories are treated like in the `recursive` command, but instead of scanning the whole directory tree
+    again, MAKEM4B waits for changes to be notified by inotify (or polls for them where that is not available), and
+    only processes the directories affected. Directories are processed once their files have stopped changing, so
+    that books still being copied are not picked up early. All directories are checked once on start.
+
+    Stop watching with Ctrl+C. A summary of the books processed is printed at the end.
+    """
+    from makem4b.books import BookQueue, BookStages, print_summary
+    from makem4b.discovery import discover_books
+    from makem4b.library import serialize_settings
+    from makem4b.pipeline import Pipeline
+    from makem4b.watching import PendingDirectories, open_watcher
+
+    books = books or env.jobs
+    suffixes = tuple(types)
+    prune = [path for path in (move_originals_to, env.scratch_dir) if path]
+
+    def _is_relevant(name: str) -> bool:
+        return name.endswith(suffixes) or bool(cover_regex.match(name))
+
+    with (
+        env.open_probe_cache(),
+        env.open_intermediate_cache(),
+        env.open_library_index() as index,
+    ):
+        stages = BookStages(
+            env,
+            index=index,
+            move_originals_to=move_originals_to,
+            analyze_only=analyze_only,
+            prefer_remux=prefer_remux,
+            no_transcode=no_transcode,
+            books=books,
+        )
+        queue = BookQueue(
+            directory,
+            stages=stages,
+            index=index,
+            suffixes=types,
+            cover_regex=cover_regex,
+            settings=serialize_settings(prefer_remux=prefer_remux, single_pass=env.single_pass),
+            overwrite=overwrite,
+            reprocess_changed=reprocess_changed,
+            pending=PendingDirectories(settle=settle),
+        )
+        try:
+            with (
+                closing(
+                    open_watcher(
+                        directory,
+                        prune=prune,
+                        relevant=_is_relevant,
+                        poll_interval=poll_interval,
+                        polling=polling,
+                    )
+                ) as watcher,
+                Pipeline(
+                    stages.pipeline_stages(),
+                    on_finish=queue.finish,
+                    maxsize=books,
+                ) as queue.pipeline,
+            ):
+                queue.pending.touch(
+                    book.path
+                    for book in discover_books(directory, suffixes=types, cover_regex=cover_regex, prune=prune)
+                )
+                pinfo(Emoji.INFO, f"Watching {directory} for audiobooks")
+                while True:
+                    queue.pending.touch(watcher.wait(WAIT_TIMEOUT))
+                    for dirpath in queue.pending.settled():
+                        queue.put(dirpath)
+        except KeyboardInterrupt:
+            pinfo(Emoji.STOP, "Stopped watching")
+
+    print_summary(stages.statuses, failed=stages.failed, env=env)
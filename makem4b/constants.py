@@ -29,3 +29,17 @@ AAC_SAMPLE_RATES = (
     88200,
     96000,
 )
+
+# Seconds to wait for another process writing to the probe or intermediate cache.
+CACHE_BUSY_TIMEOUT = 30.0
+
+PROBE_CACHE_FILE = "probe.sqlite"
+PROBE_CACHE_MAX_SIZE = 256 * 1024 * 1024
+# Version of the probes, bump it when probing changes its output, so that cached probes are probed again.
+PROBE_CACHE_VERSION = 1
+
+LIBRARY_INDEX_FILE = "library.sqlite"
+
+INTERMEDIATE_CACHE_DIR = "intermediates"
+INTERMEDIATE_CACHE_FILE = "intermediates.sqlite"
+INTERMEDIATE_CACHE_MAX_SIZE = 4_000_000_000
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import os
+from collections import defaultdict
+from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
+
+from loguru import logger
+
+from makem4b import constants
+
+if TYPE_CHECKING:
+    import re
+    from collections.abc import Generator
+
+
+class BookDirectory(NamedTuple):
+    path: Path
+    matches: dict[str, list[os.DirEntry[str]]]
+    cover: os.DirEntry[str] | None
+
+    def files(self, suffix: str) -> list[Path]:
+        return [Path(entry.path) for entry in self.matches[suffix]]
+
+
+def _is_ignored(dirpath: str, entry_names: set[str]) -> bool:
+    if constants.CACHEDIR_TAG in entry_names:
+        return True
+    if constants.PLEXIGNORE_FILE not in entry_names:
+        return False
+    try:
+        with open(os.path.join(dirpath, constants.PLEXIGNORE_FILE)) as fh:
+            return any(line.strip() == "*" for line in fh)
+    except OSError:
+        return False
+
+
+def _scan(dirpath: str) -> list[os.DirEntry[str]] | None:
+    try:
+        with os.scandir(dirpath) as it:
+            return sorted(it, key=lambda e: e.name)
+    except OSError as exc:
+        logger.warning("Cannot read directory, skipping: {}", exc)
+        return None
+
+
+def walk_directories(
+    directory: Path,
+    *,
+    prune: list[Path] | None = None,
+    recursive: bool = True,
+) -> Generator[tuple[Path, list[os.DirEntry[str]]], None, None]:
+    """Walk directory top-down and yield every directory with its entries, sorted by name.
+
+    Directories are read with a single scandir each and yielded as soon as they are read. Temporary
+    directories, directories marked as caches or fully ignored via .plexignore, and the pruned paths
+    (and their subtrees) are not descended into. Symlinked directories are not followed. Unless recursive,
+    only directory itself is read.
+    """
+    pruned = {str(p.resolve()) for p in prune or []}
+    stack = [str(directory)]
+    while stack:
+        dirpath = stack.pop()
+        if (entries := _scan(dirpath)) is None:
+            continue
+        if _is_ignored(dirpath, {e.name for e in entries}):
+            logger.debug("Pruned ignored directory {}", dirpath)
+            continue
+
+        if recursive:
+            # Reversed, so that subdirectories are popped off the stack in sorted order.
+            stack.extend(
+                entry.path
+                for entry in reversed(entries)
+                if entry.is_dir(follow_symlinks=False)
+                and entry.name != constants.TEMPDIR_NAME
+                and entry.path not in pruned
+            )
+        yield Path(dirpath), entries
+
+
+def discover_books(
+    directory: Path,
+    *,
+    suffixes: list[str],
+    cover_regex: re.Pattern[str],
+    prune: list[Path] | None = None,
+    recursive: bool = True,
+) -> Generator[BookDirectory, None, None]:
+    """Walk directory (see walk_directories) and yield every directory that contains files with one of the suffixes."""
+    suffix_tuple = tuple(suffixes)
+    for dirpath, entries in walk_directories(directory, prune=prune, recursive=recursive):
+        matches: dict[str, list[os.DirEntry[str]]] = defaultdict(list)
+        cover = None
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                continue
+            name = entry.name
+            if name.endswith(suffix_tuple) and (suffix := os.path.splitext(name)[1]):
+                matches[suffix].append(entry)
+            elif cover is None and cover_regex.match(name):
+                cover = entry
+
+        if matches:
+            yield BookDirectory(path=dirpath, matches=dict(matches), cover=cover)
@@ -1,44 +1,37 @@
 from __future__ import annotations
 
-import json
-import re
 import shlex
 import subprocess
+import threading
 from bisect import bisect_left
-from pathlib import Path
-from typing import TYPE_CHECKING, Any, Literal
-
-from loguru import logger
-
-from makem4b import constants
+from concurrent.futures import CancelledError, Future
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import StrEnum
+from functools import cache
+from typing import TYPE_CHECKING, Any, Literal, NamedTuple
+
+from makem4b import aioffmpeg, constants
+from makem4b.aioffmpeg import FFMPEG_CMD_BIN
 from makem4b.emoji import Emoji
-from makem4b.utils import TaskProgress, pinfo
+from makem4b.utils import pinfo
 
 if TYPE_CHECKING:
-    from collections.abc import Generator
+    from collections.abc import Callable, Coroutine, Generator
+    from pathlib import Path
 
+    from makem4b.progress import ProgressEvent
     from makem4b.types import CodecParams
+    from makem4b.utils import TaskProgress
 
 
-FFMPEG_CMD_BIN = "ffmpeg"
-
-FFPROBE_CMD = [
-    "ffprobe",
-    "-hide_banner",
-    "-v",
-    "16",
-]
-FFMPEG_CMD = [
-    FFMPEG_CMD_BIN,
-    "-hide_banner",
-    "-v",
-    "16",
-    "-y",
-]
-
 TRANSCODE_MAX_BITRATE = 192000
 TRANSCODE_CODEC_AAC_FDK = "libfdk_aac"
 TRANSCODE_CODEC_AAC_FREE = "aac"
+AAC_FRAME_SIZE = 1024
+# Samples the encoders prepend to their output. The delay of libfdk_aac differs between its
+# versions, so the duration of its intermediates can only be probed.
+ENCODER_DELAYS = {TRANSCODE_CODEC_AAC_FREE: 1024}
 
 COPY_CMD_ARGS = [
     "-c:a",
@@ -59,20 +52,9 @@ CONCAT_CMD_ARGS = [
     "-map_chapters",
     "1",
 ]
-CONCAT_AAC_ADDED_ARGS = [
-    "-movflags",
-    "faststart",
-    "-f",
-    "mp4",
-]
-
-CONCAT_APPEND_COVER_ADDED_ARGS = [
+COVER_STREAM_ARGS = [
     "-c:v",
     "mjpeg",
-    "-map",
-    "0:a",
-    "-map",
-    "2:v",
     "-disposition:1",
     "attached_pic",
     "-metadata:s:v",
@@ -80,34 +62,189 @@ CONCAT_APPEND_COVER_ADDED_ARGS = [
     "-metadata:s:v",
     'comment="Cover (front)"',
 ]
+CONCAT_APPEND_COVER_ADDED_ARGS = [
+    "-map",
+    "0:a",
+    "-map",
+    "2:v",
+    *COVER_STREAM_ARGS,
+]
 
-re_progress = re.compile(r"^total_size=(\d+)")
+CHANNEL_LAYOUTS = {
+    1: "mono",
+    2: "stereo",
+}
 
 
-def _make_input_args(inputs: list[Path | str] | Path | str) -> list[str]:
-    if not isinstance(inputs, list):
-        inputs = [inputs]
-    args = []
-    for file in inputs:
-        if isinstance(file, Path) and not file.is_file():
-            msg = f"File '{file}' not found"
-            raise ValueError(msg)
-        args += ["-i", str(file)]
-    return args
+class ProcessGroup:
+    """Set of running FFmpeg processes that can be killed together.
 
+    Processes are tracked by the futures of their runs on the background loop, cancelling them
+    kills the processes. Once killed, the group also kills any process subsequently added to it,
+    so that workers that have not yet started their process terminate right away.
+    """
 
-def make_transcoding_args(codec: CodecParams, target_format: Literal["m4b"] = "m4b") -> list[str]:
+    def __init__(self, *, limited: bool = True) -> None:
+        self._lock = threading.Lock()
+        self._runs: set[Future[Any]] = set()
+        self.killed = False
+        self.limited = limited
+
+    def add(self, run: Future[Any]) -> None:
+        with self._lock:
+            self._runs.add(run)
+            if self.killed:
+                run.cancel()
+
+    def discard(self, run: Future[Any]) -> None:
+        with self._lock:
+            self._runs.discard(run)
+
+    def kill(self) -> None:
+        with self._lock:
+            self.killed = True
+            for run in self._runs:
+                run.cancel()
+
+
+_cancel_group: ContextVar[ProcessGroup | None] = ContextVar("cancel_group", default=None)
+
+
+@contextmanager
+def cancel_group(group: ProcessGroup) -> Generator[ProcessGroup, None, None]:
+    """Add the processes run in the current context to group, besides any group of their own.
+
+    Killing the group thereby cancels all processing in the context, such as that of a book.
+    """
+    token = _cancel_group.set(group)
+    try:
+        yield group
+    finally:
+        _cancel_group.reset(token)
+
+
+class JobKind(StrEnum):
+    PROBE = "probe"
+    REMUX = "remux"
+    TRANSCODE = "transcode"
+    MERGE = "merge"
+
+
+class JobCost(NamedTuple):
+    cpu: int
+    io: int
+
+
+# Probes and cover extractions are short, but still count against the CPU budget, so that their
+# number is capped like that of any other process. Transcodes take as many CPU units as threads
+# they are granted. Remuxing and merging (which rewrites the whole output to move the moov atom
+# to the front with -movflags faststart) are bound by disk I/O.
+JOB_COSTS = {
+    JobKind.PROBE: JobCost(cpu=1, io=0),
+    JobKind.REMUX: JobCost(cpu=0, io=1),
+    JobKind.TRANSCODE: JobCost(cpu=1, io=0),
+    JobKind.MERGE: JobCost(cpu=0, io=1),
+}
+
+
+class Budget(NamedTuple):
+    cpu: int
+    io: int
+
+
+class Scheduler:
+    """Process-wide admission of FFmpeg processes against budgets of CPU and disk I/O units.
+
+    A process is admitted once the units for its kind of job are available, or once nothing else
+    uses the resource it needs, so that a job costing more than the budget still runs on its own.
+    Unlimited unless a budget is set, processes of groups that are not limited are exempt.
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._budget: Budget | None = None
+        self._used = JobCost(cpu=0, io=0)
+
+    @contextmanager
+    def budget(self, *, cpu: int, io: int) -> Generator[None, None, None]:
+        with self._cond:
+            previous, self._budget = self._budget, Budget(cpu=cpu, io=io)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._budget = previous
+                self._cond.notify_all()
+
+    def _fits(self, budget: Budget, cost: JobCost) -> bool:
+        cpu, io = self._used
+        return (not cost.cpu or not cpu or cpu + cost.cpu <= budget.cpu) and (
+            not cost.io or not io or io + cost.io <= budget.io
+        )
+
+    @contextmanager
+    def admit(
+        self,
+        kind: JobKind,
+        *,
+        group: ProcessGroup | None = None,
+        max_threads: int = 1,
+    ) -> Generator[int | None, None, None]:
+        """Wait for the admission of a job, yielding the number of threads granted to transcodes.
+
+        Transcodes are granted up to max_threads of the free CPU units. No thread count is granted
+        if no budget is set, leaving it to FFmpeg.
+        """
+        budget = self._budget
+        if not budget or (group and not group.limited):
+            yield None
+            return
+
+        cost, threads = self._acquire(kind, budget, max_threads=max_threads)
+        try:
+            yield threads
+        finally:
+            with self._cond:
+                self._used = JobCost(cpu=self._used.cpu - cost.cpu, io=self._used.io - cost.io)
+                self._cond.notify_all()
+
+    def _acquire(self, kind: JobKind, budget: Budget, *, max_threads: int) -> tuple[JobCost, int | None]:
+        cost = JOB_COSTS[kind]
+        with self._cond:
+            while not self._fits(budget, cost):
+                self._cond.wait()
+            threads = None
+            if kind == JobKind.TRANSCODE:
+                threads = max(1, min(max_threads, budget.cpu - self._used.cpu))
+                cost = cost._replace(cpu=threads)
+            self._used = JobCost(cpu=self._used.cpu + cost.cpu, io=self._used.io + cost.io)
+        return cost, threads
+
+
+scheduler = Scheduler()
+
+
+class TranscodingParams(NamedTuple):
+    encoder: str
+    sample_rate: float
+    bit_rate: int
+
+
+@cache
+def _has_libfdk_aac() -> bool:
+    version_output = subprocess.check_output(  # noqa: S603
+        [FFMPEG_CMD_BIN, "-version"],
+        stderr=subprocess.PIPE,
+    ).decode()
+    return "enable-libfdk-aac" in version_output
+
+
+def select_transcoding_params(codec: CodecParams, target_format: Literal["m4b"] = "m4b") -> TranscodingParams:
     encoder: str | None
     allowed_sample_rates: tuple[float | int, ...] | None = None
     match target_format:
         case "m4b":
-            version_output = subprocess.check_output(  # noqa: S603
-                [FFMPEG_CMD_BIN, "-version"],
-                stderr=subprocess.PIPE,
-            ).decode()
-
-            if "enable-libfdk-aac" in version_output:
-                pinfo(Emoji.FDKAAC, "Using libfdk-aac encoder")
+            if _has_libfdk_aac():
                 encoder = TRANSCODE_CODEC_AAC_FDK
                 allowed_sample_rates = constants.AAC_SAMPLE_RATES
             else:
@@ -125,7 +262,13 @@ def make_transcoding_args(codec: CodecParams, target_format: Literal["m4b"] = "m
     bit_rate = 16000
     while bit_rate < codec.bit_rate and bit_rate < TRANSCODE_MAX_BITRATE:
         bit_rate += 16000
+    return TranscodingParams(encoder=encoder, sample_rate=sample_rate, bit_rate=bit_rate)
+
 
+def make_transcoding_args(codec: CodecParams, target_format: Literal["m4b"] = "m4b") -> list[str]:
+    encoder, sample_rate, bit_rate = select_transcoding_params(codec, target_format)
+    if encoder == TRANSCODE_CODEC_AAC_FDK:
+        pinfo(Emoji.FDKAAC, "Using libfdk-aac encoder")
     pinfo(
         Emoji.TRANSCODE,
         f"Transcoding files to {target_format} ({bit_rate/1000:.1f} kBit/s, {sample_rate/1000:.1f} kHz)",
@@ -133,129 +276,137 @@ def make_transcoding_args(codec: CodecParams, target_format: Literal["m4b"] = "m
     return shlex.split(f"-c:a {encoder} -b:a {bit_rate} -ar {sample_rate} -vn")
 
 
-def _poll_for_progress(process: subprocess.Popen[bytes]) -> Generator[int, None, None]:
-    while True:
-        if process.stdout is None:
-            continue
+def make_duration_filter(duration_ts: int, sample_rate: float) -> str:
+    """Build a filter that pads or trims audio of sample_rate to exactly duration_ts.
 
-        stdout_line = process.stdout.readline().decode("utf-8", errors="replace").strip()
-        if stdout_line == "" and process.poll() is not None:
-            break
+    This allows chapter marks derived from the same durations to line up with the
+    resulting audio sample by sample.
+    """
+    samples = round(duration_ts * sample_rate / constants.TIMEBASE)
+    return f"apad=whole_len={samples},atrim=end_sample={samples}"
 
-        if match := re_progress.search(stdout_line):
-            yield round(int(match.group(1)))
 
+def make_transcoded_duration_filter(duration_ts: int, params: TranscodingParams) -> str:
+    """Build a filter that resamples audio to the sample rate of params, and pads or trims it to duration_ts."""
+    return f"aresample={round(params.sample_rate)},{make_duration_filter(duration_ts, params.sample_rate)}"
 
-def _check_result(process: subprocess.Popen[bytes] | subprocess.CompletedProcess[bytes], *, args: list[str]) -> None:
-    if process.returncode != 0:
-        msg = f"Error running command {shlex.join(['ffmpeg']+args)}"
-        raise RuntimeError(msg)
 
+def transcoded_duration(duration_ts: int, params: TranscodingParams) -> int:
+    """Return the duration of mpegts transcoded with params from audio filtered by make_transcoded_duration_filter.
 
-def wrapped_ffmpeg(args: list[str]) -> Generator[int, None, None]:
-    progress_args = ["-progress", "-", "-nostats"]
-    process = subprocess.Popen(  # noqa: S603
-        FFMPEG_CMD + progress_args + args,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        text=False,
-    )
-    yield from _poll_for_progress(process)
-    _check_result(process, args=args)
+    Unlike MP4, mpegts has no edit list to hide the samples the encoder prepends to the audio, and
+    the last frame is filled up, so the intermediate lasts longer than duration_ts.
+    """
+    samples = round(duration_ts * params.sample_rate / constants.TIMEBASE)
+    frames = -(-(samples + ENCODER_DELAYS[params.encoder]) // AAC_FRAME_SIZE)
+    return round(frames * AAC_FRAME_SIZE * constants.TIMEBASE / params.sample_rate)
+
+
+def make_concat_filter_args(durations: list[int], codec: CodecParams) -> list[str]:
+    """Build a filter graph that decodes all inputs, aligns them to codec, and concatenates them."""
+    sample_rate = round(codec.sample_rate)
+    channel_layout = CHANNEL_LAYOUTS.get(codec.channels, f"{codec.channels}c")
+    chains = [
+        f"[{idx}:a:0]aresample={sample_rate},aformat=channel_layouts={channel_layout},"
+        f"{make_duration_filter(duration_ts, sample_rate)}[a{idx}]"
+        for idx, duration_ts in enumerate(durations)
+    ]
+    labels = "".join(f"[a{idx}]" for idx in range(len(durations)))
+    chains.append(f"{labels}concat=n={len(durations)}:v=0:a=1[out]")
+    return ["-filter_complex", ";".join(chains), "-map", "[out]"]
+
+
+def _run[T](coro: Coroutine[Any, Any, T], *, group: ProcessGroup | None = None) -> T:
+    """Run a coroutine of the async API on the background loop, and wait for its result."""
+    run = aioffmpeg.background_loop.submit(coro)
+    groups = [g for g in (group, _cancel_group.get()) if g]
+    for g in groups:
+        g.add(run)
+    try:
+        return run.result()
+    except CancelledError as exc:
+        msg = "FFmpeg process was killed"
+        raise RuntimeError(msg) from exc
+    except BaseException:
+        # Waiting was interrupted, e.g. by Ctrl+C, make sure the process does not outlive us.
+        run.cancel()
+        raise
+    finally:
+        for g in groups:
+            g.discard(run)
 
 
-def wrapped_ffmpeg_no_progress(args: list[str]) -> None:
-    list(wrapped_ffmpeg(args))
+def _with_threads(args: list[str], threads: int | None) -> list[str]:
+    return [*args, "-threads", str(threads)] if threads else args
+
+
+def _update_progress(progress: TaskProgress) -> Callable[[ProgressEvent], None]:
+    def _on_progress(event: ProgressEvent) -> None:
+        if event.total_size is not None:
+            progress.update(completed=event.total_size)
+
+    return _on_progress
 
 
 def extract_cover_img(file: Path, *, output: Path) -> None:
-    wrapped_ffmpeg_no_progress(
-        [
-            *_make_input_args(file),
-            "-map_metadata",
-            "-1",
-            "-map",
-            "0:v",
-            "-map",
-            "-0:V",
-            "-c",
-            "copy",
-            str(output),
-        ],
-    )
+    with scheduler.admit(JobKind.PROBE):
+        _run(aioffmpeg.extract_cover_img(file, output=output))
 
 
 def probe(file: Path) -> dict[str, Any]:
-    try:
-        probe_res = subprocess.check_output(  # noqa: S603
-            [
-                *FFPROBE_CMD,
-                *_make_input_args(file),
-                "-output_format",
-                "json",
-                "-show_streams",
-                "-show_entries",
-                "format_tags",
-            ],
-            stderr=subprocess.PIPE,
-        )
-        return json.loads(probe_res)
-    except json.JSONDecodeError as exc:
-        msg = f"File {file} could not be probed: {exc}"
-        raise RuntimeError(msg) from exc
-    except subprocess.CalledProcessError as exc:
-        msg = f"File {file} could not be parsed: {exc.stderr.decode()}"
-        raise RuntimeError(msg) from exc
+    with scheduler.admit(JobKind.PROBE):
+        return _run(aioffmpeg.probe(file))
 
 
 def probe_duration(file: Path) -> int:
-    probe_res = subprocess.check_output(  # noqa: S603
-        [
-            *FFPROBE_CMD,
-            *_make_input_args(file),
-            "-output_format",
-            "csv=p=0",
-            "-show_entries",
-            "format=duration",
-        ],
-        text=True,
-    )
-    return round(float(probe_res) * constants.TIMEBASE)
-
-
-def convert(inputs: list[Path | str], args: list[str], *, output: Path, progress: TaskProgress) -> None:
+    with scheduler.admit(JobKind.PROBE):
+        return _run(aioffmpeg.probe_duration(file))
+
+
+def convert(
+    inputs: list[Path | str],
+    args: list[str],
+    *,
+    output: Path,
+    progress: TaskProgress,
+    kind: JobKind = JobKind.TRANSCODE,
+    max_threads: int = 1,
+    group: ProcessGroup | None = None,
+) -> None:
+    """Convert inputs to output.
+
+    Transcodes are run with as many threads as the scheduler grants, up to max_threads. These
+    are charged to the CPU budget, so raise it only for encoders that can use more than one
+    thread, which FFmpeg's aac and libfdk_aac encoders cannot.
+    """
     try:
-        all_args = [
-            *_make_input_args(inputs),
-            *args,
-            str(output),
-        ]
-        logger.debug("Running command: {}", shlex.join(all_args))
-        for completed in wrapped_ffmpeg(all_args):
-            progress.update(completed=completed)
+        with scheduler.admit(kind, group=group, max_threads=max_threads) as threads:
+            _run(
+                aioffmpeg.convert(
+                    inputs,
+                    _with_threads(args, threads),
+                    output=output,
+                    on_progress=_update_progress(progress),
+                ),
+                group=group,
+            )
+    finally:
         progress.close()
-    except subprocess.CalledProcessError as exc:
-        msg = f"Conversion failed: {exc.stderr.decode()}"
-        raise RuntimeError(msg) from exc
 
 
-def concat(inputs: list[Path | str], args: list[str], *, output: Path, progress: TaskProgress) -> None:
-    if output.suffix in (".m4a", ".m4b"):
-        args = args + CONCAT_AAC_ADDED_ARGS
+def concat(
+    inputs: list[Path | str],
+    args: list[str],
+    *,
+    output: Path,
+    progress: TaskProgress,
+    group: ProcessGroup | None = None,
+) -> None:
     try:
-        all_args = [
-            "-f",
-            "concat",
-            "-safe",
-            "0",
-            *_make_input_args(inputs),
-            *args,
-            str(output),
-        ]
-        logger.debug("Running command: {}", shlex.join(all_args))
-        for completed in wrapped_ffmpeg(all_args):
-            progress.update(completed=completed)
+        with scheduler.admit(JobKind.MERGE, group=group):
+            _run(
+                aioffmpeg.concat(inputs, args, output=output, on_progress=_update_progress(progress)),
+                group=group,
+            )
+    finally:
         progress.close()
-    except subprocess.CalledProcessError as exc:
-        msg = f"Conversion failed: {exc.stderr.decode()}"
-        raise RuntimeError(msg) from exc
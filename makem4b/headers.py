@@ -0,0 +1,698 @@
+"""In-process probing of MP4/M4A and MP3 files from their container headers.
+
+The functions in this module produce a subset of the output of ``ffprobe -show_streams -show_entries format_tags``
+that is sufficient to build a ``ProbedFile``, without spawning a process. Whenever a file uses a feature that cannot be
+reproduced faithfully (unknown codecs, HE-AAC, ID3v1-only tags, numeric genres, etc.), ``probe`` returns None and the
+caller is expected to fall back to ffprobe.
+"""
+
+from __future__ import annotations
+
+import struct
+from typing import TYPE_CHECKING, Any, BinaryIO
+
+from loguru import logger
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+    from pathlib import Path
+
+ProbeOutput = dict[str, Any]
+
+MP4_HANDLER_TYPES = {
+    b"vide": "video",
+    b"text": "subtitle",
+    b"sbtl": "subtitle",
+}
+MP4_ILST_TAGS = {
+    b"\xa9alb": "album",
+    b"\xa9ART": "artist",
+    b"aART": "album_artist",
+    b"\xa9cmt": "comment",
+    b"\xa9wrt": "composer",
+    b"\xa9day": "date",
+    b"\xa9gen": "genre",
+    b"\xa9nam": "title",
+    b"\xa9too": "encoder",
+    b"\xa9grp": "grouping",
+    b"desc": "description",
+}
+MP4_ILST_NUMBERED_TAGS = {
+    b"trkn": "track",
+    b"disk": "disc",
+}
+MP4_AAC_OBJECT_TYPES = (0x40, 0x66, 0x67, 0x68)
+MP4_MP3_OBJECT_TYPES = (0x69, 0x6B)
+AAC_SAMPLE_RATES = (96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350)
+AAC_SBR_OBJECT_TYPES = (5, 29)
+AAC_GA_OBJECT_TYPES = (1, 2, 3, 4, 6, 7)
+AAC_SYNC_EXTENSION = 0x2B7
+
+ID3V2_TAGS = {
+    "TALB": "album",
+    "TCOM": "composer",
+    "TCON": "genre",
+    "TENC": "encoded_by",
+    "TIT2": "title",
+    "TPE1": "artist",
+    "TPE2": "album_artist",
+    "TPE3": "performer",
+    "TPOS": "disc",
+    "TPUB": "publisher",
+    "TRCK": "track",
+    "TSSE": "encoder",
+    "TLAN": "language",
+    "TCOP": "copyright",
+}
+ID3V24_TAGS = {
+    "TDRC": "date",
+    "TDRL": "date",
+    "TIT1": "grouping",
+    "TCMP": "compilation",
+}
+ID3V22_TAGS = {
+    "TAL": "album",
+    "TCO": "genre",
+    "TCP": "compilation",
+    "TT2": "title",
+    "TEN": "encoded_by",
+    "TP1": "artist",
+    "TP2": "album_artist",
+    "TP3": "performer",
+    "TRK": "track",
+    "TCM": "composer",
+    "TPA": "disc",
+    "TYE": "TYER",
+    "TT1": "TIT1",
+    "TT3": "TIT3",
+    "TXX": "TXXX",
+    "COM": "COMM",
+    "PIC": "APIC",
+}
+ID3V2_EXTRA_TEXT_FRAMES = ("GRP1", "MVNM", "MVIN")
+ID3V2_ENCODINGS = ("latin-1", "utf-16", "utf-16-be", "utf-8")
+
+MP3_BIT_RATES = {
+    # (MPEG-1, Layer III) and (MPEG-2/2.5, Layer III) in kBit/s
+    True: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    False: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MP3_SAMPLE_RATES = {
+    0b11: (44100, 48000, 32000),
+    0b10: (22050, 24000, 16000),
+    0b00: (11025, 12000, 8000),
+}
+MP3_SYNC_SEARCH_LIMIT = 64 * 1024
+
+
+class UnsupportedFileError(Exception):
+    pass
+
+
+def _rescale(a: int, b: int, c: int) -> int:
+    """Compute a * b / c rounded to the nearest integer, like FFmpeg's av_rescale."""
+    return (a * b + c // 2) // c
+
+
+def _format_duration(seconds: float) -> str:
+    return f"{seconds:f}"
+
+
+def _audio_stream(*, codec_name: str, sample_rate: int, channels: int, bit_rate: int, duration: float) -> ProbeOutput:
+    return {
+        "codec_type": "audio",
+        "codec_name": codec_name,
+        "sample_rate": str(sample_rate),
+        "channels": channels,
+        "bit_rate": str(bit_rate),
+        "duration": _format_duration(duration),
+        "disposition": {"attached_pic": 0},
+    }
+
+
+def _cover_stream() -> ProbeOutput:
+    return {
+        "codec_type": "video",
+        "disposition": {"attached_pic": 1},
+    }
+
+
+def _iter_boxes(data: bytes | memoryview, start: int = 0, end: int | None = None) -> Iterator[tuple[bytes, int, int]]:
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, pos)
+        header = 8
+        if size == 1:
+            (size,) = struct.unpack_from(">Q", data, pos + 8)
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            msg = "Truncated MP4 box"
+            raise UnsupportedFileError(msg)
+        yield bytes(box_type), pos + header, pos + size
+        pos += size
+
+
+def _read_moov(fh: BinaryIO) -> bytes:
+    while header := fh.read(8):
+        if len(header) < 8:
+            break
+        size, box_type = struct.unpack(">I4s", header)
+        header_size = 8
+        if size == 1:
+            (size,) = struct.unpack(">Q", fh.read(8))
+            header_size = 16
+        if box_type == b"moov":
+            if size == 0:
+                return fh.read()
+            return fh.read(size - header_size)
+        if size == 0:
+            break
+        if size < header_size:
+            msg = "Invalid MP4 box size"
+            raise UnsupportedFileError(msg)
+        fh.seek(size - header_size, 1)
+    msg = "No moov box found"
+    raise UnsupportedFileError(msg)
+
+
+def _find_child(data: bytes, start: int, end: int, box_type: bytes) -> tuple[int, int] | None:
+    for child_type, child_start, child_end in _iter_boxes(data, start, end):
+        if child_type == box_type:
+            return child_start, child_end
+    return None
+
+
+def _read_descriptor(data: bytes, pos: int) -> tuple[int, int, int]:
+    tag = data[pos]
+    pos += 1
+    length = 0
+    for _ in range(4):
+        byte = data[pos]
+        pos += 1
+        length = (length << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            break
+    return tag, pos, pos + length
+
+
+class _BitReader:
+    def __init__(self, data: bytes) -> None:
+        self.value = int.from_bytes(data, "big")
+        self.remaining = len(data) * 8
+
+    def read(self, bits: int) -> int:
+        if bits > self.remaining:
+            msg = "AudioSpecificConfig too short"
+            raise UnsupportedFileError(msg)
+        self.remaining -= bits
+        return (self.value >> self.remaining) & ((1 << bits) - 1)
+
+
+def _parse_audio_specific_config(data: bytes) -> tuple[int, int]:
+    reader = _BitReader(data)
+    object_type = reader.read(5)
+    if object_type == 31:
+        object_type = 32 + reader.read(6)
+    if object_type in AAC_SBR_OBJECT_TYPES:
+        msg = "HE-AAC streams are not supported"
+        raise UnsupportedFileError(msg)
+
+    sample_rate_idx = reader.read(4)
+    sample_rate = reader.read(24) if sample_rate_idx == 0xF else AAC_SAMPLE_RATES[sample_rate_idx]
+    channels = reader.read(4)
+    if channels < 1 or channels > 7:
+        msg = "Unsupported AAC channel configuration"
+        raise UnsupportedFileError(msg)
+
+    if object_type in AAC_GA_OBJECT_TYPES:
+        reader.read(1)  # frameLengthFlag
+        if reader.read(1):  # dependsOnCoreCoder
+            reader.read(14)
+        reader.read(1)  # extensionFlag
+        if (
+            reader.remaining >= 16
+            and reader.read(11) == AAC_SYNC_EXTENSION
+            and reader.read(5) in AAC_SBR_OBJECT_TYPES
+            and reader.read(1)
+        ):
+            msg = "HE-AAC streams are not supported"
+            raise UnsupportedFileError(msg)
+
+    if channels == 7:
+        channels = 8
+    return sample_rate, channels
+
+
+def _parse_esds(data: bytes, start: int, end: int) -> tuple[str, int, int] | None:
+    tag, pos, _ = _read_descriptor(data, start + 4)
+    if tag != 0x03:
+        return None
+    flags = data[pos + 2]
+    pos += 3
+    if flags & 0x80:
+        pos += 2
+    if flags & 0x40:
+        pos += 1 + data[pos]
+    if flags & 0x20:
+        pos += 2
+
+    tag, pos, _ = _read_descriptor(data, pos)
+    if tag != 0x04:
+        return None
+    object_type = data[pos]
+    if object_type in MP4_MP3_OBJECT_TYPES:
+        return "mp3", 0, 0
+    if object_type not in MP4_AAC_OBJECT_TYPES:
+        return None
+
+    tag, pos, dsi_end = _read_descriptor(data, pos + 13)
+    if tag != 0x05:
+        return None
+    sample_rate, channels = _parse_audio_specific_config(data[pos:dsi_end])
+    return "aac", sample_rate, channels
+
+
+def _parse_stsd(data: bytes, start: int, end: int) -> tuple[str, int, int] | None:
+    (entries,) = struct.unpack_from(">I", data, start + 4)
+    if entries != 1:
+        return None
+    fmt, entry_start, entry_end = next(_iter_boxes(data, start + 8, end))
+    if fmt != b"mp4a":
+        return None
+
+    version, _, _, channels, _, _, _, sample_rate = struct.unpack_from(">HHIHHHHI", data, entry_start + 8)
+    children_start = entry_start + 28
+    if version == 1:
+        children_start += 16
+    elif version == 2:
+        children_start += 36
+    elif version != 0:
+        return None
+
+    if esds := _find_child(data, children_start, entry_end, b"esds"):
+        parsed = _parse_esds(data, *esds)
+        if parsed and parsed[0] == "mp3":
+            return "mp3", sample_rate >> 16, channels
+        return parsed
+    return None
+
+
+def _parse_stsz(data: bytes, start: int, end: int) -> int:
+    _, sample_size, sample_count = struct.unpack_from(">III", data, start)
+    if sample_size:
+        return sample_size * sample_count
+    return sum(struct.unpack_from(f">{sample_count}I", data, start + 12))
+
+
+def _parse_mdhd(data: bytes, start: int) -> tuple[int, int]:
+    if data[start] == 1:
+        timescale, duration = struct.unpack_from(">IQ", data, start + 20)
+    else:
+        timescale, duration = struct.unpack_from(">II", data, start + 12)
+    return timescale, duration
+
+
+def _parse_mvhd_timescale(data: bytes, start: int) -> int:
+    offset = 20 if data[start] == 1 else 12
+    (timescale,) = struct.unpack_from(">I", data, start + offset)
+    return timescale
+
+
+def _parse_elst_duration(data: bytes, start: int) -> int | None:
+    version = data[start]
+    (entries,) = struct.unpack_from(">I", data, start + 4)
+    fmt, entry_size = (">Qq", 20) if version == 1 else (">Ii", 12)
+    duration = 0
+    for idx in range(entries):
+        segment_duration, media_time = struct.unpack_from(fmt, data, start + 8 + idx * entry_size)
+        if media_time >= 0:
+            duration += segment_duration
+    return duration or None
+
+
+def _parse_trak(data: bytes, start: int, end: int, movie_timescale: int) -> ProbeOutput | None:
+    mdia = _find_child(data, start, end, b"mdia")
+    if not mdia:
+        return None
+    hdlr = _find_child(data, *mdia, b"hdlr")
+    if not hdlr:
+        return None
+    handler = bytes(data[hdlr[0] + 8 : hdlr[0] + 12])
+    if handler != b"soun":
+        return {"codec_type": MP4_HANDLER_TYPES.get(handler, "data")}
+
+    mdhd = _find_child(data, *mdia, b"mdhd")
+    minf = _find_child(data, *mdia, b"minf")
+    stbl = minf and _find_child(data, *minf, b"stbl")
+    stsd = stbl and _find_child(data, *stbl, b"stsd")
+    stsz = stbl and _find_child(data, *stbl, b"stsz")
+    if not mdhd or not stsd or not stsz:
+        msg = "Incomplete audio track"
+        raise UnsupportedFileError(msg)
+
+    codec = _parse_stsd(data, *stsd)
+    if not codec:
+        msg = "Unsupported audio codec"
+        raise UnsupportedFileError(msg)
+    codec_name, sample_rate, channels = codec
+
+    timescale, media_duration_ts = _parse_mdhd(data, mdhd[0])
+    duration_ts = media_duration_ts
+    edts = _find_child(data, start, end, b"edts")
+    elst = edts and _find_child(data, *edts, b"elst")
+    if elst and (edited := _parse_elst_duration(data, elst[0])):
+        duration_ts = min(duration_ts, _rescale(edited, timescale, movie_timescale))
+    if not timescale or not duration_ts:
+        msg = "Audio track has no duration"
+        raise UnsupportedFileError(msg)
+
+    # FFmpeg derives the bit rate from the unedited media duration, only the duration is trimmed by the edit list.
+    # Unlike av_rescale, its division truncates.
+    return _audio_stream(
+        codec_name=codec_name,
+        sample_rate=sample_rate,
+        channels=channels,
+        bit_rate=_parse_stsz(data, *stsz) * timescale * 8 // media_duration_ts,
+        duration=duration_ts / timescale,
+    )
+
+
+def _parse_ilst_item(data: bytes, item_type: bytes, start: int, end: int) -> tuple[str, str] | None:
+    key = MP4_ILST_TAGS.get(item_type) or MP4_ILST_NUMBERED_TAGS.get(item_type)
+    value: str | None = None
+    for child_type, child_start, child_end in _iter_boxes(data, start, end):
+        if child_type == b"name" and item_type == b"----":
+            key = data[child_start + 4 : child_end].decode("utf-8")
+        elif child_type == b"data" and value is None:
+            payload = data[child_start + 8 : child_end]
+            if item_type in MP4_ILST_NUMBERED_TAGS:
+                number, total = struct.unpack_from(">HH", payload, 2)
+                value = f"{number}/{total}" if total else str(number)
+            elif data[child_start + 3] == 1:
+                value = payload.decode("utf-8")
+
+    if key and value is not None:
+        return key, value
+    return None
+
+
+def _parse_ilst(data: bytes, start: int, end: int) -> tuple[dict[str, str], bool]:
+    tags: dict[str, str] = {}
+    has_cover = False
+    for item_type, item_start, item_end in _iter_boxes(data, start, end):
+        if item_type == b"covr":
+            has_cover = True
+        elif item_type == b"gnre":
+            msg = "Numeric genres are not supported"
+            raise UnsupportedFileError(msg)
+        elif tag := _parse_ilst_item(data, item_type, item_start, item_end):
+            tags.setdefault(*tag)
+    return tags, has_cover
+
+
+def _parse_udta(data: bytes, start: int, end: int) -> tuple[dict[str, str], bool]:
+    meta = _find_child(data, start, end, b"meta")
+    if not meta:
+        return {}, False
+    meta_start, meta_end = meta
+    if data[meta_start + 4 : meta_start + 8] != b"hdlr":
+        # ISO-style meta boxes are full boxes, QuickTime-style ones are not.
+        meta_start += 4
+    hdlr = _find_child(data, meta_start, meta_end, b"hdlr")
+    if hdlr and data[hdlr[0] + 8 : hdlr[0] + 12] == b"mdta":
+        msg = "QuickTime metadata keys are not supported"
+        raise UnsupportedFileError(msg)
+
+    ilst = _find_child(data, meta_start, meta_end, b"ilst")
+    if not ilst:
+        return {}, False
+    return _parse_ilst(data, *ilst)
+
+
+def _probe_mp4(fh: BinaryIO) -> ProbeOutput:
+    moov = _read_moov(fh)
+    movie_timescale = 0
+    streams: list[ProbeOutput] = []
+    tags: dict[str, str] = {}
+    has_cover = False
+    for box_type, start, end in _iter_boxes(moov):
+        if box_type == b"mvhd":
+            movie_timescale = _parse_mvhd_timescale(moov, start)
+        elif box_type == b"trak":
+            if not movie_timescale:
+                msg = "Track precedes movie header"
+                raise UnsupportedFileError(msg)
+            if stream := _parse_trak(moov, start, end, movie_timescale):
+                streams.append(stream)
+        elif box_type == b"udta":
+            tags, has_cover = _parse_udta(moov, start, end)
+
+    if has_cover:
+        streams.append(_cover_stream())
+    return {"streams": streams, "format": {"tags": tags}}
+
+
+def _unsynchronize(data: bytes) -> bytes:
+    return data.replace(b"\xff\x00", b"\xff")
+
+
+def _syncsafe(data: bytes) -> int:
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def _decode_id3_string(data: bytes, encoding: int) -> tuple[str, bytes]:
+    """Decode a terminated string from data, returning it with the remaining bytes."""
+    terminator = b"\x00\x00" if encoding in (1, 2) else b"\x00"
+    end = 0
+    while (end := data.find(terminator, end)) >= 0 and len(terminator) == 2 and end % 2:
+        end += 1
+    if end < 0:
+        value, rest = data, b""
+    else:
+        value, rest = data[:end], data[end + len(terminator) :]
+    return value.decode(ID3V2_ENCODINGS[encoding]), rest
+
+
+def _parse_id3v2_frames(data: bytes, major: int) -> Iterator[tuple[str, bytes]]:
+    pos = 0
+    id_len, header_len = (3, 6) if major == 2 else (4, 10)
+    while pos + header_len <= len(data):
+        frame_id = data[pos : pos + id_len]
+        if not frame_id.strip(b"\x00") or not frame_id.isalnum():
+            break
+        if major == 2:
+            size = int.from_bytes(data[pos + 3 : pos + 6], "big")
+            flags = 0
+        elif major == 4:
+            size = _syncsafe(data[pos + 4 : pos + 8])
+            flags = int.from_bytes(data[pos + 8 : pos + 10], "big")
+        else:
+            size = int.from_bytes(data[pos + 4 : pos + 8], "big")
+            flags = int.from_bytes(data[pos + 8 : pos + 10], "big")
+
+        payload = data[pos + header_len : pos + header_len + size]
+        pos += header_len + size
+
+        if major == 4 and flags & 0x0002:
+            payload = _unsynchronize(payload)
+        if (major == 3 and flags & 0x00C0) or (major == 4 and flags & 0x000D):
+            msg = "Compressed or encrypted ID3v2 frames are not supported"
+            raise UnsupportedFileError(msg)
+        if major == 4 and flags & 0x0040:
+            payload = payload[1:]
+
+        frame = frame_id.decode("ascii")
+        if major == 2:
+            frame = ID3V22_TAGS.get(frame, frame)
+        yield frame, payload
+
+
+def _parse_id3v2_tag(frame: str, payload: bytes, major: int) -> tuple[str, str] | None:
+    if not payload or payload[0] >= len(ID3V2_ENCODINGS):
+        return None
+
+    encoding = payload[0]
+    if frame in ("TXXX", "COMM"):
+        rest = payload[1:] if frame == "TXXX" else payload[4:]
+        key, rest = _decode_id3_string(rest, encoding)
+        value, _ = _decode_id3_string(rest, encoding)
+        key = key or ("comment" if frame == "COMM" else "")
+    elif frame.startswith("T") or frame in ID3V2_EXTRA_TEXT_FRAMES:
+        value, _ = _decode_id3_string(payload[1:], encoding)
+        key = ID3V2_TAGS.get(frame) or (ID3V24_TAGS.get(frame) if major == 4 else None) or frame
+    else:
+        return None
+
+    if key == "genre" and value.strip("()").isdigit():
+        msg = "Numeric genres are not supported"
+        raise UnsupportedFileError(msg)
+    if key and value:
+        return key, value
+    return None
+
+
+def _read_id3v2_data(fh: BinaryIO) -> tuple[bytes, int, int]:
+    """Return the frame data of a leading ID3v2 tag, its major version, and the offset of the audio data."""
+    header = fh.read(10)
+    if len(header) < 10 or header[:3] != b"ID3":
+        return b"", 0, 0
+
+    major, flags = header[3], header[5]
+    if major < 2 or major > 4:
+        msg = "Unknown ID3v2 version"
+        raise UnsupportedFileError(msg)
+
+    size = _syncsafe(header[6:10])
+    data = fh.read(size)
+    if major < 4 and flags & 0x80:
+        data = _unsynchronize(data)
+    if flags & 0x40 and major == 3:
+        data = data[4 + int.from_bytes(data[:4], "big") :]
+    elif flags & 0x40 and major == 4:
+        data = data[_syncsafe(data[:4]) :]
+    return data, major, 10 + size + (10 if flags & 0x10 else 0)
+
+
+def _parse_id3v2(fh: BinaryIO) -> tuple[dict[str, str], bool, int]:
+    data, major, offset = _read_id3v2_data(fh)
+    if not data:
+        return {}, False, offset
+
+    tags: dict[str, str] = {}
+    has_cover = False
+    for frame, payload in _parse_id3v2_frames(data, major):
+        if frame == "APIC":
+            has_cover = True
+        elif tag := _parse_id3v2_tag(frame, payload, major):
+            tags.setdefault(*tag)
+
+    if year := tags.pop("TYER", None):
+        tags.setdefault("date", year)
+        if (day_month := tags.pop("TDAT", None)) and len(day_month) == 4:
+            tags["date"] = f"{year}-{day_month[2:]}-{day_month[:2]}"
+    return tags, has_cover, offset
+
+
+def _parse_mp3_header(header: int) -> tuple[int, int, int, int, int] | None:
+    """Return bit rate, sample rate, channels, samples per frame, and frame length of an MPEG audio frame."""
+    if header >> 21 != 0x7FF:
+        return None
+    version = (header >> 19) & 0b11
+    layer = (header >> 17) & 0b11
+    bit_rate_idx = (header >> 12) & 0xF
+    sample_rate_idx = (header >> 10) & 0b11
+    if version == 0b01 or layer != 0b01 or bit_rate_idx in (0, 0xF) or sample_rate_idx == 0b11:
+        return None
+
+    mpeg1 = version == 0b11
+    bit_rate = MP3_BIT_RATES[mpeg1][bit_rate_idx] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][sample_rate_idx]
+    padding = (header >> 9) & 1
+    channels = 1 if (header >> 6) & 0b11 == 0b11 else 2
+    samples_per_frame = 1152 if mpeg1 else 576
+    frame_length = (samples_per_frame // 8) * bit_rate // sample_rate + padding
+    return bit_rate, sample_rate, channels, samples_per_frame, frame_length
+
+
+def _find_mp3_frame(fh: BinaryIO, offset: int) -> tuple[int, bytes, tuple[int, int, int, int, int]]:
+    fh.seek(offset)
+    data = fh.read(MP3_SYNC_SEARCH_LIMIT)
+    pos = 0
+    while (pos := data.find(b"\xff", pos)) >= 0 and pos + 4 <= len(data):
+        params = _parse_mp3_header(int.from_bytes(data[pos : pos + 4], "big"))
+        if params:
+            next_pos = pos + params[4]
+            # Require a second valid frame header to rule out false syncs.
+            if next_pos + 4 > len(data) or _parse_mp3_header(int.from_bytes(data[next_pos : next_pos + 4], "big")):
+                return offset + pos, data[pos:], params
+        pos += 1
+    msg = "No MPEG audio frame found"
+    raise UnsupportedFileError(msg)
+
+
+def _parse_vbr_header(frame: bytes, *, mpeg1: bool, channels: int) -> tuple[int | None, int | None, bool]:
+    """Return frame count, byte count, and whether the stream is CBR from a Xing/Info or VBRI header."""
+    side_info = (17 if channels == 1 else 32) if mpeg1 else (9 if channels == 1 else 17)
+    xing_pos = 4 + side_info
+    tag = frame[xing_pos : xing_pos + 4]
+    if tag in (b"Xing", b"Info"):
+        (flags,) = struct.unpack_from(">I", frame, xing_pos + 4)
+        pos = xing_pos + 8
+        frames = size = None
+        if flags & 0x1:
+            (frames,) = struct.unpack_from(">I", frame, pos)
+            pos += 4
+        if flags & 0x2:
+            (size,) = struct.unpack_from(">I", frame, pos)
+        return frames, size, tag == b"Info"
+
+    if frame[36:40] == b"VBRI":
+        size, frames = struct.unpack_from(">II", frame, 46)
+        return frames, size, False
+
+    return None, None, True
+
+
+def _next_mp3_frame_bit_rate(frame: bytes, frame_length: int) -> int:
+    params = _parse_mp3_header(int.from_bytes(frame[frame_length : frame_length + 4], "big"))
+    if not params:
+        msg = "No MPEG audio frame follows the Info header"
+        raise UnsupportedFileError(msg)
+    return params[0]
+
+
+def _probe_mp3(fh: BinaryIO, file_size: int) -> ProbeOutput:
+    tags, has_cover, offset = _parse_id3v2(fh)
+    if file_size >= 128:
+        fh.seek(-128, 2)
+        if fh.read(3) == b"TAG" and not tags:
+            msg = "ID3v1 tags are not supported"
+            raise UnsupportedFileError(msg)
+    if file_size >= 32:
+        fh.seek(max(0, file_size - 128 - 32))
+        if b"APETAGEX" in fh.read(160):
+            msg = "APE tags are not supported"
+            raise UnsupportedFileError(msg)
+
+    _, frame, (bit_rate, sample_rate, channels, samples_per_frame, frame_length) = _find_mp3_frame(fh, offset)
+    frames, size, is_cbr = _parse_vbr_header(frame, mpeg1=samples_per_frame == 1152, channels=channels)
+    if frames:
+        duration = frames * samples_per_frame / sample_rate
+        if size and not is_cbr:
+            bit_rate = _rescale(size, 8 * sample_rate, frames * samples_per_frame)
+        elif is_cbr:
+            # LAME pads the Info frame to at least 56 kBit/s, the stream's rate is that of the first audio frame.
+            bit_rate = _next_mp3_frame_bit_rate(frame, frame_length)
+    else:
+        duration = (file_size - offset) * 8 / bit_rate
+
+    streams = [
+        _audio_stream(
+            codec_name="mp3",
+            sample_rate=sample_rate,
+            channels=channels,
+            bit_rate=bit_rate,
+            duration=duration,
+        )
+    ]
+    if has_cover:
+        streams.append(_cover_stream())
+    return {"streams": streams, "format": {"tags": tags}}
+
+
+def probe(file: Path) -> ProbeOutput | None:
+    """Probe file from its headers, returning None if it cannot be handled natively."""
+    try:
+        with file.open("rb") as fh:
+            magic = fh.read(12)
+            fh.seek(0)
+            if magic[4:8] == b"ftyp":
+                return _probe_mp4(fh)
+            if magic[:3] == b"ID3" or _parse_mp3_header(int.from_bytes(magic[:4], "big")):
+                return _probe_mp3(fh, file.stat().st_size)
+    except (UnsupportedFileError, struct.error, IndexError, ValueError, UnicodeDecodeError) as exc:
+        logger.debug("Falling back to ffprobe for {}: {}", file, exc)
+    return None
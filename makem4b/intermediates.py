@@ -1,5 +1,8 @@
 from __future__ import annotations
 
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextvars import copy_context
 from typing import TYPE_CHECKING
 
 from rich.progress import Progress
@@ -12,12 +15,120 @@ from makem4b.utils import TaskProgress, escape_concat_filename, pinfo
 if TYPE_CHECKING:
     from pathlib import Path
 
-    from makem4b.types import ProbeResult
+    from makem4b.cache import IntermediateCache
+    from makem4b.types import ProbedFile, ProbeResult
+
+
+def _intermediate_path(tmpdir: Path, idx: int) -> Path:
+    return tmpdir / f"intermediate_{idx:05d}.ts"
+
+
+def _generate_intermediate(
+    file: ProbedFile,
+    args: list[str],
+    *,
+    output: Path,
+    progress: Progress,
+    kind: ffmpeg.JobKind,
+    group: ffmpeg.ProcessGroup,
+    fixed_duration: int | None = None,
+    cache: IntermediateCache | None = None,
+) -> int:
+    if cache and (duration_ts := cache.get(file.filename, args, output=output)) is not None:
+        return duration_ts
+
+    # An intermediate left by an earlier run may be hard linked into the cache, FFmpeg would
+    # overwrite the cached one along with it. Named pipes are left for FFmpeg to write to.
+    if not output.is_fifo():
+        output.unlink(missing_ok=True)
+    ffmpeg.convert(
+        [file.filename],
+        args,
+        output=output,
+        progress=TaskProgress.make(
+            progress,
+            # FFmpeg does not report out_time reliably while writing mpeg2ts, so we're
+            # falling back to a very crude approximation of progress via total_size.
+            total=1.1 * file.stream.approx_size,
+            description=file.filename.name,
+        ),
+        kind=kind,
+        group=group,
+    )
+    # The out_time FFmpeg reports at the end leaves out the encoder delay and the last frame
+    # written to mpegts, which vary with the input, so intermediates are probed. Those padded
+    # or trimmed to a fixed duration (which may be named pipes) are of a known length instead.
+    duration_ts = fixed_duration if fixed_duration is not None else ffmpeg.probe_duration(output)
+    if cache:
+        cache.set(file.filename, args, output=output, duration_ts=duration_ts)
+    return duration_ts
+
+
+def requires_transcode(probed: ProbeResult, *, prefer_remux: bool) -> bool:
+    if not probed.processing_params:
+        msg = "Processing parameters cannot be unset."
+        raise RuntimeError(msg)
+
+    mode, _ = probed.processing_params
+    return mode == ProcessingMode.TRANSCODE_MIXED or (mode == ProcessingMode.TRANSCODE_UNIFORM and not prefer_remux)
+
+
+def requires_intermediates(probed: ProbeResult) -> bool:
+    if not probed.processing_params:
+        msg = "Processing parameters cannot be unset."
+        raise RuntimeError(msg)
+
+    mode, _ = probed.processing_params
+    return mode != ProcessingMode.REMUX
+
+
+def supports_pipes(probed: ProbeResult) -> bool:
+    """Return whether the length of transcoded intermediates is known in advance, as named pipes require."""
+    if not probed.processing_params:
+        msg = "Processing parameters cannot be unset."
+        raise RuntimeError(msg)
+
+    _, codec = probed.processing_params
+    return ffmpeg.select_transcoding_params(codec).encoder in ffmpeg.ENCODER_DELAYS
+
+
+def make_intermediate_pipes(probed: ProbeResult, *, tmpdir: Path) -> list[Path] | None:
+    """Create named pipes in place of intermediate files, returning None where unsupported."""
+    if not hasattr(os, "mkfifo"):
+        return None
+
+    pipes = [_intermediate_path(tmpdir, idx) for idx in range(1, len(probed) + 1)]
+    try:
+        for pipe in pipes:
+            pipe.unlink(missing_ok=True)
+            os.mkfifo(pipe)
+    except OSError as exc:
+        pinfo(Emoji.INFO, f"Named pipes not supported, using intermediate files ({exc})", style="yellow")
+        for pipe in pipes:
+            pipe.unlink(missing_ok=True)
+        return None
+    return pipes
 
 
 def generate_intermediates(
-    probed: ProbeResult, *, tmpdir: Path, prefer_remux: bool, disable_progress: bool = False
+    probed: ProbeResult,
+    *,
+    tmpdir: Path,
+    prefer_remux: bool,
+    jobs: int = 1,
+    fixed_durations: list[int] | None = None,
+    group: ffmpeg.ProcessGroup | None = None,
+    cache: IntermediateCache | None = None,
+    disable_progress: bool = False,
 ) -> tuple[list[Path], list[int]]:
+    """Generate intermediates for all probed files concurrently.
+
+    If fixed_durations are given, transcoded intermediates are padded or trimmed to them, and last as long
+    as ffmpeg.transcoded_duration returns for them. Remuxed ones are probed for their duration and must
+    not be named pipes therefore. Passing
+    a group allows the caller to kill the conversions together with processes of its own. Passing
+    a cache reuses the intermediates of previous runs, and stores the newly generated ones.
+    """
     if not probed.processing_params:
         msg = "Processing parameters cannot be unset."
         raise RuntimeError(msg)
@@ -29,33 +140,60 @@ def generate_intermediates(
         pinfo(Emoji.REMUX, "Using input files as-is", specs_msg)
         return [f.filename for f in probed.files], [f.stream.duration_ts for f in probed.files]
 
-    if mode == ProcessingMode.REMUX_FIX_DTS or (mode == ProcessingMode.TRANSCODE_UNIFORM and prefer_remux):
+    transcode = requires_transcode(probed, prefer_remux=prefer_remux)
+    if transcode:
+        args = ffmpeg.make_transcoding_args(codec)
+    else:
         pinfo(Emoji.AVOIDING_TRANSCODE, "Remuxing", specs_msg)
         args = ffmpeg.COPY_CMD_ARGS
-    else:
-        args = ffmpeg.make_transcoding_args(codec)
 
-    intermediates: list[Path] = []
-    durations: list[int] = []
-    with Progress(transient=True, disable=disable_progress) as progress:
-        for idx, file in enumerate(progress.track(probed, description="Processing files"), 1):
-            outfilen = tmpdir / f"intermediate_{idx:05d}.ts"
-            ffmpeg.convert(
-                [file.filename],
-                args,
+    intermediates = [_intermediate_path(tmpdir, idx) for idx in range(1, len(probed) + 1)]
+    file_args = [args] * len(probed)
+    file_durations: list[int | None] = [None] * len(probed)
+    if fixed_durations and transcode:
+        params = ffmpeg.select_transcoding_params(codec)
+        file_args = [
+            [*args, "-af", ffmpeg.make_transcoded_duration_filter(duration_ts, params)]
+            for duration_ts in fixed_durations
+        ]
+        file_durations = [ffmpeg.transcoded_duration(duration_ts, params) for duration_ts in fixed_durations]
+    kind = ffmpeg.JobKind.TRANSCODE if transcode else ffmpeg.JobKind.REMUX
+    group = group or ffmpeg.ProcessGroup()
+    with (
+        Progress(transient=True, disable=disable_progress) as progress,
+        ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="intermediate") as executor,
+    ):
+        overall = TaskProgress.make(progress, total=len(intermediates), description="Processing files")
+        futures = [
+            executor.submit(
+                copy_context().run,
+                _generate_intermediate,
+                file,
+                fargs,
                 output=outfilen,
-                progress=TaskProgress.make(
-                    progress,
-                    # FFmpeg does not report out_time when writing mpeg2ts, so we're
-                    # falling back to a very crude approximation of progress via total_size.
-                    total=1.1 * file.stream.approx_size,
-                    description=file.filename.name,
-                ),
+                progress=progress,
+                kind=kind,
+                group=group,
+                fixed_duration=fixed_duration,
+                cache=cache,
             )
-            duration_ts = ffmpeg.probe_duration(outfilen)
-            intermediates.append(outfilen)
-            durations.append(duration_ts)
-    return intermediates, durations
+            for file, fargs, fixed_duration, outfilen in zip(
+                probed, file_args, file_durations, intermediates, strict=True
+            )
+        ]
+        try:
+            for future in as_completed(futures):
+                future.result()
+                overall.update(advance=1)
+        except BaseException:
+            # Stop all siblings of the failed conversion and remove their partial output.
+            group.kill()
+            executor.shutdown(wait=True, cancel_futures=True)
+            for outfilen in intermediates:
+                outfilen.unlink(missing_ok=True)
+            raise
+
+    return intermediates, [future.result() for future in futures]
 
 
 def generate_concat_file(intermediates: list[Path], *, tmpdir: Path) -> Path:
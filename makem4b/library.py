@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+from typing import TYPE_CHECKING, Any, NamedTuple, Self
+
+from loguru import logger
+
+if TYPE_CHECKING:
+    import os
+    from collections.abc import Iterable
+    from pathlib import Path
+    from types import TracebackType
+
+LIBRARY_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    directory TEXT PRIMARY KEY,
+    inputs TEXT NOT NULL,
+    output TEXT NOT NULL,
+    settings TEXT NOT NULL,
+    processed REAL NOT NULL
+);
+"""
+
+
+class IndexedBook(NamedTuple):
+    inputs: str
+    output: str
+    settings: str
+
+
+def fingerprint_inputs(entries: Iterable[os.DirEntry[str]]) -> str:
+    """Fingerprint the names, sizes, and mtimes of the given directory entries."""
+    stats = sorted((entry.name, (stat := entry.stat()).st_size, stat.st_mtime_ns) for entry in entries)
+    return json.dumps(stats, separators=(",", ":"))
+
+
+def serialize_settings(**settings: Any) -> str:
+    return json.dumps(settings, sort_keys=True, separators=(",", ":"))
+
+
+class LibraryIndex:
+    """Persistent record of the directories processed into audiobooks, keyed by absolute path.
+
+    Each entry holds the fingerprint of the inputs, the output path, and the settings used, so
+    that unchanged directories can be skipped without probing. Entries are committed right away,
+    the index is safe to share between the threads processing books.
+    """
+
+    def __init__(self, db_file: Path) -> None:
+        db_file.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.executescript(LIBRARY_INDEX_SCHEMA)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def get(self, dirpath: Path) -> IndexedBook | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT inputs, output, settings FROM books WHERE directory = ?",
+                (str(dirpath.absolute()),),
+            ).fetchone()
+        return IndexedBook(*row) if row else None
+
+    def set(self, dirpath: Path, book: IndexedBook) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO books (directory, inputs, output, settings, processed) VALUES (?, ?, ?, ?, ?)",
+                (str(dirpath.absolute()), *book, time.time()),
+            )
+            self._conn.commit()
+        logger.debug("Recorded {} in library index", dirpath)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
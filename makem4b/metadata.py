@@ -29,9 +29,9 @@ def generate_metadata(files: list[ProbedFile], *, durations: list[int], tmpdir:
     with metadata_file.open("w") as fh:
         fh.write(FFMPEG_METADATA_HEADER)
         for (idx, start_ts, end_ts), file in zip(enumerate_timestamped_files(durations), files, strict=True):
-            if idx == 0:
+            if idx == 0 and file.metadata:
                 fh.write(file.metadata.to_tags())
-            fh.write(file.metadata.to_chapter(start_ts, end_ts))
+            fh.write(file.to_chapter(start_ts, end_ts))
         fh.flush()
     return metadata_file
 
@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import bisect
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import TYPE_CHECKING, Self
+
+from loguru import logger
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+    from types import TracebackType
+
+DURATION_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 600.0, 1800.0, 3600.0)
+SPEED_BUCKETS = (1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0, 500.0, 1000.0)
+
+Labels = tuple[str, ...]
+
+
+def _format_labels(names: Labels, values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values, strict=True)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric(ABC):
+    """Base of the metrics, holding one value per combination of label values."""
+
+    kind = ""
+
+    def __init__(self, name: str, description: str, labelnames: Labels = ()) -> None:
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+
+    def _check_labels(self, labels: Labels) -> None:
+        if len(labels) != len(self.labelnames):
+            msg = f"Metric {self.name} expects labels {self.labelnames}, got {labels}"
+            raise ValueError(msg)
+
+    @abstractmethod
+    def samples(self) -> Iterator[str]: ...
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}", *self.samples()]
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labelnames: Labels = ()) -> None:
+        super().__init__(name, description, labelnames)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._check_labels(labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        if not values and not self.labelnames:
+            values = [((), 0)]
+        for labels, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labelnames: Labels = (), *, buckets: tuple[float, ...]) -> None:
+        super().__init__(name, description, labelnames)
+        self.buckets = buckets
+        # Per combination of labels: count per bucket (the last one being +Inf), and the sum.
+        self._values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        self._check_labels(labels)
+        with self._lock:
+            counts, total = self._values.setdefault(labels, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted((labels, (counts.copy(), total[0])) for labels, (counts, total) in self._values.items())
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip([*map(_format_value, self.buckets), "+Inf"], counts, strict=True):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, f'le="{bound}"')} {cumulative}"
+            label_str = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{label_str} {_format_value(total)}"
+            yield f"{self.name}_count{label_str} {cumulative}"
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: list[Metric] = []
+
+    def register[M: Metric](self, metric: M) -> M:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "".join(metric.render() for metric in self.metrics)
+
+
+registry = Registry()
+
+books = registry.register(Counter("makem4b_books_total", "Books that finished processing, by outcome.", ("status",)))
+book_errors = registry.register(
+    Counter("makem4b_book_errors_total", "Books that were not processed, by exit code.", ("exit_code",))
+)
+books_in_progress = registry.register(Gauge("makem4b_books_in_progress", "Books currently being processed."))
+files_probed = registry.register(
+    Counter("makem4b_files_probed_total", "Files probed, by where their probe came from.", ("source",))
+)
+bytes_read = registry.register(Counter("makem4b_read_bytes_total", "Size of the input files of finished books."))
+bytes_written = registry.register(Counter("makem4b_written_bytes_total", "Size of the output files of finished books."))
+ffmpeg_processes = registry.register(Gauge("makem4b_ffmpeg_processes", "FFmpeg and FFprobe processes running."))
+ffmpeg_speed = registry.register(
+    Histogram(
+        "makem4b_ffmpeg_speed_ratio",
+        "Realtime factor of finished FFmpeg runs, as reported by FFmpeg.",
+        buckets=SPEED_BUCKETS,
+    )
+)
+step_duration = registry.register(
+    Histogram(
+        "makem4b_step_duration_seconds",
+        "Duration of the processing steps of books.",
+        ("step",),
+        buckets=DURATION_BUCKETS,
+    )
+)
+
+
+def write_textfile(file: Path, content: str) -> None:
+    """Replace file atomically, so that collectors never read a partially written file."""
+    with tempfile.NamedTemporaryFile("w", dir=file.parent, prefix=f".{file.name}.", delete=False) as tmp:
+        tmp.write(content)
+    try:
+        Path(tmp.name).chmod(0o644)
+        Path(tmp.name).replace(file)
+    except OSError:
+        Path(tmp.name).unlink(missing_ok=True)
+        raise
+
+
+class MetricsFile:
+    """Rewrite a file with the metrics in Prometheus' text format periodically, and once more when closing.
+
+    The file is suitable for node_exporter's textfile collector.
+    """
+
+    def __init__(self, file: Path, *, interval: float, metrics: Registry = registry) -> None:
+        self.file = file
+        self.interval = interval
+        self.metrics = metrics
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+
+    def __enter__(self) -> Self:
+        self.write()
+        self._thread.start()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        self._stopped.set()
+        self._thread.join()
+        self.write()
+
+    def write(self) -> None:
+        try:
+            write_textfile(self.file, self.metrics.render())
+        except OSError as exc:
+            logger.warning("Failed to write metrics to {}: {}", self.file, exc)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.write()
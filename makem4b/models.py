@@ -14,7 +14,6 @@ from pydantic import (
     model_validator,
 )
 
-from makem4b import constants
 from makem4b.utils import escape_ffmetadata, parse_grouping
 
 
@@ -31,7 +30,7 @@ class _StreamDisposition(BaseModel):
 class BaseStream(BaseModel):
     model_config = ConfigDict(extra="ignore")
 
-    disposition: _StreamDisposition = _StreamDisposition()
+    disposition: _StreamDisposition = Field(default_factory=_StreamDisposition)
     codec_type: str
 
 
@@ -45,16 +44,7 @@ class AudioStream(BaseStream):
     channels: int
     duration: float
 
-    side_data_list: list[dict[str, Any]] = []
-
-    @property
-    def duration_ts(self) -> int:
-        return round(self.duration * constants.TIMEBASE)
-
-    @property
-    def approx_size(self) -> int:
-        bps = self.bit_rate / 8
-        return round(self.duration * bps)
+    side_data_list: list[dict[str, Any]] = Field(default_factory=list)
 
     def __eq__(self, o: object) -> bool:
         if isinstance(o, AudioStream):
@@ -133,15 +123,6 @@ class Metadata(BaseModel):
         ]
         return "\n".join(tags) + "\n"
 
-    def to_chapter(self, start_ts: int, end_ts: int) -> str:
-        props = [
-            constants.CHAPTER_HEADER,
-            f"START={start_ts}",
-            f"END={end_ts}",
-            f"title={self.title}",
-        ]
-        return "\n" + "\n".join(props) + "\n"
-
 
 StreamOrNone = Annotated[AudioStream | BaseStream | None, WrapValidator(validate_stream)]
 
@@ -153,3 +134,24 @@ class FFProbeFormat(BaseModel):
 class FFProbeOutput(BaseModel):
     streams: list[StreamOrNone] = []
     format_: FFProbeFormat = Field(alias="format")
+
+    @classmethod
+    def decode(cls, output: str | dict[str, Any], *, context: dict[str, Any] | None = None) -> FFProbeOutput:
+        """Validate FFprobe output, given as JSON or already parsed.
+
+        Most of the time of validating goes into calling validate_stream for each stream. Output whose streams
+        all validate is decoded without it, only output with an unusable stream is validated again in full.
+        """
+        try:
+            if isinstance(output, str):
+                return _StrictFFProbeOutput.model_validate_json(output, context=context)
+            return _StrictFFProbeOutput.model_validate(output, context=context)
+        except ValidationError:
+            if isinstance(output, str):
+                return cls.model_validate_json(output, context=context)
+            return cls.model_validate(output, context=context)
+
+
+# Fails on unusable streams instead of dropping them, but is validated entirely by pydantic-core.
+class _StrictFFProbeOutput(FFProbeOutput):
+    streams: list[AudioStream | BaseStream] = []  # type: ignore[assignment]
@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from concurrent.futures import CancelledError
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Self
+
+from loguru import logger
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from types import TracebackType
+
+
+@dataclass
+class StageStats:
+    name: str
+    workers: int
+    items: int = 0
+    busy: float = 0.0
+    blocked: float = 0.0
+    max_depth: int = 0
+    depth_sum: int = 0
+    depth_samples: int = 0
+
+    @property
+    def mean_depth(self) -> float:
+        return self.depth_sum / self.depth_samples if self.depth_samples else 0.0
+
+    def utilization(self, elapsed: float) -> float:
+        """Share of the elapsed time the stage's workers spent processing items."""
+        return self.busy / (self.workers * elapsed) if elapsed > 0 else 0.0
+
+
+@dataclass
+class Stage[T]:
+    name: str
+    func: Callable[[T], bool]
+    workers: int = 1
+
+
+class Pipeline[T]:
+    """Pass items through a sequence of stages, each with its own workers and a bounded input queue.
+
+    A stage returns False to have an item leave the pipeline early. When an item leaves the pipeline,
+    be it after the last stage, early, or by raising, on_finish is called with the item and the exception
+    raised, if any. Putting an item blocks while the first stage's queue is full, and workers block while
+    the next stage's queue is full, which is counted as the stage being blocked.
+    """
+
+    def __init__(
+        self,
+        stages: list[Stage[T]],
+        *,
+        on_finish: Callable[[T, BaseException | None], None],
+        maxsize: int = 1,
+    ) -> None:
+        self.stages = stages
+        self.stats = [StageStats(name=stage.name, workers=stage.workers) for stage in stages]
+        self.on_finish = on_finish
+        # None marks the end of the items for one worker.
+        self._queues: list[queue.Queue[T | None]] = [queue.Queue(maxsize=maxsize) for _ in stages]
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._started = 0.0
+        self.elapsed = 0.0
+        self._workers = [
+            [
+                threading.Thread(target=self._work, args=(idx,), name=f"{stage.name}-{worker}")
+                for worker in range(stage.workers)
+            ]
+            for idx, stage in enumerate(stages)
+        ]
+
+    def __enter__(self) -> Self:
+        self._started = time.monotonic()
+        for workers in self._workers:
+            for worker in workers:
+                worker.start()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        if exc_val:
+            self._cancelled.set()
+        self.close()
+
+    def put(self, item: T) -> None:
+        self._put(0, item)
+
+    def close(self) -> None:
+        """Wait for all items to pass the pipeline, shutting down the stages one after another."""
+        for idx, workers in enumerate(self._workers):
+            for _ in workers:
+                self._queues[idx].put(None)
+            for worker in workers:
+                worker.join()
+        self.elapsed = time.monotonic() - self._started
+
+    def _put(self, idx: int, item: T) -> None:
+        self._queues[idx].put(item)
+        depth = self._queues[idx].qsize()
+        stats = self.stats[idx]
+        with self._lock:
+            stats.max_depth = max(stats.max_depth, depth)
+            stats.depth_sum += depth
+            stats.depth_samples += 1
+
+    def _finish(self, item: T, exc: BaseException | None) -> None:
+        try:
+            self.on_finish(item, exc)
+        except Exception as finish_exc:  # noqa: BLE001
+            logger.opt(exception=finish_exc).error("Failed to finish pipeline item")
+
+    def _work(self, idx: int) -> None:
+        stage, stats = self.stages[idx], self.stats[idx]
+        is_last = idx == len(self.stages) - 1
+        while (item := self._queues[idx].get()) is not None:
+            if self._cancelled.is_set():
+                self._finish(item, CancelledError())
+                continue
+
+            started = time.monotonic()
+            error: Exception | None = None
+            try:
+                proceed = stage.func(item)
+            except Exception as exc:  # noqa: BLE001
+                proceed, error = False, exc
+            finished = time.monotonic()
+            with self._lock:
+                stats.items += 1
+                stats.busy += finished - started
+
+            if not proceed or is_last:
+                self._finish(item, error)
+                continue
+
+            self._put(idx + 1, item)
+            with self._lock:
+                stats.blocked += time.monotonic() - finished
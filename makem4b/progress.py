@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import re
+from collections import deque
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Self
+
+if TYPE_CHECKING:
+    import asyncio
+    from collections.abc import AsyncGenerator
+
+re_progress = re.compile(r"^(?P<key>[a-z_]+)=(?P<value>.*)$")
+re_speed = re.compile(r"^(?P<value>\d+(\.\d+)?)x$")
+re_bitrate = re.compile(r"^(?P<value>\d+(\.\d+)?)kbits/s$")
+
+STDERR_TAIL_LINES = 20
+
+
+def _parse_int(value: str | None) -> int | None:
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _parse_float(regex: re.Pattern[str], value: str | None) -> float | None:
+    if value is None or not (match := regex.match(value)):
+        return None
+    return float(match.group("value"))
+
+
+@dataclass(frozen=True, slots=True)
+class ProgressEvent:
+    """A block of FFmpeg's -progress output, with values that are not (yet) available set to None."""
+
+    out_time_us: int | None = None
+    total_size: int | None = None
+    speed: float | None = None
+    bitrate: float | None = None  # kBit/s
+    ended: bool = False
+
+    @classmethod
+    def from_block(cls, block: dict[str, str]) -> Self:
+        return cls(
+            out_time_us=_parse_int(block.get("out_time_us")),
+            total_size=_parse_int(block.get("total_size")),
+            speed=_parse_float(re_speed, block.get("speed")),
+            bitrate=_parse_float(re_bitrate, block.get("bitrate")),
+            ended=block.get("progress") == "end",
+        )
+
+
+async def read_progress(stream: asyncio.StreamReader) -> AsyncGenerator[ProgressEvent]:
+    """Yield the blocks FFmpeg writes via -progress, each terminated by a progress= line, as events."""
+    block: dict[str, str] = {}
+    async for line in stream:
+        if not (match := re_progress.match(line.decode("utf-8", errors="replace").strip())):
+            continue
+        block[match.group("key")] = match.group("value").strip()
+        if match.group("key") == "progress":
+            yield ProgressEvent.from_block(block)
+            block = {}
+
+
+async def read_tail(stream: asyncio.StreamReader, *, lines: int = STDERR_TAIL_LINES) -> str:
+    """Drain the stream, returning its last lines."""
+    tail: deque[bytes] = deque(maxlen=lines)
+    async for line in stream:
+        tail.append(line)
+    return b"".join(tail).decode("utf-8", errors="replace").strip()
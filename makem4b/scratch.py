@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import shutil
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+from loguru import logger
+
+from makem4b.emoji import Emoji
+from makem4b.utils import pinfo
+
+if TYPE_CHECKING:
+    from collections.abc import Generator
+    from pathlib import Path
+
+# Free space is checked again periodically while waiting, as files may be removed by other processes.
+RECHECK_INTERVAL = 5.0
+
+
+def _format_size(size: int) -> str:
+    return f"{size / 1_000_000_000:.2f} GB"
+
+
+class ScratchSpace:
+    """Process-wide reservations of free space on the filesystems temporary files are written to.
+
+    A reservation is granted once the free space of the filesystem, minus the space reserved by other
+    books in progress, suffices. Space those books already use is thereby counted twice, erring on the
+    safe side. If the free space does not suffice without any other reservation, waiting would not
+    help, and the reservation fails.
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._reserved: Counter[int] = Counter()
+
+    @contextmanager
+    def reserve(self, directory: Path, size: int) -> Generator[None, None, None]:
+        device = directory.stat().st_dev
+        with self._cond:
+            waiting = False
+            while (free := shutil.disk_usage(directory).free) - self._reserved[device] < size:
+                if not self._reserved[device]:
+                    msg = (
+                        f"Not enough free space in {directory}: "
+                        f"{_format_size(size)} required, {_format_size(free)} free"
+                    )
+                    raise RuntimeError(msg)
+                if not waiting:
+                    pinfo(Emoji.INFO, f"Waiting for {_format_size(size)} of free space in {directory}", style="yellow")
+                    waiting = True
+                self._cond.wait(RECHECK_INTERVAL)
+            logger.debug("Reserved {} in {} ({} free)", _format_size(size), directory, _format_size(free))
+            self._reserved[device] += size
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._reserved[device] -= size
+                self._cond.notify_all()
+
+
+scratch_space = ScratchSpace()
@@ -0,0 +1,384 @@
+from __future__ import annotations
+
+import json
+import os
+import socket
+import socketserver
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import UTC, datetime
+from enum import StrEnum
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING, Any, ClassVar, cast
+from urllib.parse import urlsplit
+
+from click.exceptions import Exit
+from loguru import logger
+from pydantic import BaseModel, ConfigDict, DirectoryPath, Field, FilePath, ValidationError, field_validator
+
+from makem4b import ffmpeg, metrics
+from makem4b.base import process
+from makem4b.emoji import Emoji
+from makem4b.types import ExitCode
+from makem4b.utils import OutputBuffer, ProgressTracker, pinfo
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+    from pathlib import Path
+
+    from makem4b.cli.env import Environment
+
+# Finished jobs are kept for their status to be queried, the oldest ones are forgotten beyond this.
+MAX_FINISHED_JOBS = 1000
+MAX_REQUEST_SIZE = 1_000_000
+COVER_SUFFIXES = (".png", ".jpeg", ".jpg")
+
+
+class JobRequest(BaseModel):
+    """A merge job, taking the same options as the merge command.
+
+    Paths must exist, relative ones are resolved against the working directory of the server.
+    """
+
+    model_config = ConfigDict(extra="forbid")
+
+    files: list[FilePath] = Field(min_length=1)
+    cover: FilePath | None = None
+    move_originals_to: DirectoryPath | None = None
+    analyze_only: bool = False
+    prefer_remux: bool = False
+    no_transcode: bool = False
+    overwrite: bool = False
+
+    @field_validator("files")
+    @classmethod
+    def resolve_files(cls, val: list[Path]) -> list[Path]:
+        return [file.resolve() for file in val]
+
+    @field_validator("cover")
+    @classmethod
+    def validate_cover(cls, val: Path | None) -> Path | None:
+        if val and val.suffix.lower() not in COVER_SUFFIXES:
+            msg = "Cover must point to JPEG or PNG file."
+            raise ValueError(msg)
+        return val.resolve() if val else None
+
+    @field_validator("move_originals_to")
+    @classmethod
+    def resolve_directory(cls, val: Path | None) -> Path | None:
+        return val.resolve() if val else None
+
+
+class JobStatus(StrEnum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    PROCESSED = "processed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+FINISHED = (JobStatus.PROCESSED, JobStatus.FAILED, JobStatus.CANCELLED)
+
+
+def _isoformat(val: datetime | None) -> str | None:
+    return val.isoformat() if val else None
+
+
+@dataclass
+class Job:
+    request: JobRequest
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: JobStatus = JobStatus.QUEUED
+    output: Path | None = None
+    error: str | None = None
+    created: datetime = field(default_factory=lambda: datetime.now(UTC))
+    started: datetime | None = None
+    finished: datetime | None = None
+    log: OutputBuffer = field(default_factory=OutputBuffer)
+    progress: ProgressTracker = field(default_factory=ProgressTracker)
+    group: ffmpeg.ProcessGroup = field(default_factory=ffmpeg.ProcessGroup)
+    future: Future[None] | None = None
+
+    def to_dict(self, *, with_log: bool = False) -> dict[str, Any]:
+        data: dict[str, Any] = {
+            "id": self.id,
+            "status": self.status,
+            "files": [str(file) for file in self.request.files],
+            "output": str(self.output) if self.output else None,
+            "error": self.error,
+            "step": self.progress.step,
+            "progress": [task._asdict() for task in self.progress.tasks()] if self.status == JobStatus.RUNNING else [],
+            "created": _isoformat(self.created),
+            "started": _isoformat(self.started),
+            "finished": _isoformat(self.finished),
+        }
+        if with_log:
+            data["log"] = self.log.text()
+        return data
+
+
+class JobManager:
+    """Run merge jobs on a pool of workers, keeping track of their status.
+
+    Jobs run through the same processing as the merge command, with their output captured instead of
+    printed. Cancelling a running job kills its FFmpeg processes, including those it starts afterwards.
+    """
+
+    def __init__(self, env: Environment, *, workers: int) -> None:
+        self.env = env
+        self._lock = threading.Lock()
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+
+    def submit(self, request: JobRequest) -> Job:
+        job = Job(request)
+        metrics.books_in_progress.inc()
+        with self._lock:
+            self._jobs[job.id] = job
+            job.future = self._executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self) -> list[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job: Job) -> None:
+        """Cancel a queued or running job, or forget a finished one."""
+        with self._lock:
+            if job.status in FINISHED:
+                self._jobs.pop(job.id, None)
+                return
+            if job.future and job.future.cancel():
+                self._finish(job, JobStatus.CANCELLED)
+                return
+        job.group.kill()
+
+    def _run(self, job: Job) -> None:
+        with self._lock:
+            job.status = JobStatus.RUNNING
+            job.started = datetime.now(UTC)
+
+        request = job.request
+        status = JobStatus.PROCESSED
+        try:
+            with job.log.capture(), job.progress.track(), ffmpeg.cancel_group(job.group):
+                job.output = process(
+                    self.env,
+                    files=request.files,
+                    move_originals_to=request.move_originals_to,
+                    analyze_only=request.analyze_only,
+                    prefer_remux=request.prefer_remux,
+                    no_transcode=request.no_transcode,
+                    overwrite=request.overwrite,
+                    cover=request.cover,
+                )
+        except Exception as exc:  # noqa: BLE001
+            status = self._report(job, exc)
+
+        with self._lock:
+            self._finish(job, status)
+
+    def _report(self, job: Job, exc: Exception) -> JobStatus:
+        if job.group.killed:
+            return JobStatus.CANCELLED
+        if isinstance(exc, Exit):
+            if exc.exit_code == ExitCode.SUCCESS:
+                return JobStatus.PROCESSED
+            job.error = ExitCode(exc.exit_code).name if exc.exit_code in ExitCode else str(exc.exit_code)
+            metrics.book_errors.inc(job.error)
+            return JobStatus.FAILED
+
+        metrics.book_errors.inc(ExitCode.GENERIC_ERROR.name)
+        logger.opt(exception=exc).debug("Job {} failed", job.id)
+        job.error = str(exc)
+        return JobStatus.FAILED
+
+    def _finish(self, job: Job, status: JobStatus) -> None:
+        """Record the outcome of a job. Must be called holding the lock."""
+        job.status = status
+        job.finished = datetime.now(UTC)
+        metrics.books_in_progress.dec()
+        metrics.books.inc(status)
+        pinfo(Emoji.INFO, f"Job {job.id} {status}" + (f": {job.error}" if job.error else ""))
+
+        finished = [job_id for job_id, other in self._jobs.items() if other.status in FINISHED]
+        for job_id in finished[: max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def close(self) -> None:
+        """Cancel the queued jobs, and kill the running ones."""
+        for job in self.list():
+            self.cancel(job)
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """JSON API of the job server.
+
+    - `POST /jobs` submits a job, see JobRequest
+    - `GET /jobs` lists the jobs
+    - `GET /jobs/<id>` returns the status, progress, and output of a job
+    - `DELETE /jobs/<id>` cancels a job, or forgets it once finished
+    - `GET /metrics` returns the metrics in Prometheus' text format
+
+    Jobs must be submitted as `application/json`, which web pages cannot send to another origin
+    without the browser asking first. Servers listening on TCP also check the Host header against
+    DNS rebinding, so that web pages cannot submit jobs on behalf of the local user either way.
+    """
+
+    server_version = "makem4b"
+
+    @property
+    def jobs(self) -> JobManager:
+        return cast("JobServer", self.server).jobs
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+        # The default implementation includes the client's address, which is empty for Unix sockets.
+        logger.debug("Job server: {}", format % args)
+
+    def parse_request(self) -> bool:
+        if not super().parse_request():
+            return False
+        allowed_hosts = cast("JobServer", self.server).allowed_hosts
+        if allowed_hosts is not None and urlsplit(f"//{self.headers.get('Host', '')}").hostname not in allowed_hosts:
+            self._send_error(HTTPStatus.FORBIDDEN, "Host not allowed")
+            return False
+        return True
+
+    def _path_parts(self) -> list[str]:
+        return [part for part in urlsplit(self.path).path.split("/") if part]
+
+    def _send(
+        self,
+        status: HTTPStatus,
+        body: bytes,
+        *,
+        content_type: str,
+        headers: dict[str, str] | None = None,
+    ) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: HTTPStatus, data: object, *, headers: dict[str, str] | None = None) -> None:
+        body = (json.dumps(data, indent=2, ensure_ascii=False) + "\n").encode()
+        self._send(status, body, content_type="application/json", headers=headers)
+
+    def _send_error(self, status: HTTPStatus, error: str, **details: Any) -> None:
+        self._send_json(status, {"error": error, **details})
+
+    def _get_job(self, parts: list[str]) -> Job | None:
+        match parts:
+            case ["jobs", job_id] if job := self.jobs.get(job_id):
+                return job
+        self._send_error(HTTPStatus.NOT_FOUND, "Not found")
+        return None
+
+    def do_GET(self) -> None:  # noqa: N802
+        match parts := self._path_parts():
+            case ["jobs"]:
+                self._send_json(HTTPStatus.OK, {"jobs": [job.to_dict() for job in self.jobs.list()]})
+            case ["metrics"]:
+                body = metrics.registry.render().encode()
+                self._send(HTTPStatus.OK, body, content_type="text/plain; version=0.0.4")
+            case _:
+                if job := self._get_job(parts):
+                    self._send_json(HTTPStatus.OK, job.to_dict(with_log=True))
+
+    def do_POST(self) -> None:  # noqa: N802
+        if self._path_parts() != ["jobs"]:
+            self._send_error(HTTPStatus.NOT_FOUND, "Not found")
+            return
+        if self.headers.get_content_type() != "application/json":
+            self._send_error(HTTPStatus.UNSUPPORTED_MEDIA_TYPE, "Content-Type must be application/json")
+            return
+
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_REQUEST_SIZE:
+            self._send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Request too large")
+            return
+        try:
+            request = JobRequest.model_validate_json(self.rfile.read(length))
+        except ValidationError as exc:
+            self._send_error(HTTPStatus.BAD_REQUEST, "Invalid job", details=json.loads(exc.json(include_url=False)))
+            return
+
+        job = self.jobs.submit(request)
+        self._send_json(HTTPStatus.CREATED, job.to_dict(), headers={"Location": f"/jobs/{job.id}"})
+
+    def do_DELETE(self) -> None:  # noqa: N802
+        if job := self._get_job(self._path_parts()):
+            self.jobs.cancel(job)
+            self._send_json(HTTPStatus.OK, job.to_dict())
+
+
+class JobServer(socketserver.BaseServer):
+    jobs: JobManager
+    # Host names requests must be addressed to, or None to accept any.
+    allowed_hosts: ClassVar[frozenset[str] | None] = None
+
+
+class TCPJobServer(ThreadingHTTPServer, JobServer):
+    allowed_hosts: ClassVar[frozenset[str] | None] = frozenset({"127.0.0.1", "localhost"})
+
+    def __init__(self, port: int, *, jobs: JobManager) -> None:
+        self.jobs = jobs
+        super().__init__(("127.0.0.1", port), JobRequestHandler)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host!s}:{port}"
+
+
+class UnixJobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer, JobServer):
+    daemon_threads = True
+    # Owner and group may connect, so that another user of the group can submit jobs.
+    socket_umask: ClassVar[int] = 0o117
+
+    def __init__(self, path: Path, *, jobs: JobManager) -> None:
+        self.jobs = jobs
+        self.path = path
+        remove_stale_socket(path)
+        super().__init__(str(path), JobRequestHandler)
+
+    def server_bind(self) -> None:
+        umask = os.umask(self.socket_umask)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.path.unlink(missing_ok=True)
+
+    @property
+    def url(self) -> str:
+        return f"unix:{self.path}"
+
+
+def remove_stale_socket(path: Path) -> None:
+    """Remove the socket file a server left behind, raising if a server is still listening on it."""
+    if not path.is_socket():
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(path))
+        except ConnectionRefusedError:
+            path.unlink()
+            return
+    msg = f"A server is already listening on {path}"
+    raise OSError(msg)
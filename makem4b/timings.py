@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import TYPE_CHECKING
+
+from rich import box
+from rich.table import Table
+
+from makem4b.utils import current_console
+
+if TYPE_CHECKING:
+    from collections.abc import Generator, Iterable
+    from pathlib import Path
+
+
+def children_cpu_time() -> float:
+    """CPU time (user and system) spent by terminated child processes, such as FFmpeg."""
+    if sys.platform == "win32":
+        return 0.0
+
+    import resource
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def total_size(files: Iterable[Path]) -> int:
+    size = 0
+    for file in files:
+        try:
+            size += file.stat().st_size
+        except OSError:
+            continue
+    return size
+
+
+@dataclass
+class SpanStats:
+    name: str
+    calls: int = 0
+    wall: float = 0.0
+    children_cpu: float = 0.0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    files: int = 0
+
+
+@dataclass
+class Span:
+    """An open span, collecting the files written while it is open."""
+
+    outputs: list[Path] = field(default_factory=list)
+
+    def wrote(self, *files: Path | None) -> None:
+        self.outputs += (file for file in files if file)
+
+
+class Timings:
+    """Aggregate the wall time, child CPU time, and I/O of named processing steps.
+
+    Child CPU time is accounted for by the process as a whole, so when multiple books are processed
+    at the same time, each span also includes the CPU time of the processes of concurrent spans.
+    """
+
+    def __init__(self) -> None:
+        self.spans: dict[str, SpanStats] = {}
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._cpu_started = children_cpu_time()
+
+    @contextmanager
+    def span(self, name: str, *, inputs: Iterable[Path] = ()) -> Generator[Span, None, None]:
+        inputs = list(inputs)
+        bytes_read = total_size(inputs)
+        span = Span()
+        cpu_started = children_cpu_time()
+        started = time.perf_counter()
+        try:
+            yield span
+        finally:
+            wall = time.perf_counter() - started
+            children_cpu = children_cpu_time() - cpu_started
+            bytes_written = total_size(span.outputs)
+            with self._lock:
+                stats = self.spans.setdefault(name, SpanStats(name=name))
+                stats.calls += 1
+                stats.wall += wall
+                stats.children_cpu += children_cpu
+                stats.bytes_read += bytes_read
+                stats.bytes_written += bytes_written
+                stats.files += len(inputs)
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._started
+
+    @property
+    def children_cpu(self) -> float:
+        return children_cpu_time() - self._cpu_started
+
+    def to_dict(self) -> dict[str, object]:
+        with self._lock:
+            return {
+                "elapsed": self.elapsed,
+                "children_cpu": self.children_cpu,
+                "spans": [asdict(stats) for stats in self.spans.values()],
+            }
+
+    def write_json(self, file: Path) -> None:
+        file.write_text(json.dumps(self.to_dict(), indent=2) + "\n")
+
+    def print_table(self) -> None:
+        elapsed = self.elapsed
+        table = Table(box=box.SIMPLE)
+        table.add_column("Step", no_wrap=True)
+        table.add_column("Calls", justify="right")
+        table.add_column("Wall", justify="right")
+        table.add_column("Share", justify="right")
+        table.add_column("FFmpeg CPU", justify="right")
+        table.add_column("Read", justify="right")
+        table.add_column("Written", justify="right")
+        table.add_column("Files", justify="right")
+        with self._lock:
+            for stats in self.spans.values():
+                table.add_row(
+                    stats.name,
+                    str(stats.calls),
+                    f"{stats.wall:.2f} s",
+                    f"{stats.wall / elapsed:.0%}" if elapsed > 0 else "-",
+                    f"{stats.children_cpu:.2f} s",
+                    f"{stats.bytes_read / 1_000_000:.1f} MB",
+                    f"{stats.bytes_written / 1_000_000:.1f} MB",
+                    str(stats.files),
+                )
+        table.add_section()
+        table.add_row("total", "", f"{elapsed:.2f} s", "", f"{self.children_cpu:.2f} s", "", "", "")
+        current_console().print(table)
@@ -1,9 +1,8 @@
 from __future__ import annotations
 
-from collections import defaultdict
+import sys
 from dataclasses import dataclass, field
 from enum import IntEnum, StrEnum
-from statistics import mean
 from typing import TYPE_CHECKING, NamedTuple
 
 from makem4b import constants
@@ -48,12 +47,44 @@ class CodecParams(NamedTuple):
     channels: int
 
 
-@dataclass
+@dataclass(slots=True)
+class ProbedStream:
+    """The parameters of an audio stream that processing relies on, out of everything FFprobe reports about it."""
+
+    codec_name: str
+    sample_rate: float
+    bit_rate: float
+    channels: int
+    duration: float
+
+    @classmethod
+    def from_audio_stream(cls, stream: AudioStream) -> ProbedStream:
+        return cls(
+            codec_name=sys.intern(stream.codec_name),
+            sample_rate=stream.sample_rate,
+            bit_rate=stream.bit_rate,
+            channels=stream.channels,
+            duration=stream.duration,
+        )
+
+    @property
+    def duration_ts(self) -> int:
+        return round(self.duration * constants.TIMEBASE)
+
+    @property
+    def approx_size(self) -> int:
+        bps = self.bit_rate / 8
+        return round(self.duration * bps)
+
+
+@dataclass(slots=True)
 class ProbedFile:
     filename: Path
-    stream: AudioStream
-    metadata: Metadata
+    stream: ProbedStream
+    title: str
     has_cover: bool
+    # All tags of the file, only kept for the first file of a ProbeResult, see drop_metadata.
+    metadata: Metadata | None
     output_filename_stem: str = field(init=False)
 
     @classmethod
@@ -72,11 +103,13 @@ class ProbedFile:
             msg = f"File {file} contains no usable audio stream"
             raise ValueError(msg)
 
+        metadata = data.format_.tags
         return cls(
             filename=file,
-            stream=audio,
-            metadata=data.format_.tags,
+            stream=ProbedStream.from_audio_stream(audio),
+            title=metadata.title,
             has_cover=has_cover,
+            metadata=metadata,
         )
 
     def __post_init__(self) -> None:
@@ -91,9 +124,27 @@ class ProbedFile:
             channels=self.stream.channels,
         )
 
+    def drop_metadata(self, first: ProbedFile) -> None:
+        """Drop the tags of a file following first, of which only the title ends up in the output.
+
+        The output filename stem is shared with first where it is equal, as it is for the files of most books.
+        """
+        self.metadata = None
+        if self.output_filename_stem == first.output_filename_stem:
+            self.output_filename_stem = first.output_filename_stem
+
+    def to_chapter(self, start_ts: int, end_ts: int) -> str:
+        props = [
+            constants.CHAPTER_HEADER,
+            f"START={start_ts}",
+            f"END={end_ts}",
+            f"title={self.title}",
+        ]
+        return "\n" + "\n".join(props) + "\n"
+
     def _make_stem(self) -> str:
         metadata = self.metadata
-        if not metadata.artist and not metadata.album:
+        if not metadata or (not metadata.artist and not metadata.album):
             return self.filename.stem + "_merged"
 
         stem = f"{metadata.artist} -"
@@ -107,26 +158,85 @@ class ProbedFile:
         return self.filename.stem == self.output_filename_stem
 
 
+@dataclass
+class _CodecStats:
+    """Running statistics over the distinct codec parameters seen so far."""
+
+    first: CodecParams
+    uniform: bool = True
+    bit_rate_sum: float = 0.0
+    count: int = 0
+    min_bit_rate: float = float("inf")
+    max_bit_rate: float = 0.0
+    max_sample_rate: float = 0.0
+    min_channels: int = 9999
+
+    def add(self, params: CodecParams) -> None:
+        first = self.first
+        if (
+            params.codec_name != first.codec_name
+            or params.sample_rate != first.sample_rate
+            or params.channels != first.channels
+        ):
+            self.uniform = False
+        self.bit_rate_sum += params.bit_rate
+        self.count += 1
+        self.min_bit_rate = min(self.min_bit_rate, params.bit_rate)
+        self.max_bit_rate = max(self.max_bit_rate, params.bit_rate)
+        self.max_sample_rate = max(self.max_sample_rate, params.sample_rate)
+        self.min_channels = min(self.min_channels, params.channels)
+
+    @property
+    def match_loosely(self) -> bool:
+        if not self.uniform:
+            return False
+
+        # This might be a terrible assumption to make but in my testing this
+        # did not cause any issues in playback or chapter alignment: If the distance from mean
+        # between bit rates is less than 128 bits, remuxing files works just fine.
+        avg = self.bit_rate_sum / self.count
+        return max(self.max_bit_rate - avg, avg - self.min_bit_rate) < 128
+
+
 @dataclass
 class ProbeResult:
     files: list[ProbedFile]
 
     processing_params: tuple[ProcessingMode, CodecParams] | None = field(default=None, init=False)
-    seen_codecs: dict[CodecParams, list[Path]] = field(default_factory=dict, init=False)
+    # Indices of the files in files by their codec parameters.
+    seen_codecs: dict[CodecParams, list[int]] = field(default_factory=dict, init=False)
+    _stats: _CodecStats | None = field(default=None, init=False, repr=False)
 
     def __post_init__(self) -> None:
-        if self.files:
-            self._remove_prospective_output()
-        if self.files:
-            self.seen_codecs = self._generate_seen_codecs()
-            self.processing_params = self._generate_processing_params()
+        files, self.files = self.files, []
+        for file in files:
+            self.add(file)
 
     def add(self, probed_file: ProbedFile) -> None:
-        self.files.append(probed_file)
-        self._remove_prospective_output()
+        """Add a file, updating codec statistics and processing parameters in constant time."""
+        if probed_file.matches_prospective_output:
+            pinfo(
+                Emoji.EVADED_DRAGONS,
+                "Removed input that looks too much like the prospective output:",
+                probed_file.filename.name,
+                style="yellow",
+            )
+            return
+
         if self.files:
-            self.seen_codecs = self._generate_seen_codecs()
-            self.processing_params = self._generate_processing_params()
+            probed_file.drop_metadata(self.first)
+        index = len(self.files)
+        self.files.append(probed_file)
+        params = probed_file.codec_params
+        if (seen := self.seen_codecs.get(params)) is not None:
+            seen.append(index)
+            return
+
+        self.seen_codecs[params] = [index]
+        if not self._stats:
+            self._stats = _CodecStats(first=params)
+        self._stats.add(params)
+        self.processing_params = self._generate_processing_params(self._stats)
 
     def check_should_bail(
         self,
@@ -148,75 +258,22 @@ class ProbeResult:
 
         return None
 
-    def _remove_prospective_output(self) -> None:
-        clean_files = []
-        for file in self.files:
-            if file.matches_prospective_output:
-                pinfo(
-                    Emoji.EVADED_DRAGONS,
-                    "Removed input that looks too much like the prospective output:",
-                    file.filename.name,
-                    style="yellow",
-                )
-                continue
-
-            clean_files.append(file)
-        self.files = clean_files
-
-    def _generate_seen_codecs(self) -> dict[CodecParams, list[Path]]:
-        codecs: dict[CodecParams, list[Path]] = defaultdict(list)
-        for file in self.files:
-            codecs[file.codec_params].append(file.filename)
-        return codecs
-
     @staticmethod
-    def _codecs_match_loosely(seen_codecs: list[CodecParams]) -> bool:
-        cn = seen_codecs[0].codec_name
-        sr = seen_codecs[0].sample_rate
-        ch = seen_codecs[0].channels
-
-        bit_rates = [seen_codecs[0].bit_rate]
-        for params in seen_codecs[1:]:
-            if params.codec_name != cn or params.sample_rate != sr or params.channels != ch:
-                return False
-            bit_rates.append(params.bit_rate)
-
-        # This might be a terrible assumption to make but in my testing this
-        # did not cause any issues in playback or chapter alignment: If the distance from mean
-        # between bit rates is less than 128 bits, remuxing files works just fine.
-        avg = mean(bit_rates)
-        return max(abs(br - avg) for br in bit_rates) < 128
-
-    def _generate_processing_params(self) -> tuple[ProcessingMode, CodecParams] | None:
-        seen_codecs = list(self.seen_codecs.keys())
-        if not seen_codecs:
-            return None
-
-        first_seen = seen_codecs[0]
+    def _generate_processing_params(stats: _CodecStats) -> tuple[ProcessingMode, CodecParams]:
+        first_seen = stats.first
         mode = (
             ProcessingMode.REMUX
             if first_seen.codec_name in constants.SUPPORT_REMUX_CODECS
             else ProcessingMode.TRANSCODE_UNIFORM
         )
-        if len(seen_codecs) == 1 or self._codecs_match_loosely(seen_codecs):
+        if stats.count == 1 or stats.match_loosely:
             return mode, first_seen
 
-        max_bit_rate = 0.0
-        max_sample_rate = 0.0
-        min_channels = 9999
-        for codec in seen_codecs:
-            if (fbr := codec.bit_rate) > max_bit_rate:
-                max_bit_rate = fbr
-            if (fsr := codec.sample_rate) > max_sample_rate:
-                max_sample_rate = fsr
-            if (fch := codec.channels) < min_channels:
-                min_channels = fch
-
         return ProcessingMode.TRANSCODE_MIXED, CodecParams(
             "aac",
-            sample_rate=max_sample_rate,
-            bit_rate=max_bit_rate,
-            channels=min_channels,
+            sample_rate=stats.max_sample_rate,
+            bit_rate=stats.max_bit_rate,
+            channels=stats.min_channels,
         )
 
     @property
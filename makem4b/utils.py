@@ -1,24 +1,86 @@
 from __future__ import annotations
 
+import hashlib
+import io
 import os
 import re
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
 from pathlib import Path
 from typing import TYPE_CHECKING, Any, NamedTuple
 
+from loguru import logger
 from rich import get_console
-from rich.progress import Progress
+from rich.console import Console
+from rich.text import Text
 
 from makem4b import constants
 from makem4b.emoji import Emoji
 
 if TYPE_CHECKING:
-    from pathlib import Path
+    from collections.abc import Generator
 
     from rich.progress import Progress, TaskID
 
+_buffered_console: ContextVar[Console | None] = ContextVar("buffered_console", default=None)
+_progress_tracker: ContextVar[ProgressTracker | None] = ContextVar("progress_tracker", default=None)
+
+
+def current_console() -> Console:
+    return _buffered_console.get() or get_console()
+
+
+def is_output_buffered() -> bool:
+    return _buffered_console.get() is not None
+
+
+class OutputBuffer:
+    """Buffer for the output of a task that might move between threads.
+
+    Output printed while the buffer is capturing in the current context is collected, and
+    printed at once when flushed.
+    """
+
+    def __init__(self) -> None:
+        console = get_console()
+        self._buffer = io.StringIO()
+        self.console = Console(
+            file=self._buffer,
+            width=console.width,
+            force_terminal=console.is_terminal,
+            color_system=console.color_system,  # type: ignore[arg-type]
+        )
+
+    @contextmanager
+    def capture(self) -> Generator[Console, None, None]:
+        token = _buffered_console.set(self.console)
+        try:
+            yield self.console
+        finally:
+            _buffered_console.reset(token)
+
+    def text(self) -> str:
+        """Return the output buffered so far, without styles."""
+        return Text.from_ansi(self._buffer.getvalue()).plain
+
+    def flush(self) -> None:
+        if output := self._buffer.getvalue():
+            get_console().print(Text.from_ansi(output), end="")
+        self._buffer.seek(0)
+        self._buffer.truncate()
+
 
 def pinfo(emoji: Emoji = Emoji.INFO, *objects: Any, **print_kwargs: Any) -> None:
-    get_console().print(emoji, *objects, **print_kwargs)
+    current_console().print(emoji, *objects, **print_kwargs)
+
+
+class TaskState(NamedTuple):
+    description: str
+    completed: float
+    total: float | None
 
 
 class TaskProgress(NamedTuple):
@@ -27,15 +89,74 @@ class TaskProgress(NamedTuple):
 
     @classmethod
     def make(cls, progress: Progress, **task_kwargs: Any) -> TaskProgress:
-        return cls(progress=progress, task_id=progress.add_task(**task_kwargs))
+        task = cls(progress=progress, task_id=progress.add_task(**task_kwargs))
+        if tracker := _progress_tracker.get():
+            tracker.add(task)
+        return task
+
+    @property
+    def state(self) -> TaskState | None:
+        for task in self.progress.tasks:
+            if task.id == self.task_id:
+                return TaskState(description=task.description, completed=task.completed, total=task.total)
+        return None
 
     def update(self, **update_kwargs: Any) -> None:
         self.progress.update(self.task_id, **update_kwargs)
 
     def close(self) -> None:
+        if tracker := _progress_tracker.get():
+            tracker.discard(self)
         self.progress.remove_task(self.task_id)
 
 
+class ProgressTracker:
+    """Follow the processing step and progress tasks of a book, for reporting them other than on the console.
+
+    Progress tasks made in a context the tracker is tracking in are followed until they are closed, even
+    when their progress display is disabled.
+    """
+
+    def __init__(self) -> None:
+        self.step: str | None = None
+        self._lock = threading.Lock()
+        self._tasks: list[TaskProgress] = []
+
+    @contextmanager
+    def track(self) -> Generator[ProgressTracker, None, None]:
+        token = _progress_tracker.set(self)
+        try:
+            yield self
+        finally:
+            _progress_tracker.reset(token)
+
+    def add(self, task: TaskProgress) -> None:
+        with self._lock:
+            self._tasks.append(task)
+
+    def discard(self, task: TaskProgress) -> None:
+        with self._lock:
+            if task in self._tasks:
+                self._tasks.remove(task)
+
+    def tasks(self) -> list[TaskState]:
+        """Return the states of the tasks followed that have not finished yet."""
+        with self._lock:
+            tasks = list(self._tasks)
+        return [
+            state for task in tasks if (state := task.state) and (state.total is None or state.completed < state.total)
+        ]
+
+
+def current_progress_tracker() -> ProgressTracker | None:
+    return _progress_tracker.get()
+
+
+def display_path(path: Path, cwd: Path) -> Path:
+    """Path relative to cwd for display, or as is if it lies outside of cwd."""
+    return path.relative_to(cwd) if path.is_relative_to(cwd) else path
+
+
 def escape_concat_filename(val: Path) -> str:
     re_escape = re.compile(r"([^a-zA-Z0-9\/\._-])")
     return re_escape.sub(r"\\\1", str(val.absolute()))
@@ -75,10 +196,54 @@ def parse_grouping(val: str) -> tuple[str, str] | None:
     return None
 
 
-def make_tempdir(parent: Path) -> Path:
-    tempdir = parent / constants.TEMPDIR_NAME
-    tempdir.mkdir(exist_ok=True)
-    (tempdir / constants.CACHEDIR_TAG).touch()
-    (tempdir / constants.DOTIGNORE_FILE).touch()
-    (tempdir / constants.PLEXIGNORE_FILE).write_text("*")
-    return tempdir
+TEMPDIR_MARKERS = (constants.CACHEDIR_TAG, constants.DOTIGNORE_FILE, constants.PLEXIGNORE_FILE)
+TEMPDIR_ATTEMPTS = 3
+
+
+def make_tempdir(parent: Path, *, scratch_dir: Path | None = None) -> Path:
+    container = parent / constants.TEMPDIR_NAME
+    if scratch_dir:
+        # Keep the temporary directories of books with the same directory name apart.
+        digest = hashlib.sha1(str(parent).encode(), usedforsecurity=False).hexdigest()[:10]
+        container = scratch_dir / f"{parent.name}-{digest}"
+    attempts = TEMPDIR_ATTEMPTS
+    while True:
+        container.mkdir(parents=True, exist_ok=True)
+        try:
+            (container / constants.CACHEDIR_TAG).touch()
+            (container / constants.DOTIGNORE_FILE).touch()
+            (container / constants.PLEXIGNORE_FILE).write_text("*")
+            # Concurrent jobs on the same directory must not share their intermediates.
+            return Path(tempfile.mkdtemp(prefix="job-", dir=container))
+        except FileNotFoundError:
+            # The job of another process removed the container in the meantime.
+            attempts -= 1
+            if not attempts:
+                raise
+
+
+def remove_tempdir(tempdir: Path) -> None:
+    """Remove the temporary directory of a job, and its container once no other job uses it."""
+    for file in tempdir.iterdir():
+        file.unlink(missing_ok=True)
+    tempdir.rmdir()
+    container = tempdir.parent
+    try:
+        if any(entry.name not in TEMPDIR_MARKERS for entry in container.iterdir()):
+            return
+        for name in TEMPDIR_MARKERS:
+            (container / name).unlink(missing_ok=True)
+        # Fails if another job created its directory in the meantime, which then keeps the container.
+        container.rmdir()
+    except OSError as exc:
+        logger.debug("Keeping temporary directory {}: {}", container, exc)
+
+
+def user_cache_dir() -> Path:
+    if sys.platform == "win32":
+        base = Path(os.environ.get("LOCALAPPDATA") or Path.home() / "AppData" / "Local")
+    elif sys.platform == "darwin":
+        base = Path.home() / "Library" / "Caches"
+    else:
+        base = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    return base / constants.PROG_NAME
@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+from typing import TYPE_CHECKING, Protocol
+
+from loguru import logger
+
+from makem4b import constants
+from makem4b.discovery import walk_directories
+from makem4b.library import fingerprint_inputs
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable
+    from pathlib import Path
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+# Writes are not watched, the files of a changed directory are checked for stability anyway.
+WATCH_MASK = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW
+)
+
+# struct inotify_event, followed by the name of len bytes.
+INOTIFY_EVENT = struct.Struct("iIII")
+INOTIFY_READ_SIZE = 64 * 1024
+
+
+def fingerprint_directory(directory: Path) -> str | None:
+    """Fingerprint the names, sizes, and mtimes of the files in directory, or None if it cannot be read."""
+    try:
+        with os.scandir(directory) as it:
+            return fingerprint_inputs(entry for entry in it if entry.is_file(follow_symlinks=False))
+    except OSError:
+        return None
+
+
+class Watcher(Protocol):
+    def wait(self, timeout: float) -> set[Path]:
+        """Wait up to timeout seconds for changes, returning the directories with changed files."""
+        ...
+
+    def close(self) -> None: ...
+
+
+class InotifyWatcher:
+    """Watch a directory tree with inotify, adding watches for directories as they are created."""
+
+    def __init__(self, directory: Path, *, prune: list[Path], relevant: Callable[[str], bool]) -> None:
+        if not sys.platform.startswith("linux"):
+            msg = "inotify is only available on Linux"
+            raise OSError(errno.ENOSYS, msg)
+
+        self.directory = directory
+        self.prune = prune
+        self.relevant = relevant
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._paths: dict[int, Path] = {}
+        try:
+            self.add_tree(directory)
+        except OSError:
+            self.close()
+            raise
+
+    def add_tree(self, directory: Path) -> set[Path]:
+        """Watch directory and its subdirectories, returning them."""
+        added = set()
+        for dirpath, _ in walk_directories(directory, prune=self.prune):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirpath), WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    msg = "inotify watch limit reached, see fs.inotify.max_user_watches"
+                    raise OSError(err, msg)
+                logger.debug("Cannot watch {}: {}", dirpath, os.strerror(err))
+                continue
+            self._paths[wd] = dirpath
+            added.add(dirpath)
+        return added
+
+    def wait(self, timeout: float) -> set[Path]:
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+        try:
+            data = os.read(self._fd, INOTIFY_READ_SIZE)
+        except BlockingIOError:
+            return set()
+
+        changed: set[Path] = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            changed |= self._handle_event(wd, mask, name)
+        return changed
+
+    def _handle_event(self, wd: int, mask: int, name: str) -> set[Path]:
+        if mask & IN_Q_OVERFLOW:
+            logger.warning("Missed file system events, checking all directories")
+            return self.add_tree(self.directory)
+        if mask & IN_IGNORED:
+            self._paths.pop(wd, None)
+            return set()
+        if not (dirpath := self._paths.get(wd)):
+            return set()
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO) and name != constants.TEMPDIR_NAME:
+                return self.add_tree(dirpath / name)
+            return set()
+        return {dirpath} if self.relevant(name) else set()
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """Watch a directory tree by comparing snapshots of the relevant files of its directories."""
+
+    def __init__(
+        self,
+        directory: Path,
+        *,
+        prune: list[Path],
+        relevant: Callable[[str], bool],
+        interval: float,
+    ) -> None:
+        self.directory = directory
+        self.prune = prune
+        self.relevant = relevant
+        self.interval = interval
+        self._snapshot = self._take_snapshot()
+        self._next_poll = time.monotonic() + interval
+
+    def _take_snapshot(self) -> dict[Path, str]:
+        return {
+            dirpath: fingerprint_inputs(
+                entry for entry in entries if entry.is_file(follow_symlinks=False) and self.relevant(entry.name)
+            )
+            for dirpath, entries in walk_directories(self.directory, prune=self.prune)
+        }
+
+    def wait(self, timeout: float) -> set[Path]:
+        remaining = self._next_poll - time.monotonic()
+        if remaining > timeout:
+            time.sleep(timeout)
+            return set()
+
+        time.sleep(max(remaining, 0))
+        self._next_poll = time.monotonic() + self.interval
+        snapshot = self._take_snapshot()
+        changed = {dirpath for dirpath, fingerprint in snapshot.items() if self._snapshot.get(dirpath) != fingerprint}
+        self._snapshot = snapshot
+        return changed
+
+    def close(self) -> None:
+        pass
+
+
+def open_watcher(
+    directory: Path,
+    *,
+    prune: list[Path],
+    relevant: Callable[[str], bool],
+    poll_interval: float,
+    polling: bool = False,
+) -> Watcher:
+    """Watch directory with inotify, falling back to polling where it is unavailable."""
+    if not polling:
+        try:
+            return InotifyWatcher(directory, prune=prune, relevant=relevant)
+        except (OSError, AttributeError) as exc:
+            logger.warning("Cannot watch with inotify, polling every {} seconds instead: {}", poll_interval, exc)
+    return PollingWatcher(directory, prune=prune, relevant=relevant, interval=poll_interval)
+
+
+class PendingDirectories:
+    """Directories with changes, released once their files have stopped changing.
+
+    A directory is settled once no changes were reported for it for settle seconds, and the sizes and mtimes
+    of its files are still the same another settle seconds later.
+    """
+
+    def __init__(self, *, settle: float) -> None:
+        self.settle = settle
+        # Time of the last change, and the fingerprint of the files after it has been checked once.
+        self._pending: dict[Path, tuple[float, str | None]] = {}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def touch(self, directories: Iterable[Path]) -> None:
+        now = time.monotonic()
+        for directory in directories:
+            self._pending[directory] = (now, None)
+
+    def settled(self) -> list[Path]:
+        now = time.monotonic()
+        released = []
+        for directory, (changed, fingerprint) in list(self._pending.items()):
+            if now - changed < self.settle:
+                continue
+            current = fingerprint_directory(directory)
+            if current is None:
+                del self._pending[directory]
+            elif current == fingerprint:
+                del self._pending[directory]
+                released.append(directory)
+            else:
+                self._pending[directory] = (now, current)
+        return sorted(released)